@@ -4,20 +4,33 @@ Bamboo API 测试共享 Fixtures
 此文件包含 pytest 共享 fixtures，自动被所有测试文件使用。
 """
 
+from __future__ import annotations
+
+import functools
+import hashlib
 import os
+import subprocess
 import pytest
 import pytest_asyncio
 import asyncio
-import aiohttp
-import websockets
 import json
+import orjson
 import time
-import uuid
-import psutil
 from pathlib import Path
-from typing import Generator, Dict, Any, List, Optional
+from typing import TYPE_CHECKING, Generator, Dict, Any, List, Optional, Union
 from dataclasses import dataclass
 
+# aiohttp / websockets 只在类型注解里出现，运行时在用到的函数内导入：
+# 只用到本文件中少数辅助函数的测试模块不会被迫加载它们
+if TYPE_CHECKING:
+    import aiohttp
+    import websockets
+
+try:
+    import uvloop
+except ImportError:  # 可选依赖，未安装时使用默认事件循环
+    uvloop = None
+
 
 # 项目根目录
 PROJECT_ROOT = Path(__file__).parent.parent.parent
@@ -60,24 +73,52 @@ def load_fixture(filename: str) -> Dict[str, Any]:
 # 辅助函数
 # =============================================================================
 
+# WebSocket 消息编解码（orjson）；编码结果解码为 str，保持以文本帧发送
+ws_loads = orjson.loads
+
+
+def ws_dumps(obj: Any) -> str:
+    return orjson.dumps(obj).decode()
+
+
+def chat_payload(message: str) -> bytes:
+    """序列化聊天请求体（可预先构建后传给 create_session_via_http 复用）"""
+    return orjson.dumps({
+        "message": message,
+        "model": "gpt-4"
+    })
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
 async def create_session_via_http(
     http_session: aiohttp.ClientSession,
     config: TestConfig,
-    message: str = "Hello, this is a test message"
+    message: Union[str, bytes] = "Hello, this is a test message"
 ) -> Dict[str, Any]:
-    """通过 HTTP 创建会话"""
-    payload = {
-        "message": message,
-        "model": "gpt-4"
-    }
+    """通过 HTTP 创建会话（message 为 bytes 时视为已序列化的请求体）"""
+    import aiohttp
+    
+    payload = message if isinstance(message, bytes) else chat_payload(message)
     
     async with http_session.post(
         config.chat_url,
-        json=payload,
+        data=payload,
+        headers=_JSON_HEADERS,
         timeout=aiohttp.ClientTimeout(total=config.timeout)
     ) as response:
         assert response.status == 201
-        return await response.json()
+        result = await response.json()
+    
+    # 预先拼好完整的流地址，调用方无需重复拼接
+    result['absolute_stream_url'] = f"{config.base_url}{result['stream_url']}"
+    return result
+
+
+def make_session_id(prefix: str) -> str:
+    """生成带前缀的随机 session_id"""
+    return f"{prefix}-{os.urandom(4).hex()}"
 
 
 async def connect_ws(
@@ -89,11 +130,11 @@ async def connect_ws(
         "type": "Connect",
         "session_id": session_id
     }
-    await ws.send(json.dumps(connect_msg))
+    await ws.send(ws_dumps(connect_msg))
     
     # 等待 Connected 响应
     response = await asyncio.wait_for(ws.recv(), timeout=10)
-    return json.loads(response)
+    return ws_loads(response)
 
 
 async def send_chat_via_ws(
@@ -107,7 +148,30 @@ async def send_chat_via_ws(
         "session_id": session_id,
         "content": content
     }
-    await ws.send(json.dumps(chat_msg))
+    await ws.send(ws_dumps(chat_msg))
+
+
+# 表示一轮对话结束的事件类型
+TERMINAL_EVENT_TYPES = frozenset({'Complete', 'Error'})
+
+
+async def drain_ws(
+    ws: websockets.WebSocketClientProtocol,
+    overall: float = 30.0,
+    terminal: frozenset = TERMINAL_EVENT_TYPES
+) -> List[Dict[str, Any]]:
+    """持续接收 WebSocket 消息，直到收到结束事件或总超时"""
+    events = []
+    try:
+        async with asyncio.timeout(overall):
+            async for raw in ws:
+                data = ws_loads(raw)
+                events.append(data)
+                if data.get('type') in terminal:
+                    break
+    except TimeoutError:
+        pass
+    return events
 
 
 async def read_sse_stream(
@@ -115,29 +179,33 @@ async def read_sse_stream(
     stream_url: str,
     timeout: float = 30.0
 ) -> List[Dict[str, Any]]:
-    """读取 SSE 流并返回所有事件"""
+    """读取 SSE 流并返回所有事件（按块读取，在缓冲区内切分 data 行）"""
     events = []
-    start_time = time.time()
+    buffer = bytearray()
     
     async with http_session.get(stream_url) as response:
         assert response.status == 200
         
-        async for line in response.content:
-            if time.time() - start_time > timeout:
-                break
-                
-            line = line.decode('utf-8').strip()
-            if line.startswith('data: '):
-                data = line[6:]  # 去掉 'data: ' 前缀
-                try:
-                    event = json.loads(data)
-                    events.append(event)
-                    
-                    # 检查是否完成
-                    if event.get('type') in ['Complete', 'Error']:
-                        break
-                except json.JSONDecodeError:
-                    pass
+        try:
+            async with asyncio.timeout(timeout):
+                async for chunk in response.content.iter_chunked(16384):
+                    buffer += chunk
+                    while (end := buffer.find(b"\n")) >= 0:
+                        line = bytes(buffer[:end]).rstrip(b"\r")
+                        del buffer[:end + 1]
+                        if not line.startswith(b"data:"):
+                            continue
+                        try:
+                            event = orjson.loads(line[5:].lstrip())
+                        except orjson.JSONDecodeError:
+                            continue
+                        events.append(event)
+                        
+                        # 检查是否完成
+                        if event.get('type') in TERMINAL_EVENT_TYPES:
+                            return events
+        except TimeoutError:
+            pass
     
     return events
 
@@ -172,35 +240,65 @@ async def stop_session(
 # 性能监控
 # =============================================================================
 
+# 延迟直方图可追踪的最大值（微秒，即 60s）
+LATENCY_MAX_US = 60_000_000
+
+
+@functools.cache
+def _hdr_histogram_class():
+    """按需导入 hdrh（只有记录延迟时才用到），未安装时不影响其他测试的收集"""
+    from hdrh.histogram import HdrHistogram
+    return HdrHistogram
+
+
+def new_latency_histogram():
+    """创建延迟直方图：1µs ~ 60s，3 位有效数字"""
+    return _hdr_histogram_class()(1, LATENCY_MAX_US, 3)
+
+
+def record_latency_us(histogram, latency_us: int) -> None:
+    """记录一个延迟样本（微秒）
+    
+    超过 LATENCY_MAX_US 的值 record_value 会返回 False 且不计数，
+    所以先钳到上限：样本数不丢，max 显示为上限。
+    """
+    histogram.record_value(min(latency_us, LATENCY_MAX_US))
+
+
 class PerformanceMonitor:
     """性能监控器"""
     
     def __init__(self):
+        import psutil  # 仅在实际做性能监控时才导入
         self.process = psutil.Process()
         self.start_time: Optional[float] = None
         self.metrics: Dict[str, Any] = {}
+        self.histograms: Dict[str, Any] = {}  # 名称 -> HdrHistogram（微秒）
     
     def start(self):
         """开始监控"""
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
         self.metrics['start_memory'] = self.process.memory_info().rss / 1024 / 1024  # MB
         self.metrics['start_cpu'] = self.process.cpu_percent()
     
     def stop(self):
         """停止监控并记录指标"""
         if self.start_time:
-            self.metrics['duration'] = time.time() - self.start_time
+            self.metrics['duration'] = time.perf_counter() - self.start_time
         self.metrics['end_memory'] = self.process.memory_info().rss / 1024 / 1024  # MB
         self.metrics['memory_delta'] = self.metrics['end_memory'] - self.metrics['start_memory']
         self.metrics['end_cpu'] = self.process.cpu_percent()
     
+    def record_latency_ns(self, name: str, latency_ns: int):
+        """记录延迟指标（纳秒，按微秒精度写入固定桶直方图）"""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = new_latency_histogram()
+        record_latency_us(histogram, latency_ns // 1000)
+    
     def record_latency(self, name: str, latency_ms: float):
-        """记录延迟指标"""
-        if 'latencies' not in self.metrics:
-            self.metrics['latencies'] = {}
-        if name not in self.metrics['latencies']:
-            self.metrics['latencies'][name] = []
-        self.metrics['latencies'][name].append(latency_ms)
+        """记录延迟指标（毫秒）"""
+        self.record_latency_ns(name, int(latency_ms * 1_000_000))
     
     def get_summary(self) -> Dict[str, Any]:
         """获取性能摘要"""
@@ -211,17 +309,17 @@ class PerformanceMonitor:
             'memory_delta_mb': self.metrics.get('memory_delta', 0),
         }
         
-        # 计算延迟统计
-        if 'latencies' in self.metrics:
-            for name, values in self.metrics['latencies'].items():
-                if values:
-                    summary[f'{name}_latency_ms'] = {
-                        'min': min(values),
-                        'max': max(values),
-                        'avg': sum(values) / len(values),
-                        'p95': sorted(values)[int(len(values) * 0.95)] if len(values) > 1 else values[0],
-                        'count': len(values)
-                    }
+        # 计算延迟统计（直方图值单位为微秒）
+        for name, histogram in self.histograms.items():
+            if histogram.get_total_count():
+                summary[f'{name}_latency_ms'] = {
+                    'min': histogram.get_min_value() / 1000,
+                    'max': histogram.get_max_value() / 1000,
+                    'avg': histogram.get_mean_value() / 1000,
+                    'p95': histogram.get_value_at_percentile(95) / 1000,
+                    'p99': histogram.get_value_at_percentile(99) / 1000,
+                    'count': histogram.get_total_count()
+                }
         
         return summary
 
@@ -243,13 +341,16 @@ TEST_MESSAGES = [
     "How does blockchain work?"
 ]
 
+# 预序列化的 TEST_MESSAGES 请求体，压测循环中直接按序号取用
+TEST_PAYLOADS = tuple(chat_payload(m) for m in TEST_MESSAGES)
+
 
 # ============================================
 # 异步 Fixtures
 # ============================================
 
-@pytest_asyncio.fixture
-async def config() -> TestConfig:
+@pytest.fixture(scope="session")
+def config() -> TestConfig:
     """返回测试配置"""
     return TestConfig(
         base_url=os.getenv("BAMBOO_API_URL", "http://127.0.0.1:8080"),
@@ -258,10 +359,13 @@ async def config() -> TestConfig:
     )
 
 
-@pytest_asyncio.fixture
+@pytest_asyncio.fixture(scope="session")
 async def http_session():
-    """创建 HTTP session"""
-    async with aiohttp.ClientSession() as session:
+    """创建整个测试会话共享的 HTTP session（复用 keep-alive 连接）"""
+    import aiohttp
+    
+    connector = aiohttp.TCPConnector(limit=128, keepalive_timeout=60, ttl_dns_cache=600)
+    async with aiohttp.ClientSession(connector=connector) as session:
         yield session
 
 
@@ -411,6 +515,16 @@ def slow_tests_enabled() -> bool:
 # pytest 配置钩子
 # ============================================
 
+def pytest_addoption(parser):
+    """注册命令行选项"""
+    parser.addoption(
+        "--test-cache",
+        action="store_true",
+        default=False,
+        help="跳过源码未变且上次已通过的测试（按文件内容哈希 + git HEAD 判断，工作区有未提交改动时不生效）"
+    )
+
+
 def pytest_configure(config):
     """pytest 配置钩子"""
     # 添加自定义标记
@@ -426,3 +540,98 @@ def pytest_runtest_setup(item):
         env_var = marker.args[0]
         if not os.getenv(env_var):
             pytest.skip(f"需要环境变量: {env_var}")
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_asyncio_loop_factories(config, item):
+    """安装了 uvloop 时，异步测试统一跑在 uvloop 事件循环上"""
+    if uvloop is None or os.getenv("BAMBOO_NO_UVLOOP"):
+        return None
+    return {"uvloop": uvloop.new_event_loop}
+
+
+# ============================================
+# 测试结果缓存（--test-cache）
+# ============================================
+
+TEST_CACHE_PREFIX = "bamboo_hashes"
+
+
+def _git(*args: str) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=TESTS_DIR,
+        capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+@functools.lru_cache(maxsize=None)
+def _git_head() -> str:
+    """当前 git HEAD；工作区不干净（含未跟踪文件）或获取失败时返回空串
+    
+    缓存键只含 HEAD 和测试文件哈希，工作区的其他改动（被测代码、fixtures 数据）
+    不在键里，所以有未提交改动时既不读也不写缓存。
+    """
+    try:
+        if _git("status", "--porcelain"):
+            return ""
+        return _git("rev-parse", "HEAD")
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+@functools.lru_cache(maxsize=None)
+def _source_digest(path: str) -> str:
+    """测试文件与 conftest.py 的联合内容哈希"""
+    digest = hashlib.blake2b()
+    for source in (path, __file__):
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _test_cache_enabled(config) -> bool:
+    return (
+        config.getoption("--test-cache")
+        and getattr(config, "cache", None) is not None
+        and bool(_git_head())
+    )
+
+
+def pytest_report_header(config):
+    """--test-cache 因工作区不干净而不生效时在报告头里说明"""
+    if config.getoption("--test-cache") and not _git_head():
+        return "test-cache: disabled (working tree has uncommitted changes or git is unavailable)"
+
+
+def pytest_collection_modifyitems(config, items):
+    """跳过源码未变且上次通过的测试"""
+    if not _test_cache_enabled(config):
+        return
+    
+    head = _git_head()
+    cached_pass = pytest.mark.skip(reason="cached-pass")
+    for item in items:
+        entry = config.cache.get(f"{TEST_CACHE_PREFIX}/{item.nodeid}", None)
+        if (
+            entry
+            and entry.get("outcome") == "passed"
+            and entry.get("head") == head
+            and entry.get("hash") == _source_digest(str(item.fspath))
+        ):
+            item.add_marker(cached_pass)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    """记录测试结果供下次 --test-cache 使用"""
+    outcome = yield
+    report = outcome.get_result()
+    if not _test_cache_enabled(item.config):
+        return
+    # 只记录真正执行后的结果，以及任一阶段的失败
+    if report.when == "call" or report.failed:
+        item.config.cache.set(f"{TEST_CACHE_PREFIX}/{item.nodeid}", {
+            "outcome": report.outcome,
+            "head": _git_head(),
+            "hash": _source_digest(str(item.fspath)),
+        })
@@ -0,0 +1,1524 @@
+"""
+Bamboo Session 存储实现（供 test_session.py 使用）
+
+- SessionMetadata / SessionState：会话数据模型
+- JSONLSessionStore：JSONL 追加写存储（组提交、偏移索引、读缓存、分段与归档）
+- SessionManager：内存会话表 + 过期清理 + 存储恢复
+"""
+
+import asyncio
+import functools
+import mmap
+import os
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, Any
+import gzip
+import heapq
+import itertools
+import shutil
+
+import orjson
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖，未安装时归档使用 gzip
+    zstandard = None
+
+
+# ============================================================================
+# 数据模型
+# ============================================================================
+
+@dataclass(slots=True)
+class SessionMetadata:
+    """Session 元数据"""
+    session_id: str
+    client_id: str
+    created_at: float
+    last_activity: float
+    expires_at: float
+    user_agent: str
+    ip_address: str
+    custom_data: Dict[str, Any]
+    
+    def to_dict(self) -> Dict:
+        return asdict(self)
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'SessionMetadata':
+        return cls(**data)
+
+
+@dataclass(slots=True)
+class SessionState:
+    """Session 状态"""
+    session_id: str
+    status: str  # active, inactive, expired
+    data: Dict[str, Any]
+    sequence_number: int
+    checkpoint_id: str
+    
+    def to_dict(self) -> Dict:
+        return asdict(self)
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'SessionState':
+        return cls(**data)
+
+
+# ============================================================================
+# Session 存储实现
+# ============================================================================
+
+# 偏移索引未命中的哨兵（区别于“索引确认不存在该类型记录”的 None）
+_INDEX_MISS = object()
+
+# 小于该大小的文件直接缓冲读，mmap 的建立开销不划算
+_MMAP_MIN_SIZE = 4096
+
+# 完整性校验要解析整个文件，达到该大小才改用 mmap + memoryview 切片（省去整文件复制）
+_MMAP_PARSE_MIN_SIZE = 64 * 1024
+
+# SessionManager 按 session 分片的写入锁个数（2 的幂）
+_LOCK_SHARDS = 64
+
+# 归档时流式拷贝的缓冲区大小
+_COPY_BUFSIZE = 64 * 1024
+
+# _encode_record 写出的每行开头（orjson 保持键顺序，"type" 总在最前）
+_KIND_PREFIX = b'{"type":"'
+
+# 单次 writev 的缓冲区个数上限（Linux 的 IOV_MAX）
+_IOV_MAX = 1024
+
+# 归档编码 -> 文件后缀；读取时两种后缀都会查找
+_ARCHIVE_SUFFIXES = {"zstd": ".jsonl.zst", "gzip": ".jsonl.gz"}
+
+# 小于 compression_min_size 的 session 不压缩，直接改名为该后缀（压缩小文件只会变大）
+_PLAIN_ARCHIVE_SUFFIX = ".jsonl.archived"
+_ARCHIVE_READ_SUFFIXES = (*_ARCHIVE_SUFFIXES.values(), _PLAIN_ARCHIVE_SUFFIX)
+_ARCHIVE_ERRORS = (gzip.BadGzipFile,) + ((zstandard.ZstdError,) if zstandard else ())
+
+# zstd 字典：训练样本（单条记录）数下限/上限，字典大小上限（且不超过样本总量的 1/10）
+_ZSTD_DICT_MIN_SAMPLES = 16
+_ZSTD_DICT_SAMPLES = 2048
+_ZSTD_DICT_SIZE = 100_000
+
+
+def _encode_record(kind: str, data: Any) -> bytes:
+    """序列化一条记录行
+    
+    orjson 直接序列化 dataclass（省去 asdict 的递归拷贝），换行符由 orjson 一并写出，
+    不再额外拼接一次 bytes。按类型预生成信封前缀、只拼接时间戳和 data 的模板写法实测更慢
+    （浮点数 repr 与多段拼接的开销超过 orjson 序列化三个键），所以信封仍整体交给 orjson。
+    返回的 bytes 要在写队列里留到所在批次落盘，所以不复用编码缓冲区：
+    每条记录一次分配就是最终写出的对象。
+    """
+    record = {"type": kind, "timestamp": time.time(), "data": data}
+    try:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    except orjson.JSONEncodeError:
+        # 与 json.dumps 一致，把非字符串键（int、None 等）转成字符串；
+        # 该选项会拖慢常规记录的序列化，只在失败时重试
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+
+
+@functools.cache
+def _numpy():
+    """按需导入 numpy（只有大文件校验用到）；未安装时返回 None"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _line_spans(buf) -> List[Tuple[int, int]]:
+    """按 b"\\n" 找出每行的 (起, 止) 偏移（不含换行符），不复制行内容
+    
+    有 numpy 时一次向量化比较找出所有换行符，否则逐个 find。
+    """
+    size = len(buf)
+    np = _numpy()
+    if np is not None:
+        newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 0x0A)
+        starts = [0, *(newlines + 1).tolist()]
+        ends = newlines.tolist()
+        if starts[-1] < size:
+            ends.append(size)
+        else:
+            starts.pop()
+        return list(zip(starts, ends))
+    
+    spans = []
+    find = buf.find
+    start = 0
+    while start < size:
+        nl = find(b'\n', start)
+        if nl == -1:
+            nl = size
+        spans.append((start, nl))
+        start = nl + 1
+    return spans
+
+
+def _peek_kind(line: bytes) -> Optional[str]:
+    """不解析整行，从 _encode_record 写出的紧凑前缀 {"type":"..." 读出记录类型
+    
+    其他格式（外部写入、带空格的 JSON 等）返回 None，由调用方完整解析。
+    """
+    if not line.startswith(_KIND_PREFIX):
+        return None
+    end = line.find(b'"', len(_KIND_PREFIX))
+    if end == -1:
+        return None
+    return line[len(_KIND_PREFIX):end].decode()
+
+
+# 只追加的文件用 fdatasync 即可（文件长度变化仍会落盘，省去 mtime 等元数据的刷写）
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+
+def _write_all(fd: int, buffers: List[bytes]) -> None:
+    """把一批记录行写入 fd：有 os.writev 时每 _IOV_MAX 行一次系统调用，不先拼接成一个 bytes"""
+    if not hasattr(os, "writev"):
+        data = memoryview(b''.join(buffers))
+        while data:
+            data = data[os.write(fd, data):]
+        return
+    
+    for start in range(0, len(buffers), _IOV_MAX):
+        chunk = buffers[start:start + _IOV_MAX]
+        written = os.writev(fd, chunk)
+        if written < sum(map(len, chunk)):
+            # 部分写入（很少见）时把剩余部分逐次补齐
+            rest = memoryview(b''.join(chunk))[written:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
+
+
+def _rsplit_lines(buf) -> Iterator[bytes]:
+    """从缓冲区末尾向前按 b"\\n" 切分，产出的行不含换行符"""
+    rfind = buf.rfind
+    end = len(buf)
+    while end > 0:
+        nl = rfind(b'\n', 0, end)
+        yield buf[nl + 1:end]
+        end = nl
+
+
+def _iter_lines_reversed(path: Path, decompress: Optional[Callable[[bytes], bytes]] = None) -> Iterator[bytes]:
+    """从文件末尾向前逐行读取；普通文件 mmap 后回溯，找到目标即停只会触及尾部页面"""
+    with open(path, 'rb') as f:
+        if decompress is not None:
+            yield from _rsplit_lines(decompress(f.read()))
+            return
+        if os.fstat(f.fileno()).st_size < _MMAP_MIN_SIZE:
+            yield from _rsplit_lines(f.read())
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from _rsplit_lines(mm)
+
+
+class JSONLSessionStore:
+    """JSONL 格式的 Session 持久化存储"""
+    
+    def __init__(
+        self,
+        storage_dir: str,
+        compress_after_days: int = 7,
+        max_queue_size: int = 4096,
+        fsync: bool = False,
+        commit_delay: float = 0.0,
+        max_batch_bytes: int = 1 << 20,
+        max_open_files: int = 256,
+        archive_codec: Optional[str] = None,
+        max_segment_bytes: int = 1 << 20,
+        max_cached_sessions: int = 4096,
+        compression_min_size: int = 512
+    ):
+        self.storage_dir = Path(storage_dir)
+        self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self.compress_after_days = compress_after_days
+        self.compression_min_size = compression_min_size
+        
+        # 归档/删除按 session 加锁，不同 session 互不阻塞；没有协程持有时锁随之回收
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        
+        # 后台写协程：save_* 把记录放进有界队列，写协程取出已排队的全部记录，
+        # 按 session 合并成一次 write，整批落盘后再唤醒各调用方（组提交）
+        self.max_queue_size = max_queue_size
+        self.fsync = fsync
+        # 开启 fsync 时，写协程取到第一条记录后再等 commit_delay 秒，让更多记录搭上同一次刷盘
+        self.commit_delay = commit_delay
+        # 单批次字节数上限：积压很多时分多批写，先到的调用方不必等整个积压写完
+        self.max_batch_bytes = max_batch_bytes
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        
+        # 追加模式文件描述符缓存（LRU），避免每次落盘都 open/close；
+        # 写入直接 writev 到 fd，不经过 Python 文件对象
+        self.max_open_files = max_open_files
+        self._handles: OrderedDict[str, int] = OrderedDict()
+        
+        # 文件 I/O 不在事件循环里做：写入/归档/删除走单个写线程保证顺序，读取走默认线程池。
+        # 写线程按需创建，close_all 时关闭
+        self._io_executor: Optional[ThreadPoolExecutor] = None
+        
+        # 记录偏移索引：session_id -> {"size": 文件大小, 记录类型: (偏移, 长度)}
+        # 只在索引从文件开头连续覆盖本实例写入时保留，读取时文件大小不符即回退到文件扫描
+        self._index: Dict[str, Dict[str, Any]] = {}
+        
+        # 归档编码：安装了 zstandard 时默认 zstd（带训练字典），否则 gzip
+        self.archive_codec = archive_codec or ("zstd" if zstandard else "gzip")
+        if self.archive_codec == "zstd" and zstandard is None:
+            raise ValueError("archive_codec='zstd' requires the zstandard package")
+        self._zstd_dict_path = self.storage_dir / ".zstd.dict"
+        self._zstd_dict: Optional["zstandard.ZstdCompressionDict"] = None
+        self._zstd_dict_tried = False
+        # 带字典的解压上下文按线程缓存（ZstdDecompressor 不能跨线程并发使用）
+        self._zstd_local = threading.local()
+        
+        # 分段滚动：活动文件超过 max_segment_bytes 时改名为 {session_id}.jsonl.{n}，
+        # 新活动文件以最新的元数据/状态记录开头，加载只读当前分段
+        self.max_segment_bytes = max_segment_bytes
+        self._segment_counts: Dict[str, int] = {}
+        
+        # 文件大小缓存：启动时扫描一次目录，之后由写线程在写入/归档/删除时增量维护，
+        # list_sessions 与 get_storage_stats 不再每次遍历目录
+        self._active_sizes: Dict[str, int] = {}
+        self._archive_sizes: Dict[str, int] = {}
+        self._segment_sizes: Dict[str, int] = {}
+        self._total_size = 0
+        self._scan_storage_dir()
+        
+        # 读缓存（LRU）：session_id -> (文件 (mtime_ns, size), 解码后的对象)。
+        # 命中时只需一次 stat；写线程落盘/滚动/归档/删除时失效，stat 不符也视为未命中。
+        # 读取在默认线程池中并发执行，所以缓存操作加锁
+        self.max_cached_sessions = max_cached_sessions
+        self._session_cache: OrderedDict[str, Tuple[Tuple[int, int], Optional[SessionMetadata]]] = OrderedDict()
+        self._state_cache: OrderedDict[str, Tuple[Tuple[int, int], Optional[SessionState]]] = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
+        # I/O 计数：写入批次/记录数、刷盘次数、按索引读取与回溯扫描的次数。
+        # 写线程和读线程都会累加，所以同样加锁
+        self.io_stats: Dict[str, int] = dict.fromkeys(
+            ("batches", "records", "syncs", "indexed_reads", "scans"), 0
+        )
+        self._stats_lock = threading.Lock()
+        
+    def _count(self, key: str, n: int = 1) -> None:
+        """累加一项 I/O 计数"""
+        with self._stats_lock:
+            self.io_stats[key] += n
+    
+    def _scan_storage_dir(self) -> None:
+        """单次 os.scandir 遍历存储目录，建立文件大小缓存
+        
+        只比较文件名后缀，不构造 Path；DirEntry.stat() 复用目录项里的信息。
+        """
+        archive_suffixes = _ARCHIVE_READ_SUFFIXES
+        with os.scandir(self.storage_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.endswith(".jsonl"):
+                    self._track_size(self._active_sizes, name[:-6], entry.stat(follow_symlinks=False).st_size)
+                elif name.endswith(archive_suffixes):
+                    session_id = name[:name.rindex(".jsonl.")]
+                    self._track_size(self._archive_sizes, session_id, entry.stat(follow_symlinks=False).st_size)
+                else:
+                    session_id, sep, segment_no = name.rpartition(".jsonl.")
+                    if sep and segment_no.isdigit():
+                        size = entry.stat(follow_symlinks=False).st_size
+                        self._track_size(self._segment_sizes, session_id, self._segment_sizes.get(session_id, 0) + size)
+                        self._segment_counts[session_id] = max(self._segment_counts.get(session_id, 0), int(segment_no))
+    
+    def _track_size(self, sizes: Dict[str, int], session_id: str, size: Optional[int]) -> None:
+        """更新缓存的文件大小，size 为 None 表示文件已删除"""
+        self._total_size -= sizes.pop(session_id, 0)
+        if size is not None:
+            sizes[session_id] = size
+            self._total_size += size
+    
+    def _cache_get(self, cache: OrderedDict, session_id: str, stamp: Tuple[int, int]) -> Any:
+        """查读缓存，文件 stat 与缓存时一致才算命中；未命中返回 _INDEX_MISS"""
+        with self._cache_lock:
+            cached = cache.get(session_id)
+            if cached is None or cached[0] != stamp:
+                return _INDEX_MISS
+            cache.move_to_end(session_id)
+            return cached[1]
+    
+    def _cache_put(self, cache: OrderedDict, session_id: str, stamp: Tuple[int, int], value: Any) -> None:
+        """写入读缓存，超出上限时淘汰最久未用的"""
+        with self._cache_lock:
+            cache[session_id] = (stamp, value)
+            cache.move_to_end(session_id)
+            if len(cache) > self.max_cached_sessions:
+                cache.popitem(last=False)
+    
+    def _invalidate_cache(self, session_id: str) -> None:
+        """session 文件变化后丢弃其缓存（在写线程中执行）"""
+        with self._cache_lock:
+            self._session_cache.pop(session_id, None)
+            self._state_cache.pop(session_id, None)
+    
+    def _stat_session(self, session_id: str) -> Optional[Tuple[Path, Tuple[int, int], bool]]:
+        """返回 (数据文件, (mtime_ns, size), 是否为归档)；活跃文件优先，都不存在时返回 None"""
+        file_path = self._get_session_file(session_id)
+        try:
+            st = os.stat(file_path)
+            return file_path, (st.st_mtime_ns, st.st_size), False
+        except FileNotFoundError:
+            pass
+        archive_path = self._find_archive(session_id)
+        if archive_path is None:
+            return None
+        try:
+            st = os.stat(archive_path)
+        except FileNotFoundError:
+            return None
+        return archive_path, (st.st_mtime_ns, st.st_size), True
+    
+    def _get_session_file(self, session_id: str) -> Path:
+        """获取 session 文件路径"""
+        return self.storage_dir / f"{session_id}.jsonl"
+    
+    def _get_segment_files(self, session_id: str) -> List[Path]:
+        """获取已滚动的历史分段路径（从旧到新）"""
+        return [
+            self.storage_dir / f"{session_id}.jsonl.{n}"
+            for n in range(1, self._segment_counts.get(session_id, 0) + 1)
+        ]
+    
+    def _get_archive_file(self, session_id: str) -> Path:
+        """获取归档文件路径（按当前归档编码）"""
+        return self.storage_dir / f"{session_id}{_ARCHIVE_SUFFIXES[self.archive_codec]}"
+    
+    def _find_archive(self, session_id: str) -> Optional[Path]:
+        """查找已有的归档文件（zstd、gzip 或未压缩）"""
+        for suffix in _ARCHIVE_READ_SUFFIXES:
+            path = self.storage_dir / f"{session_id}{suffix}"
+            if path.exists():
+                return path
+        return None
+    
+    def _load_zstd_dict(self) -> Optional["zstandard.ZstdCompressionDict"]:
+        """读取已持久化的 zstd 字典"""
+        if self._zstd_dict is None and self._zstd_dict_path.exists():
+            self._zstd_dict = zstandard.ZstdCompressionDict(self._zstd_dict_path.read_bytes())
+        return self._zstd_dict
+    
+    def _iter_dict_samples(self) -> Iterator[bytes]:
+        """逐条产出训练样本：先取活动文件中的记录，不够时再取旧 gzip 归档中的记录"""
+        for file_path in self.storage_dir.glob("*.jsonl"):
+            yield from file_path.read_bytes().splitlines()
+        for archive_path in self.storage_dir.glob(f"*{_ARCHIVE_SUFFIXES['gzip']}"):
+            try:
+                yield from gzip.decompress(archive_path.read_bytes()).splitlines()
+            except _ARCHIVE_ERRORS:
+                continue
+    
+    def _train_zstd_dict(self) -> Optional["zstandard.ZstdCompressionDict"]:
+        """用现有记录训练 zstd 字典并持久化；样本不足时返回 None（在写线程中执行）
+        
+        记录的字段名、UUID、时间戳高度重复，以单条记录为样本训练的字典对小文件压缩率提升明显；
+        session 都已归档（冷启动）时也能从旧 gzip 归档取样。
+        字典一旦落盘就不再重训，保证旧归档始终可解压。
+        """
+        if self._load_zstd_dict() is not None or self._zstd_dict_tried:
+            return self._zstd_dict
+        
+        samples = []
+        for sample in self._iter_dict_samples():
+            if sample:
+                samples.append(sample)
+                if len(samples) >= _ZSTD_DICT_SAMPLES:
+                    break
+        if len(samples) < _ZSTD_DICT_MIN_SAMPLES:
+            return None
+        
+        # 样本足够仍训练失败时本实例不再重试
+        self._zstd_dict_tried = True
+        dict_size = min(_ZSTD_DICT_SIZE, sum(map(len, samples)) // 10)
+        try:
+            zstd_dict = zstandard.train_dictionary(dict_size, samples)
+        except zstandard.ZstdError:
+            return None
+        
+        tmp_path = self._zstd_dict_path.with_suffix(".tmp")
+        tmp_path.write_bytes(zstd_dict.as_bytes())
+        os.replace(tmp_path, self._zstd_dict_path)
+        self._zstd_dict = zstd_dict
+        return zstd_dict
+    
+    def _write_archive(self, files: List[Path], archive_path: Path) -> None:
+        """把文件依次流式压缩到临时文件，fsync 后用 os.replace 原子替换为归档（在写线程中执行）
+        
+        归档只用于冷恢复，压缩级别取 1；中途失败只会留下被清理的临时文件，原 session 文件完好。
+        """
+        tmp_path = archive_path.with_name(archive_path.name + ".tmp")
+        try:
+            with open(tmp_path, 'wb', buffering=_COPY_BUFSIZE) as raw:
+                if self.archive_codec == "zstd":
+                    cctx = zstandard.ZstdCompressor(level=1, dict_data=self._train_zstd_dict())
+                    # 写明内容大小，解压时可一次分配输出缓冲
+                    dst = cctx.stream_writer(raw, size=sum(p.stat().st_size for p in files), closefd=False)
+                else:
+                    dst = gzip.GzipFile(filename='', mode='wb', compresslevel=1, fileobj=raw)
+                with dst:
+                    for path in files:
+                        with open(path, 'rb', buffering=0) as src:
+                            shutil.copyfileobj(src, dst, _COPY_BUFSIZE)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp_path, archive_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    
+    def _decompressor(self, archive_path: Path) -> Optional[Callable[[bytes], bytes]]:
+        """按归档文件后缀返回解压函数；未压缩的归档返回 None，按普通文件读取"""
+        if archive_path.name.endswith(".zst"):
+            return self._zstd_decompress
+        if archive_path.name.endswith(_PLAIN_ARCHIVE_SUFFIX):
+            return None
+        return gzip.decompress
+    
+    def _zstd_decompress(self, data: bytes) -> bytes:
+        """解压 zstd 归档；帧头记录了字典 ID 时才带上字典"""
+        if zstandard is None:
+            raise ValueError("reading .zst archives requires the zstandard package")
+        if not zstandard.get_frame_parameters(data).dict_id:
+            return zstandard.ZstdDecompressor().decompress(data)
+        dctx = getattr(self._zstd_local, "dctx", None)
+        if dctx is None:
+            dctx = self._zstd_local.dctx = zstandard.ZstdDecompressor(dict_data=self._load_zstd_dict())
+        return dctx.decompress(data)
+    
+    async def submit(self, session_id: str, kind: str, data: Any) -> asyncio.Future:
+        """编码记录并按调用顺序放入写队列，返回所在批次落盘时完成的 future
+        
+        save_session/save_state 是入队后等待落盘的简写；需要在锁内入队、
+        锁外等待落盘的调用方（SessionManager）直接用本方法。
+        """
+        if self._writer_task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._writer_task = asyncio.create_task(self._writer_loop())
+        
+        written = asyncio.get_running_loop().create_future()
+        await self._queue.put((session_id, _encode_record(kind, data), kind, written))
+        return written
+    
+    async def _writer_loop(self) -> None:
+        """写协程：每轮取出队列中已有的记录（不超过 max_batch_bytes），交给写线程一次落盘"""
+        queue = self._queue
+        while True:
+            items = [await queue.get()]
+            if self.fsync and self.commit_delay > 0:
+                await asyncio.sleep(self.commit_delay)
+            batch_bytes = len(items[0][1])
+            while batch_bytes < self.max_batch_bytes and not queue.empty():
+                item = queue.get_nowait()
+                items.append(item)
+                batch_bytes += len(item[1])
+            
+            # 每个 session 的行与类型分成两个并列列表，行列表可直接交给 writev
+            pending: Dict[str, Tuple[List[bytes], List[str]]] = defaultdict(lambda: ([], []))
+            for session_id, line, kind, _ in items:
+                lines, kinds = pending[session_id]
+                lines.append(line)
+                kinds.append(kind)
+            
+            try:
+                await self._run_io(self._write_batches, pending)
+            except Exception as e:
+                for *_, written in items:
+                    if not written.done():
+                        written.set_exception(e)
+            else:
+                for *_, written in items:
+                    if not written.done():
+                        written.set_result(None)
+            finally:
+                for _ in items:
+                    queue.task_done()
+    
+    def _get_handle(self, session_id: str) -> int:
+        """获取 session 文件的 O_APPEND 描述符（LRU 缓存，超出上限时关闭最久未用的）"""
+        fd = self._handles.get(session_id)
+        if fd is not None:
+            self._handles.move_to_end(session_id)
+            return fd
+        
+        fd = os.open(
+            self._get_session_file(session_id),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644
+        )
+        # 上次崩溃可能留下没有换行符的半截记录：先补一个换行，避免新记录拼接到坏行上一起丢失
+        size = os.fstat(fd).st_size
+        if size and self._read_last_byte(session_id, size) != b'\n':
+            _write_all(fd, [b'\n'])
+        self._handles[session_id] = fd
+        if len(self._handles) > self.max_open_files:
+            _, oldest = self._handles.popitem(last=False)
+            os.close(oldest)
+        return fd
+    
+    def _read_last_byte(self, session_id: str, size: int) -> bytes:
+        """读取活动文件的最后一个字节（追加描述符是只写的，另开只读描述符）"""
+        fd = os.open(self._get_session_file(session_id), os.O_RDONLY)
+        try:
+            return os.pread(fd, 1, size - 1)
+        finally:
+            os.close(fd)
+    
+    @property
+    def cached_handles(self) -> List[str]:
+        """持有缓存追加描述符的 session_id，从最久未用到最近使用"""
+        return list(self._handles)
+    
+    def _close_handle(self, session_id: str) -> None:
+        """关闭并移除 session 的缓存描述符（归档/删除文件前调用）"""
+        fd = self._handles.pop(session_id, None)
+        if fd is not None:
+            os.close(fd)
+    
+    def _executor(self) -> ThreadPoolExecutor:
+        """返回写线程，未创建或已被 close_all 关闭时新建"""
+        if self._io_executor is None:
+            self._io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jsonl-store")
+        return self._io_executor
+    
+    def close_all(self) -> None:
+        """停止写协程、关闭写线程和所有缓存的文件句柄（调用前先 await flush()）"""
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+            self._queue = None
+        executor, self._io_executor = self._io_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        while self._handles:
+            _, fd = self._handles.popitem()
+            os.close(fd)
+    
+    def _write_batches(self, pending: Dict[str, Tuple[List[bytes], List[str]]]) -> None:
+        """每个 session 一次 writev 追加一批记录（在写线程中执行）"""
+        self._count("batches")
+        for session_id, (lines, kinds) in pending.items():
+            fd = self._get_handle(session_id)
+            offset = os.lseek(fd, 0, os.SEEK_END)
+            _write_all(fd, lines)
+            self._count("records", len(lines))
+            if self.fsync:
+                _datasync(fd)
+                self._count("syncs")
+            self._index_batch(session_id, offset, lines, kinds)
+            self._invalidate_cache(session_id)
+            # O_APPEND 写入后文件位置就在末尾
+            size = os.lseek(fd, 0, os.SEEK_CUR)
+            self._track_size(self._active_sizes, session_id, size)
+            if size >= self.max_segment_bytes:
+                self._rotate_segment(session_id)
+    
+    def _rotate_segment(self, session_id: str) -> None:
+        """把活动文件滚动为历史分段，并把最新的元数据/状态记录带入新的活动文件（在写线程中执行）"""
+        file_path = self._get_session_file(session_id)
+        lines, kinds = [], []
+        for kind in ("metadata", "state"):
+            line = self._read_latest_line(session_id, kind)
+            if line is not None:
+                lines.append(line)
+                kinds.append(kind)
+        
+        self._close_handle(session_id)
+        self._index.pop(session_id, None)
+        self._invalidate_cache(session_id)
+        segment_no = self._segment_counts.get(session_id, 0) + 1
+        os.replace(file_path, self.storage_dir / f"{session_id}.jsonl.{segment_no}")
+        self._segment_counts[session_id] = segment_no
+        self._track_size(
+            self._segment_sizes, session_id,
+            self._segment_sizes.get(session_id, 0) + self._active_sizes.get(session_id, 0)
+        )
+        self._track_size(self._active_sizes, session_id, None)
+        
+        if lines:
+            fd = self._get_handle(session_id)
+            _write_all(fd, lines)
+            if self.fsync:
+                _datasync(fd)
+                self._count("syncs")
+            self._index_batch(session_id, 0, lines, kinds)
+            self._track_size(self._active_sizes, session_id, os.lseek(fd, 0, os.SEEK_CUR))
+    
+    def _read_latest_line(self, session_id: str, kind: str) -> Optional[bytes]:
+        """读取活动文件中某类型最新记录的原始行（含换行符）"""
+        entry = self._index.get(session_id)
+        file_path = self._get_session_file(session_id)
+        if entry is not None and entry["size"] == file_path.stat().st_size:
+            if kind not in entry:
+                return None
+            offset, length = entry[kind]
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                return f.read(length)
+        
+        for line in _iter_lines_reversed(file_path):
+            if not line or line.isspace():
+                continue
+            peeked = _peek_kind(line)
+            if peeked is not None and peeked != kind:
+                continue
+            try:
+                if orjson.loads(line).get("type") == kind:
+                    return line + b'\n'
+            except orjson.JSONDecodeError:
+                continue
+        return None
+    
+    def _index_batch(self, session_id: str, offset: int, lines: List[bytes], kinds: List[str]) -> None:
+        """把一批记录的偏移并入索引；与已有索引不连续时丢弃该 session 的索引"""
+        entry = self._index.get(session_id)
+        if entry is None:
+            if offset != 0:
+                return
+            entry = self._index[session_id] = {"size": 0}
+        elif entry["size"] != offset:
+            del self._index[session_id]
+            return
+        
+        for line, kind in zip(lines, kinds):
+            entry[kind] = (offset, len(line))
+            offset += len(line)
+        entry["size"] = offset
+    
+    def _read_indexed(self, session_id: str, kind: str) -> Any:
+        """按偏移索引直接读取某类型最新记录的 data；索引不可用时返回 _INDEX_MISS"""
+        entry = self._index.get(session_id)
+        if entry is None:
+            return _INDEX_MISS
+        
+        try:
+            with open(self._get_session_file(session_id), 'rb') as f:
+                if os.fstat(f.fileno()).st_size != entry["size"]:
+                    return _INDEX_MISS
+                if kind not in entry:
+                    return None
+                offset, length = entry[kind]
+                f.seek(offset)
+                self._count("indexed_reads")
+                return orjson.loads(f.read(length))["data"]
+        except (OSError, orjson.JSONDecodeError):
+            return _INDEX_MISS
+    
+    def _load_session_sync(self, session_id: str) -> Optional[SessionMetadata]:
+        """同步加载元数据：先查读缓存和索引，未命中再从文件末尾回溯，没有活跃文件时读归档"""
+        located = self._stat_session(session_id)
+        if located is None:
+            return None
+        path, stamp, archived = located
+        session = self._cache_get(self._session_cache, session_id, stamp)
+        if session is not _INDEX_MISS:
+            return session
+        
+        if archived:
+            self._count("scans")
+            session = self._read_latest_metadata(path, self._decompressor(path))
+        else:
+            data = self._read_indexed(session_id, "metadata")
+            if data is _INDEX_MISS:
+                self._count("scans")
+                session = self._read_latest_metadata(path)
+            else:
+                session = SessionMetadata.from_dict(data) if data is not None else None
+        self._cache_put(self._session_cache, session_id, stamp, session)
+        return session
+    
+    def _load_state_sync(self, session_id: str) -> Optional[SessionState]:
+        """同步加载状态：先查读缓存和索引，未命中再从文件末尾回溯，没有活跃文件时读归档"""
+        located = self._stat_session(session_id)
+        if located is None:
+            return None
+        path, stamp, archived = located
+        state = self._cache_get(self._state_cache, session_id, stamp)
+        if state is not _INDEX_MISS:
+            return state
+        
+        if archived:
+            self._count("scans")
+            state = self._read_latest_state(path, self._decompressor(path))
+        else:
+            data = self._read_indexed(session_id, "state")
+            if data is _INDEX_MISS:
+                self._count("scans")
+                state = self._read_latest_state(path)
+            else:
+                state = SessionState.from_dict(data) if data is not None else None
+        self._cache_put(self._state_cache, session_id, stamp, state)
+        return state
+    
+    def _load_all_sync(self, session_id: str) -> Tuple[Optional[SessionMetadata], Optional[SessionState]]:
+        """同步取回元数据和最新状态：先查读缓存，再查索引，否则一次回溯扫描同时取回，结果写回读缓存"""
+        located = self._stat_session(session_id)
+        if located is None:
+            return None, None
+        path, stamp, archived = located
+        session = self._cache_get(self._session_cache, session_id, stamp)
+        state = self._cache_get(self._state_cache, session_id, stamp)
+        if session is not _INDEX_MISS and state is not _INDEX_MISS:
+            return session, state
+        
+        if archived:
+            self._count("scans")
+            found = self._read_latest_records(path, self._decompressor(path))
+        else:
+            found = {
+                "metadata": self._read_indexed(session_id, "metadata"),
+                "state": self._read_indexed(session_id, "state")
+            }
+            if _INDEX_MISS in found.values():
+                self._count("scans")
+                found = self._read_latest_records(path)
+        
+        metadata, state = found.get("metadata"), found.get("state")
+        session = SessionMetadata.from_dict(metadata) if metadata is not None else None
+        state = SessionState.from_dict(state) if state is not None else None
+        self._cache_put(self._session_cache, session_id, stamp, session)
+        self._cache_put(self._state_cache, session_id, stamp, state)
+        return session, state
+    
+    async def load_all(self, session_id: str) -> Tuple[Optional[SessionMetadata], Optional[SessionState]]:
+        """加载元数据和最新状态（单次读取）"""
+        return await asyncio.to_thread(self._load_all_sync, session_id)
+    
+    def _session_lock(self, session_id: str) -> asyncio.Lock:
+        """获取 session 专属的锁"""
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+    
+    async def _run_io(self, func, *args):
+        """在写线程中执行文件操作，与落盘保持先后顺序"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor(), func, *args)
+    
+    async def flush(self) -> None:
+        """等待写队列中的记录全部落盘"""
+        if self._queue is not None:
+            await self._queue.join()
+    
+    async def save_session(self, session: SessionMetadata) -> bool:
+        """保存 session 元数据（与并发的保存合并批量落盘，落盘后返回）"""
+        await (await self.submit(session.session_id, "metadata", session))
+        return True
+    
+    async def save_state(self, session_id: str, state: SessionState) -> bool:
+        """保存 session 状态（与并发的保存合并批量落盘，落盘后返回）"""
+        await (await self.submit(session_id, "state", state))
+        return True
+    
+    async def save_sessions(self, sessions: List[SessionMetadata]) -> bool:
+        """批量保存 session 元数据：全部入队后再一起等待，通常在同一批次里落盘"""
+        written = [await self.submit(session.session_id, "metadata", session) for session in sessions]
+        await asyncio.gather(*written)
+        return True
+    
+    async def load_session(self, session_id: str) -> Optional[SessionMetadata]:
+        """加载 session 元数据"""
+        return await asyncio.to_thread(self._load_session_sync, session_id)
+    
+    async def load_state(self, session_id: str) -> Optional[SessionState]:
+        """加载最新 session 状态"""
+        return await asyncio.to_thread(self._load_state_sync, session_id)
+    
+    @staticmethod
+    def _read_latest_records(
+        path: Path,
+        decompress: Optional[Callable[[bytes], bytes]] = None,
+        kinds: Tuple[str, ...] = ("metadata", "state")
+    ) -> Dict[str, Dict]:
+        """从文件末尾向前一次扫描，返回每种类型最后一条记录的 data
+        
+        记录由单个写协程按序追加，状态的 sequence_number 单调递增，
+        所以最后一条即最新一条，各类型都找到后即可停止。
+        前缀能看出类型的行，不需要的类型直接跳过，不做完整解码。
+        """
+        found = {}
+        for line in _iter_lines_reversed(path, decompress):
+            if not line or line.isspace():
+                continue
+            peeked = _peek_kind(line)
+            if peeked is not None and (peeked not in kinds or peeked in found):
+                continue
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            kind = record.get("type")
+            if kind in kinds and kind not in found:
+                found[kind] = record["data"]
+                if len(found) == len(kinds):
+                    break
+        return found
+    
+    @classmethod
+    def _read_latest_record(cls, path: Path, kind: str, decompress=None) -> Optional[Dict]:
+        """从文件末尾向前找最后一条指定类型的记录，返回其 data"""
+        return cls._read_latest_records(path, decompress, (kind,)).get(kind)
+    
+    @classmethod
+    def _read_latest_metadata(cls, path: Path, decompress=None) -> Optional[SessionMetadata]:
+        """同步读取最后一条元数据记录"""
+        data = cls._read_latest_record(path, "metadata", decompress)
+        return SessionMetadata.from_dict(data) if data is not None else None
+    
+    @classmethod
+    def _read_latest_state(cls, path: Path, decompress=None) -> Optional[SessionState]:
+        """同步读取最后一条状态记录"""
+        data = cls._read_latest_record(path, "state", decompress)
+        return SessionState.from_dict(data) if data is not None else None
+    
+    async def compact(self, session_id: str) -> bool:
+        """压实 session：活动文件只保留最新的元数据/状态记录，并删除历史分段
+        
+        会丢弃历史记录（之后的归档也不再包含），所以不自动触发；日常的文件增长由分段滚动限制。
+        """
+        async with self._session_lock(session_id):
+            await self.flush()
+            return await self._run_io(self._compact_sync, session_id)
+    
+    def _compact_sync(self, session_id: str) -> bool:
+        """写临时文件、fsync 后原子替换活动文件，再删除历史分段（在写线程中执行）"""
+        file_path = self._get_session_file(session_id)
+        if not file_path.exists():
+            return False
+        
+        lines, kinds = [], []
+        for kind in ("metadata", "state"):
+            line = self._read_latest_line(session_id, kind)
+            if line is not None:
+                lines.append(line)
+                kinds.append(kind)
+        
+        self._close_handle(session_id)
+        self._index.pop(session_id, None)
+        self._invalidate_cache(session_id)
+        tmp_path = file_path.with_name(file_path.name + ".tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        
+        for segment_path in self._get_segment_files(session_id):
+            segment_path.unlink(missing_ok=True)
+        self._segment_counts.pop(session_id, None)
+        self._track_size(self._segment_sizes, session_id, None)
+        self._index_batch(session_id, 0, lines, kinds)
+        self._track_size(self._active_sizes, session_id, file_path.stat().st_size)
+        return True
+    
+    async def archive_session(self, session_id: str) -> bool:
+        """归档 session 文件"""
+        async with self._session_lock(session_id):
+            await self.flush()
+            return await self._run_io(self._archive_sync, session_id)
+    
+    def _archive_sync(self, session_id: str) -> bool:
+        """压缩 session 文件并删除原文件（在写线程中执行）"""
+        self._close_handle(session_id)
+        self._index.pop(session_id, None)
+        self._invalidate_cache(session_id)
+        file_path = self._get_session_file(session_id)
+        
+        if not file_path.exists():
+            return False
+        
+        files = [p for p in self._get_segment_files(session_id) if p.exists()] + [file_path]
+        if len(files) == 1 and file_path.stat().st_size < self.compression_min_size:
+            # 太小的文件压缩后反而更大，原子改名即可
+            archive_path = self.storage_dir / f"{session_id}{_PLAIN_ARCHIVE_SUFFIX}"
+            os.replace(file_path, archive_path)
+        else:
+            # 历史分段与活动文件按顺序拼接后一起压缩，归档落盘后才删除源文件
+            archive_path = self._get_archive_file(session_id)
+            self._write_archive(files, archive_path)
+            for path in files:
+                path.unlink()
+        # 先登记归档再移除活动文件，has_session 在任何时刻都能看到该 session
+        self._track_size(self._archive_sizes, session_id, archive_path.stat().st_size)
+        self._segment_counts.pop(session_id, None)
+        self._track_size(self._segment_sizes, session_id, None)
+        self._track_size(self._active_sizes, session_id, None)
+        return True
+    
+    async def delete_session(self, session_id: str) -> bool:
+        """删除 session"""
+        async with self._session_lock(session_id):
+            await self.flush()
+            return await self._run_io(self._delete_sync, session_id)
+    
+    def _delete_sync(self, session_id: str) -> bool:
+        """删除 session 文件及归档（在写线程中执行）"""
+        self._close_handle(session_id)
+        self._index.pop(session_id, None)
+        self._invalidate_cache(session_id)
+        file_path = self._get_session_file(session_id)
+        deleted = False
+        
+        if file_path.exists():
+            file_path.unlink()
+            deleted = True
+        for segment_path in self._get_segment_files(session_id):
+            segment_path.unlink(missing_ok=True)
+        for suffix in _ARCHIVE_READ_SUFFIXES:
+            archive_path = self.storage_dir / f"{session_id}{suffix}"
+            if archive_path.exists():
+                archive_path.unlink()
+                deleted = True
+        
+        self._segment_counts.pop(session_id, None)
+        self._track_size(self._segment_sizes, session_id, None)
+        self._track_size(self._active_sizes, session_id, None)
+        self._track_size(self._archive_sizes, session_id, None)
+        
+        return deleted
+    
+    async def list_sessions(self) -> List[str]:
+        """列出所有 session ID"""
+        return await self._run_io(self._list_sessions_sync)
+    
+    async def has_session(self, session_id: str) -> bool:
+        """判断存储中是否有该 session
+        
+        先查文件大小缓存，命中时不访问文件系统。缓存由启动扫描建立、本实例的写线程增量维护，
+        看不到其他进程或实例之后写入的文件，所以未命中时再 stat 一次活动文件和归档文件，
+        找到则补进缓存。
+        """
+        if (
+            session_id in self._active_sizes
+            or session_id in self._archive_sizes
+            or session_id in self._segment_sizes
+        ):
+            return True
+        return await self._run_io(self._probe_session_sync, session_id)
+    
+    def _probe_session_sync(self, session_id: str) -> bool:
+        """stat 活动文件和归档文件，存在时补进文件大小缓存（在写线程中执行，与缓存的更新串行）"""
+        found = self._stat_session(session_id)
+        if found is None:
+            return False
+        _, (_, size), archived = found
+        self._track_size(self._archive_sizes if archived else self._active_sizes, session_id, size)
+        return True
+    
+    def _list_sessions_sync(self) -> List[str]:
+        """从文件大小缓存读取 session 列表（在写线程中执行，与缓存的更新串行）"""
+        return list(self._active_sizes.keys() | self._archive_sizes.keys() | self._segment_sizes.keys())
+    
+    async def verify_integrity(self, session_id: str) -> Dict[str, Any]:
+        """验证存储文件完整性"""
+        return await asyncio.to_thread(self._verify_sync, session_id)
+    
+    def _verify_sync(self, session_id: str) -> Dict[str, Any]:
+        """同步校验：查找文件与逐个校验都在同一次线程调用里完成，不在事件循环里 stat"""
+        file_path = self._get_session_file(session_id)
+        result = {
+            "session_id": session_id,
+            "exists": False,
+            "valid_records": 0,
+            "invalid_records": 0,
+            "total_records": 0,
+            "errors": []
+        }
+        
+        if not file_path.exists():
+            archive_path = self._find_archive(session_id)
+            if archive_path is not None:
+                result["archived"] = True
+                return self._verify_file(archive_path, result, self._decompressor(archive_path))
+            return result
+        
+        # 依次校验历史分段和活动文件
+        for segment_path in self._get_segment_files(session_id):
+            if segment_path.exists():
+                self._verify_file(segment_path, result)
+        return self._verify_file(file_path, result)
+    
+    @classmethod
+    def _verify_file(cls, path: Path, result: Dict, decompress=None) -> Dict:
+        """同步校验文件：小文件/归档整体读入后一次 split，大文件 mmap 后按偏移切 memoryview"""
+        result["exists"] = True
+        
+        try:
+            with open(path, 'rb') as f:
+                if decompress is None and os.fstat(f.fileno()).st_size >= _MMAP_PARSE_MIN_SIZE:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        view = memoryview(mm)
+                        try:
+                            cls._verify_lines(
+                                [view[start:end] for start, end in _line_spans(mm)], result,
+                                truncated=mm[-1:] != b'\n'
+                            )
+                        finally:
+                            view.release()
+                    return result
+                data = f.read()
+            if decompress is not None:
+                data = decompress(data)
+        except _ARCHIVE_ERRORS as e:
+            result["errors"].append(f"Corrupted archive file: {e}")
+            return result
+        
+        return cls._verify_lines(data.split(b'\n'), result, truncated=data[-1:] not in (b'', b'\n'))
+    
+    @staticmethod
+    def _verify_lines(lines: List, result: Dict, truncated: bool = False) -> Dict:
+        """校验一组行（bytes 或 memoryview），空白行不计入记录数
+        
+        truncated 表示文件末尾没有换行符，最后一行解析失败时按写入中断的半截记录报告。
+        """
+        numbered = [(n, line) for n, line in enumerate(lines, 1) if len(line)]
+        
+        # 快速路径：所有行都能解析时一次列表推导解码完；有坏行再逐行定位错误
+        try:
+            records = [(n, orjson.loads(line)) for n, line in numbered]
+        except orjson.JSONDecodeError:
+            records = []
+            for n, line in numbered:
+                try:
+                    records.append((n, orjson.loads(line)))
+                except orjson.JSONDecodeError as e:
+                    if bytes(line).isspace():
+                        continue
+                    result["total_records"] += 1
+                    result["invalid_records"] += 1
+                    if truncated and n == len(lines):
+                        result["errors"].append(f"Line {n}: Truncated record (no trailing newline) - {e}")
+                    else:
+                        result["errors"].append(f"Line {n}: JSON decode error - {e}")
+        
+        result["total_records"] += len(records)
+        for n, record in records:
+            if isinstance(record, dict) and "type" in record and "data" in record:
+                result["valid_records"] += 1
+            else:
+                result["invalid_records"] += 1
+                result["errors"].append(f"Line {n}: Missing required fields")
+        
+        return result
+    
+    async def get_storage_stats(self) -> Dict[str, Any]:
+        """获取存储统计信息"""
+        return await self._run_io(self._storage_stats_sync)
+    
+    def _storage_stats_sync(self) -> Dict[str, Any]:
+        """从文件大小缓存汇总统计（在写线程中执行）"""
+        stats = {
+            "total_sessions": 0,
+            "active_files": len(self._active_sizes),
+            "archived_files": len(self._archive_sizes),
+            "total_size_bytes": self._total_size,
+            "avg_file_size_bytes": 0
+        }
+        
+        stats["total_sessions"] = stats["active_files"] + stats["archived_files"]
+        
+        if stats["total_sessions"] > 0:
+            stats["avg_file_size_bytes"] = self._total_size // stats["total_sessions"]
+        
+        return stats
+
+
+# ============================================================================
+# Session 管理器
+# ============================================================================
+
+class SessionManager:
+    """Session 管理器"""
+    
+    def __init__(
+        self,
+        storage_dir: str,
+        default_ttl: int = 3600,
+        cleanup_interval: int = 300,
+        activity_flush_interval: float = 30.0
+    ):
+        self.store = JSONLSessionStore(storage_dir)
+        self.default_ttl = default_ttl
+        self.cleanup_interval = cleanup_interval
+        self._active_sessions: Dict[str, SessionMetadata] = {}
+        self._session_states: Dict[str, SessionState] = {}
+        self._lock = asyncio.Lock()
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self._running = False
+        
+        # 活动时间只改内存并标记为脏，每个 session 至多每 activity_flush_interval 秒写一次元数据。
+        # 崩溃最多丢失这段时间内的 last_activity 更新；expires_at 由它推导且受 TTL 约束，可以接受
+        self.activity_flush_interval = activity_flush_interval
+        self._dirty: Set[str] = set()
+        self._last_flush: Dict[str, float] = {}
+        
+        # 正在从存储加载的 session：并发的未命中共用同一次读取
+        self._loading: Dict[str, asyncio.Task] = {}
+        
+        # 过期小顶堆 (expires_at, session_id)，清理时只弹出堆顶已过期的项。
+        # 延期不入堆：弹出时发现已延期就按新的过期时间重新入堆；只有过期时间提前时才立即入堆
+        self._expiry_heap: List[Tuple[float, str]] = []
+        
+        # self._lock 只保护内存字典的多步修改，临界区内没有 I/O 也没有 await；
+        # 字典只在事件循环线程里访问，单步只读（计数、按键读取）不需要加锁。
+        # 分片锁保证同一 session 的记录按生成顺序进入写队列（队列满时 put 的唤醒顺序不保证），
+        # 只在入队期间持有，等待落盘时已释放，不同 session、同一批次的写入仍合并提交
+        self._write_locks = [asyncio.Lock() for _ in range(_LOCK_SHARDS)]
+        
+        # 每个 session 的下一个状态序号；首次保存时从内存中的当前状态起算，状态被替换或移除时丢弃
+        self._sequences: Dict[str, Iterator[int]] = {}
+    
+    async def start(self):
+        """启动管理器"""
+        self._running = True
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+    
+    async def stop(self):
+        """停止管理器"""
+        self._running = False
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            try:
+                await self._cleanup_task
+            except asyncio.CancelledError:
+                pass
+        await self._flush_dirty_sessions()
+        await self.store.flush()
+        self.store.close_all()
+    
+    async def _cleanup_loop(self):
+        """清理过期 session 的循环，同时定期写入积压的活动时间更新"""
+        next_cleanup = time.monotonic() + self.cleanup_interval
+        while self._running:
+            try:
+                await asyncio.sleep(min(self.cleanup_interval, self.activity_flush_interval))
+                await self._flush_dirty_sessions()
+                if time.monotonic() >= next_cleanup:
+                    next_cleanup += self.cleanup_interval
+                    await self.cleanup_expired_sessions()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                continue
+    
+    async def _flush_dirty_sessions(self) -> None:
+        """把积压的活动时间更新写入存储"""
+        now = time.time()
+        async with self._lock:
+            dirty = [self._active_sessions[sid] for sid in self._dirty if sid in self._active_sessions]
+            self._dirty.clear()
+            for session in dirty:
+                self._last_flush[session.session_id] = now
+        
+        await asyncio.gather(*(self._persist_session(session) for session in dirty))
+    
+    def _write_lock(self, session_id: str) -> asyncio.Lock:
+        """session 所在分片的写入锁"""
+        return self._write_locks[hash(session_id) & (_LOCK_SHARDS - 1)]
+    
+    async def _persist_session(self, session: SessionMetadata) -> None:
+        """按顺序提交元数据并等待落盘"""
+        async with self._write_lock(session.session_id):
+            written = await self.store.submit(session.session_id, "metadata", session)
+        await written
+    
+    def _track_expiry(self, session: SessionMetadata, expires_at: float) -> None:
+        """更新过期时间（调用方持有 self._lock）"""
+        if expires_at < session.expires_at:
+            heapq.heappush(self._expiry_heap, (expires_at, session.session_id))
+        session.expires_at = expires_at
+    
+    async def create_session(
+        self,
+        client_id: str,
+        user_agent: str = "",
+        ip_address: str = "",
+        custom_data: Optional[Dict] = None,
+        ttl: Optional[int] = None
+    ) -> SessionMetadata:
+        """创建新 session"""
+        now = time.time()
+        session_id = str(uuid.uuid4())
+        
+        session = SessionMetadata(
+            session_id=session_id,
+            client_id=client_id,
+            created_at=now,
+            last_activity=now,
+            expires_at=now + (ttl or self.default_ttl),
+            user_agent=user_agent,
+            ip_address=ip_address,
+            custom_data=custom_data or {}
+        )
+        
+        # 创建初始状态
+        state = SessionState(
+            session_id=session_id,
+            status="active",
+            data={},
+            sequence_number=1,
+            checkpoint_id=str(uuid.uuid4())
+        )
+        
+        async with self._lock:
+            self._active_sessions[session_id] = session
+            self._session_states[session_id] = state
+            self._last_flush[session_id] = now
+            heapq.heappush(self._expiry_heap, (session.expires_at, session_id))
+        
+        # 元数据和初始状态依次入队、一起等待落盘，只等一个批次
+        async with self._write_lock(session_id):
+            written = (
+                await self.store.submit(session_id, "metadata", session),
+                await self.store.submit(session_id, "state", state),
+            )
+        await asyncio.gather(*written)
+        
+        return session
+    
+    async def get_session(self, session_id: str) -> Optional[SessionMetadata]:
+        """获取 session"""
+        session, _ = await self._get_session_and_state(session_id)
+        return session
+    
+    async def _get_session_and_state(
+        self,
+        session_id: str
+    ) -> Tuple[Optional[SessionMetadata], Optional[SessionState]]:
+        """获取 session 及其状态；内存未命中时单次读取存储同时取回两者"""
+        now = time.time()
+        
+        async with self._lock:
+            if session_id in self._active_sessions:
+                session = self._active_sessions[session_id]
+                # 检查是否过期
+                if session.expires_at > now:
+                    return session, self._session_states.get(session_id)
+                else:
+                    # 过期了，从内存中移除
+                    del self._active_sessions[session_id]
+                    self._session_states.pop(session_id, None)
+                    self._sequences.pop(session_id, None)
+                    return None, None
+        
+        # 存储里没有的 session 直接返回，不做加载
+        if not await self.store.has_session(session_id):
+            return None, None
+        
+        # 从存储加载，加载结果连同状态一起放回内存
+        load = self._loading.get(session_id)
+        if load is None:
+            load = self._loading[session_id] = asyncio.create_task(self.store.load_all(session_id))
+            load.add_done_callback(lambda _: self._loading.pop(session_id, None))
+        session, state = await asyncio.shield(load)
+        if session and session.expires_at > now:
+            async with self._lock:
+                if session_id not in self._active_sessions:
+                    self._active_sessions[session_id] = session
+                    heapq.heappush(self._expiry_heap, (session.expires_at, session_id))
+                session = self._active_sessions[session_id]
+                if state is not None:
+                    state = self._session_states.setdefault(session_id, state)
+            return session, state
+        
+        return None, None
+    
+    async def update_session_activity(self, session_id: str) -> bool:
+        """更新 session 活动时间（距上次写入不足 activity_flush_interval 时只标记为脏）"""
+        now = time.time()
+        async with self._lock:
+            if session_id not in self._active_sessions:
+                return False
+            
+            session = self._active_sessions[session_id]
+            session.last_activity = now
+            self._track_expiry(session, now + self.default_ttl)
+            
+            if now - self._last_flush.get(session_id, 0.0) < self.activity_flush_interval:
+                self._dirty.add(session_id)
+                return True
+            self._dirty.discard(session_id)
+            self._last_flush[session_id] = now
+        
+        await self._persist_session(session)
+        return True
+    
+    async def save_state(
+        self,
+        session_id: str,
+        data: Dict[str, Any],
+        status: str = "active"
+    ) -> Optional[SessionState]:
+        """保存 session 状态（序号分配与入队在同一分片锁内，文件中的序号保持递增）"""
+        async with self._write_lock(session_id):
+            async with self._lock:
+                if session_id not in self._session_states:
+                    return None
+                
+                sequences = self._sequences.get(session_id)
+                if sequences is None:
+                    current_state = self._session_states[session_id]
+                    sequences = self._sequences[session_id] = itertools.count(current_state.sequence_number + 1)
+                new_state = SessionState(
+                    session_id=session_id,
+                    status=status,
+                    data=data,
+                    sequence_number=next(sequences),
+                    checkpoint_id=str(uuid.uuid4())
+                )
+                self._session_states[session_id] = new_state
+            
+            written = await self.store.submit(session_id, "state", new_state)
+        await written
+        return new_state
+    
+    async def get_state(self, session_id: str) -> Optional[SessionState]:
+        """获取 session 状态（内存命中时只读，不加锁）"""
+        state = self._session_states.get(session_id)
+        if state is not None:
+            return state
+        if not await self.store.has_session(session_id):
+            return None
+        
+        state = await self.store.load_state(session_id)
+        if state is not None:
+            # 只缓存活跃 session 的状态，过期/已归档的不占内存
+            async with self._lock:
+                if session_id in self._active_sessions:
+                    state = self._session_states.setdefault(session_id, state)
+        return state
+    
+    async def destroy_session(self, session_id: str) -> bool:
+        """销毁 session"""
+        async with self._lock:
+            self._active_sessions.pop(session_id, None)
+            self._session_states.pop(session_id, None)
+            self._sequences.pop(session_id, None)
+            self._dirty.discard(session_id)
+            self._last_flush.pop(session_id, None)
+        
+        return await self.store.delete_session(session_id)
+    
+    async def cleanup_expired_sessions(self) -> List[str]:
+        """清理过期 session"""
+        now = time.time()
+        expired_sessions = []
+        unsaved = []
+        
+        async with self._lock:
+            heap = self._expiry_heap
+            while heap and heap[0][0] < now:
+                _, session_id = heapq.heappop(heap)
+                session = self._active_sessions.get(session_id)
+                if session is None:
+                    continue  # 已销毁/已清理，或是同一 session 的重复项
+                if session.expires_at >= now:
+                    heapq.heappush(heap, (session.expires_at, session_id))  # 已延期
+                    continue
+                expired_sessions.append(session_id)
+                del self._active_sessions[session_id]
+                self._session_states.pop(session_id, None)
+                self._sequences.pop(session_id, None)
+                self._last_flush.pop(session_id, None)
+                if session_id in self._dirty:
+                    self._dirty.discard(session_id)
+                    unsaved.append(session)
+        
+        # 归档前先写入积压的活动时间
+        await asyncio.gather(*(self._persist_session(session) for session in unsaved))
+        
+        # 归档过期 session
+        for session_id in expired_sessions:
+            await self.store.archive_session(session_id)
+        
+        return expired_sessions
+    
+    async def restore_session(self, session_id: str) -> Optional[SessionMetadata]:
+        """恢复 session（用于客户端重连）"""
+        session, state = await self._get_session_and_state(session_id)
+        if not session:
+            return None
+        
+        # 更新过期时间
+        now = time.time()
+        async with self._lock:
+            session.last_activity = now
+            self._track_expiry(session, now + self.default_ttl)
+            self._dirty.discard(session_id)
+            self._last_flush[session_id] = now
+        
+        await self._persist_session(session)
+        
+        if state:
+            async with self._lock:
+                self._session_states[session_id] = state
+                self._sequences.pop(session_id, None)
+        
+        return session
+    
+    async def get_active_count(self) -> int:
+        """获取活跃 session 数量（只读，不加锁）"""
+        return len(self._active_sessions)
+    
+    def _recover_shard(
+        self,
+        session_ids: List[str],
+        now: float
+    ) -> List[Tuple[SessionMetadata, Optional[SessionState]]]:
+        """同步加载一片 session，只返回未过期的（在恢复线程中执行）"""
+        live = []
+        for session_id in session_ids:
+            session, state = self.store._load_all_sync(session_id)
+            if session and session.expires_at > now:
+                live.append((session, state))
+        return live
+    
+    async def recover_from_storage(self) -> int:
+        """从存储恢复所有 session
+        
+        解压和扫描在线程池里并行执行（zlib/zstd 解压时释放 GIL），线程数即并发上限。
+        session 按线程数分片，每个线程一次处理一片，事件循环只等待分片数个 future。
+        """
+        session_ids = await self.store.list_sessions()
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        
+        workers = max(1, min(os.cpu_count() or 4, len(session_ids)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="session-recover") as loader:
+            shards = await asyncio.gather(*(
+                loop.run_in_executor(loader, self._recover_shard, session_ids[i::workers], now)
+                for i in range(workers)
+            ))
+        
+        live = [pair for shard in shards for pair in shard]
+        async with self._lock:
+            for session, state in live:
+                self._active_sessions[session.session_id] = session
+                if state:
+                    self._session_states[session.session_id] = state
+                    self._sequences.pop(session.session_id, None)
+            self._expiry_heap.extend((session.expires_at, session.session_id) for session, _ in live)
+            heapq.heapify(self._expiry_heap)
+        
+        return len(live)
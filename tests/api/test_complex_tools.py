@@ -23,25 +23,33 @@ Bamboo 复杂工具调用场景测试
 - 工具调用深度限制
 """
 
+import importlib.util
 import json
+import logging
 import os
 import sys
+import threading
 import time
 import asyncio
-import unittest
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Any, Callable, Set
 from dataclasses import dataclass, field
 from datetime import datetime
-from unittest.mock import Mock, patch, MagicMock
 
+import pytest
 import requests
 
+from conftest import new_latency_histogram, record_latency_us
+
 
 # 配置
 DEFAULT_BASE_URL = "http://localhost:8080"
 BASE_URL = os.getenv("BAMBOO_API_URL", DEFAULT_BASE_URL)
 
+# 性能基准日志（由 BAMBOO_BENCH_REPORT 控制是否输出）
+bench_log = logging.getLogger("bamboo.bench")
+
 
 @dataclass
 class ToolResult:
@@ -77,11 +85,24 @@ class AdvancedToolExecutor:
     def __init__(self):
         self.tools: Dict[str, ToolDef] = {}
         self.call_history: List[ToolCall] = []
-        self.call_stack: List[str] = []  # 用于检测循环调用
+        self._local = threading.local()  # 调用栈按线程隔离，并行调用互不干扰
         self.max_depth: int = 10  # 最大嵌套深度
-        self.performance_stats: Dict[str, List[float]] = {}
+        self.performance_stats: Dict[str, Any] = {}  # 每个工具一个 HdrHistogram 延迟直方图（微秒）
+        self._stats_lock = threading.Lock()
         self._setup_tools()
     
+    @property
+    def call_stack(self) -> List[str]:
+        """当前线程的调用栈（用于检测循环调用）"""
+        stack = getattr(self._local, "call_stack", None)
+        if stack is None:
+            stack = self._local.call_stack = []
+        return stack
+    
+    @call_stack.setter
+    def call_stack(self, stack: List[str]):
+        self._local.call_stack = stack
+    
     def _setup_tools(self):
         """设置工具定义"""
         self.tools["calculator"] = ToolDef(
@@ -151,6 +172,8 @@ class AdvancedToolExecutor:
     def execute(self, tool_name: str, args: Dict[str, Any], 
                 track_performance: bool = True) -> ToolResult:
         """执行工具，支持循环检测和深度限制"""
+        call_stack = self.call_stack
+        
         # 检查工具是否存在
         if tool_name not in self.tools:
             return ToolResult(
@@ -161,16 +184,16 @@ class AdvancedToolExecutor:
             )
         
         # 检查循环调用
-        if tool_name in self.call_stack:
+        if tool_name in call_stack:
             return ToolResult(
                 success=False,
                 output="",
-                error=f"Circular tool call detected: {' -> '.join(self.call_stack + [tool_name])}",
+                error=f"Circular tool call detected: {' -> '.join(call_stack + [tool_name])}",
                 duration_ms=0
             )
         
         # 检查深度限制
-        if len(self.call_stack) >= self.max_depth:
+        if len(call_stack) >= self.max_depth:
             return ToolResult(
                 success=False,
                 output="",
@@ -179,47 +202,51 @@ class AdvancedToolExecutor:
             )
         
         # 记录调用栈
-        self.call_stack.append(tool_name)
+        call_stack.append(tool_name)
         
-        start_time = time.time()
-        call_record = ToolCall(
-            tool_name=tool_name,
-            args=args,
-            timestamp=start_time
-        )
+        # 调用记录在拿到结果后再构建，避免每次调用多一次中间分配；
+        # 耗时按单调时钟计算，不受墙钟调整影响，timestamp 仍记录墙钟时间
+        timestamp = time.time()
+        start_ns = time.perf_counter_ns()
         
         try:
             # 执行工具
             result = self._execute_tool(tool_name, args)
             
-            duration_ms = int((time.time() - start_time) * 1000)
-            result.duration_ms = duration_ms
+            duration_us = (time.perf_counter_ns() - start_ns) // 1000
+            result.duration_ms = duration_us // 1000
             
             # 记录性能统计
             if track_performance:
-                if tool_name not in self.performance_stats:
-                    self.performance_stats[tool_name] = []
-                self.performance_stats[tool_name].append(duration_ms)
-            
-            call_record.result = result
-            self.call_history.append(call_record)
-            
-            return result
+                with self._stats_lock:
+                    histogram = self.performance_stats.get(tool_name)
+                    if histogram is None:
+                        histogram = self.performance_stats[tool_name] = new_latency_histogram()
+                    record_latency_us(histogram, duration_us)
             
         except Exception as e:
-            duration_ms = int((time.time() - start_time) * 1000)
+            duration_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
             result = ToolResult(
                 success=False,
                 output="",
                 error=str(e),
                 duration_ms=duration_ms
             )
-            call_record.result = result
-            self.call_history.append(call_record)
-            return result
         finally:
             # 弹出调用栈
-            self.call_stack.pop()
+            call_stack.pop()
+        
+        self.call_history.append(ToolCall(tool_name, args, timestamp, result))
+        return result
+    
+    def fast_execute(self, tool_name: str, args: Dict[str, Any]) -> ToolResult:
+        """快速执行路径：跳过调用栈、计时和调用历史，仅用于无嵌套且无需追踪的调用"""
+        if tool_name not in self.tools:
+            return ToolResult(success=False, output="", error=f"Tool not found: {tool_name}")
+        try:
+            return self._execute_tool(tool_name, args)
+        except Exception as e:
+            return ToolResult(success=False, output="", error=str(e))
     
     def _execute_tool(self, tool_name: str, args: Dict[str, Any]) -> ToolResult:
         """实际执行工具逻辑"""
@@ -296,8 +323,9 @@ class AdvancedToolExecutor:
             return ToolResult(success=True, output=text.strip().capitalize())
         elif operation == "extract_keywords":
             # 简单关键词提取
-            words = text.lower().split()
-            keywords = list(set([w for w in words if len(w) > 4]))[:10]
+            # 按词频排序取前 10，次序稳定（同频按首次出现）
+            counts = Counter(w for w in text.lower().split() if len(w) > 4)
+            keywords = [w for w, _ in counts.most_common(10)]
             return ToolResult(success=True, output=json.dumps(keywords))
         else:
             return ToolResult(success=False, error=f"Unknown operation: {operation}")
@@ -305,13 +333,13 @@ class AdvancedToolExecutor:
     def _mock_get_time(self, args: Dict[str, Any]) -> ToolResult:
         """Mock 时间获取"""
         format_type = args.get("format", "iso")
-        now = datetime.now()
         
-        if format_type == "iso":
-            output = now.isoformat()
-        elif format_type == "timestamp":
-            output = str(int(now.timestamp()))
-        elif format_type == "human":
+        # 时间戳无需构造 datetime
+        if format_type == "timestamp":
+            return ToolResult(success=True, output=str(time.time_ns() // 1_000_000_000))
+        
+        now = datetime.now()
+        if format_type == "human":
             output = now.strftime("%Y-%m-%d %H:%M:%S")
         else:
             output = now.isoformat()
@@ -395,17 +423,12 @@ class AdvancedToolExecutor:
             metadata={"fixes_applied": errors}
         )
     
-    def execute_parallel(self, tasks: List[tuple], max_workers: int = 4) -> List[ToolResult]:
-        """并行执行多个工具调用"""
-        results = []
+    def execute_parallel(self, tasks: List[tuple], max_workers: int = 4,
+                         track: bool = True) -> List[ToolResult]:
+        """并行执行多个工具调用，结果顺序与 tasks 一致（track=False 时走快速路径，不记录历史和统计）"""
+        execute = self.execute if track else self.fast_execute
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = [
-                executor.submit(self.execute, tool_name, args)
-                for tool_name, args in tasks
-            ]
-            for future in as_completed(futures):
-                results.append(future.result())
-        return results
+            return list(executor.map(lambda task: execute(task[0], task[1]), tasks))
     
     def execute_conditional(self, condition_tool: str, condition_args: Dict[str, Any],
                            true_branch: Callable, false_branch: Optional[Callable] = None) -> Any:
@@ -422,14 +445,17 @@ class AdvancedToolExecutor:
     def get_performance_report(self) -> Dict[str, Any]:
         """获取性能报告"""
         report = {}
-        for tool_name, durations in self.performance_stats.items():
-            if durations:
+        for tool_name, histogram in self.performance_stats.items():
+            count = histogram.get_total_count()
+            if count:
+                mean_us = histogram.get_mean_value()
                 report[tool_name] = {
-                    "count": len(durations),
-                    "avg_ms": round(sum(durations) / len(durations), 2),
-                    "min_ms": min(durations),
-                    "max_ms": max(durations),
-                    "total_ms": sum(durations)
+                    "count": count,
+                    "avg_ms": round(mean_us / 1000, 2),
+                    "min_ms": histogram.get_min_value() / 1000,
+                    "max_ms": histogram.get_max_value() / 1000,
+                    "p99_ms": histogram.get_value_at_percentile(99) / 1000,
+                    "total_ms": round(mean_us * count / 1000, 2)
                 }
         return report
     
@@ -440,68 +466,68 @@ class AdvancedToolExecutor:
         self.performance_stats.clear()
 
 
-class TestConditionalToolCalls(unittest.TestCase):
+@pytest.fixture
+def executor() -> AdvancedToolExecutor:
+    """每个测试使用独立的执行器"""
+    return AdvancedToolExecutor()
+
+
+class TestConditionalToolCalls:
     """测试条件工具调用"""
     
-    def setUp(self):
-        self.executor = AdvancedToolExecutor()
-    
-    def test_conditional_based_on_file_size(self):
+    def test_conditional_based_on_file_size(self, executor: AdvancedToolExecutor):
         """测试基于文件大小的条件调用"""
         # 读取文件
-        file_result = self.executor.execute("read_file", {"path": "/tmp/test.txt"})
-        self.assertTrue(file_result.success)
+        file_result = executor.execute("read_file", {"path": "/tmp/test.txt"})
+        assert file_result.success
         
         # 统计文件内容
-        count_result = self.executor.execute("text_processor", {
+        count_result = executor.execute("text_processor", {
             "text": file_result.output,
             "operation": "count"
         })
-        self.assertTrue(count_result.success)
+        assert count_result.success
         stats = json.loads(count_result.output)
         
         # 根据行数决定后续操作
         if stats["lines"] > 2:
             # 长文件：提取关键词
-            result = self.executor.execute("text_processor", {
+            result = executor.execute("text_processor", {
                 "text": file_result.output,
                 "operation": "extract_keywords"
             })
-            self.assertTrue(result.success)
+            assert result.success
         else:
             # 短文件：直接格式化
-            result = self.executor.execute("text_processor", {
+            result = executor.execute("text_processor", {
                 "text": file_result.output,
                 "operation": "upper"
             })
-            self.assertTrue(result.success)
+            assert result.success
     
-    def test_conditional_error_handling(self):
+    def test_conditional_error_handling(self, executor: AdvancedToolExecutor):
         """测试条件错误处理流程"""
         # 尝试验证有问题的代码
         code = "def test():\n    print('hello')\n    try:\n        pass\n    except:\n        pass"
         
-        validation = self.executor.execute("code_validator", {"code": code})
+        validation = executor.execute("code_validator", {"code": code})
         
         if not validation.success:
             # 验证失败，尝试修复
-            fix_result = self.executor.execute("code_fixer", {
+            fix_result = executor.execute("code_fixer", {
                 "code": code,
                 "errors": validation.error
             })
-            self.assertTrue(fix_result.success)
-            self.assertIn("logger.info", fix_result.output)
+            assert fix_result.success
+            assert "logger.info" in fix_result.output
         else:
-            self.fail("Expected validation to fail")
+            pytest.fail("Expected validation to fail")
 
 
-class TestParallelToolCalls(unittest.TestCase):
+class TestParallelToolCalls:
     """测试并行工具调用"""
     
-    def setUp(self):
-        self.executor = AdvancedToolExecutor()
-    
-    def test_parallel_independent_calls(self):
+    def test_parallel_independent_calls(self, executor: AdvancedToolExecutor):
         """测试并行独立工具调用"""
         tasks = [
             ("calculator", {"expression": "1 + 2"}),
@@ -512,21 +538,21 @@ class TestParallelToolCalls(unittest.TestCase):
         ]
         
         start_time = time.time()
-        results = self.executor.execute_parallel(tasks, max_workers=3)
+        results = executor.execute_parallel(tasks, max_workers=3)
         elapsed_ms = (time.time() - start_time) * 1000
         
         # 验证所有调用成功
         for result in results:
-            self.assertTrue(result.success)
+            assert result.success
         
         # 验证并行性能（5个调用应该比串行快）
-        self.assertLess(elapsed_ms, 500)  # 假设串行需要 >500ms
+        assert elapsed_ms < 500  # 假设串行需要 >500ms
         
         # 验证调用历史
-        history = self.executor.call_history
-        self.assertEqual(len(history), 5)
+        history = executor.call_history
+        assert len(history) == 5
     
-    def test_parallel_with_large_data(self):
+    def test_parallel_with_large_data(self, executor: AdvancedToolExecutor):
         """测试并行处理大数据"""
         tasks = [
             ("read_file", {"path": "/tmp/large_file.txt", "limit": 100}),
@@ -534,55 +560,52 @@ class TestParallelToolCalls(unittest.TestCase):
             ("read_file", {"path": "/tmp/logs.txt", "limit": 10}),
         ]
         
-        results = self.executor.execute_parallel(tasks, max_workers=3)
+        results = executor.execute_parallel(tasks, max_workers=3)
         
         for result in results:
-            self.assertTrue(result.success)
-            self.assertGreater(len(result.output), 0)
+            assert result.success
+            assert len(result.output) > 0
 
 
-class TestNestedToolCalls(unittest.TestCase):
+class TestNestedToolCalls:
     """测试嵌套工具调用"""
     
-    def setUp(self):
-        self.executor = AdvancedToolExecutor()
-    
-    def test_nested_analysis_workflow(self):
+    def test_nested_analysis_workflow(self, executor: AdvancedToolExecutor):
         """测试嵌套分析工作流"""
         # 读取日志文件
-        file_result = self.executor.execute("read_file", {"path": "/tmp/logs.txt"})
-        self.assertTrue(file_result.success)
+        file_result = executor.execute("read_file", {"path": "/tmp/logs.txt"})
+        assert file_result.success
         
         # 第一层嵌套：过滤错误日志
-        filter_result = self.executor.execute("data_filter", {
+        filter_result = executor.execute("data_filter", {
             "data": file_result.output,
             "condition": "error"
         })
-        self.assertTrue(filter_result.success)
+        assert filter_result.success
         
         # 第二层嵌套：聚合过滤结果
-        aggregate_result = self.executor.execute("data_aggregate", {
+        aggregate_result = executor.execute("data_aggregate", {
             "data": filter_result.output,
             "operation": "stats"
         })
-        self.assertTrue(aggregate_result.success)
+        assert aggregate_result.success
         
         # 第三层嵌套：格式化报告
         report = f"Error analysis at {datetime.now().isoformat()}: {aggregate_result.output}"
-        format_result = self.executor.execute("text_processor", {
+        format_result = executor.execute("text_processor", {
             "text": report,
             "operation": "format"
         })
-        self.assertTrue(format_result.success)
+        assert format_result.success
     
-    def test_deep_nesting_limit(self):
+    def test_deep_nesting_limit(self, executor: AdvancedToolExecutor):
         """测试深度限制"""
         # 模拟深度嵌套调用
         def recursive_call(depth: int) -> ToolResult:
             if depth <= 0:
-                return self.executor.execute("calculator", {"expression": "1 + 1"})
+                return executor.execute("calculator", {"expression": "1 + 1"})
             
-            result = self.executor.execute("text_processor", {
+            result = executor.execute("text_processor", {
                 "text": f"Level {depth}",
                 "operation": "upper"
             })
@@ -593,27 +616,24 @@ class TestNestedToolCalls(unittest.TestCase):
         
         # 正常深度应该成功
         result = recursive_call(3)
-        self.assertTrue(result.success)
+        assert result.success
 
 
-class TestDynamicParameterGeneration(unittest.TestCase):
+class TestDynamicParameterGeneration:
     """测试工具参数动态生成"""
     
-    def setUp(self):
-        self.executor = AdvancedToolExecutor()
-    
-    def test_extract_and_use_parameters(self):
+    def test_extract_and_use_parameters(self, executor: AdvancedToolExecutor):
         """测试从前文提取并使用参数"""
         # 读取文件
-        file_result = self.executor.execute("read_file", {"path": "/tmp/data.json"})
-        self.assertTrue(file_result.success)
+        file_result = executor.execute("read_file", {"path": "/tmp/data.json"})
+        assert file_result.success
         
         # 分析内容特征
-        count_result = self.executor.execute("text_processor", {
+        count_result = executor.execute("text_processor", {
             "text": file_result.output,
             "operation": "count"
         })
-        self.assertTrue(count_result.success)
+        assert count_result.success
         stats = json.loads(count_result.output)
         
         # 根据分析结果动态生成参数
@@ -623,17 +643,17 @@ class TestDynamicParameterGeneration(unittest.TestCase):
             limit = stats["lines"]
         
         # 使用动态参数重新读取
-        re_read = self.executor.execute("read_file", {
+        re_read = executor.execute("read_file", {
             "path": "/tmp/data.json",
             "limit": limit
         })
-        self.assertTrue(re_read.success)
+        assert re_read.success
     
-    def test_chain_parameter_building(self):
+    def test_chain_parameter_building(self, executor: AdvancedToolExecutor):
         """测试链式参数构建"""
         # 获取当前时间
-        time_result = self.executor.execute("get_time", {"format": "human"})
-        self.assertTrue(time_result.success)
+        time_result = executor.execute("get_time", {"format": "human"})
+        assert time_result.success
         
         # 基于时间构建查询参数
         timestamp = time_result.output
@@ -642,123 +662,117 @@ class TestDynamicParameterGeneration(unittest.TestCase):
         report_text = f"Report generated at {timestamp}"
         
         # 处理报告
-        process_result = self.executor.execute("text_processor", {
+        process_result = executor.execute("text_processor", {
             "text": report_text,
             "operation": "count"
         })
-        self.assertTrue(process_result.success)
+        assert process_result.success
 
 
-class TestLargeTextProcessing(unittest.TestCase):
+class TestLargeTextProcessing:
     """测试长文本处理"""
     
-    def setUp(self):
-        self.executor = AdvancedToolExecutor()
-    
-    def test_large_file_read(self):
+    def test_large_file_read(self, executor: AdvancedToolExecutor):
         """测试大文件读取"""
-        result = self.executor.execute("read_file", {
+        result = executor.execute("read_file", {
             "path": "/tmp/large_file.txt",
             "limit": 1000
         })
-        self.assertTrue(result.success)
-        self.assertGreater(len(result.output), 5000)
+        assert result.success
+        assert len(result.output) > 5000
     
-    def test_large_text_processing(self):
+    def test_large_text_processing(self, executor: AdvancedToolExecutor):
         """测试大文本处理"""
         # 生成大文本
         large_text = "Sample text line\n" * 500
         
-        result = self.executor.execute("text_processor", {
+        result = executor.execute("text_processor", {
             "text": large_text,
             "operation": "count"
         })
-        self.assertTrue(result.success)
+        assert result.success
         
         stats = json.loads(result.output)
         # 注意：split("\n") 在末尾有换行符时会产生额外的一个空字符串
-        self.assertGreaterEqual(stats["lines"], 500)
+        assert stats["lines"] >= 500
 
 
-class TestRealWorldScenarios(unittest.TestCase):
+class TestRealWorldScenarios:
     """测试真实场景模拟"""
     
-    def setUp(self):
-        self.executor = AdvancedToolExecutor()
-    
-    def test_file_analysis_workflow(self):
+    def test_file_analysis_workflow(self, executor: AdvancedToolExecutor):
         """测试文件分析流程：读取 → 分析 → 总结 → 输出"""
         # 1. 读取文件
-        file_result = self.executor.execute("read_file", {"path": "/tmp/logs.txt"})
-        self.assertTrue(file_result.success)
+        file_result = executor.execute("read_file", {"path": "/tmp/logs.txt"})
+        assert file_result.success
         
         # 2. 分析内容
-        count_result = self.executor.execute("text_processor", {
+        count_result = executor.execute("text_processor", {
             "text": file_result.output,
             "operation": "count"
         })
-        self.assertTrue(count_result.success)
+        assert count_result.success
         
         # 3. 过滤关键信息
-        filter_result = self.executor.execute("data_filter", {
+        filter_result = executor.execute("data_filter", {
             "data": file_result.output,
             "condition": "warn"
         })
-        self.assertTrue(filter_result.success)
+        assert filter_result.success
         
         # 4. 聚合统计
-        aggregate_result = self.executor.execute("data_aggregate", {
+        aggregate_result = executor.execute("data_aggregate", {
             "data": filter_result.output,
             "operation": "stats"
         })
-        self.assertTrue(aggregate_result.success)
+        assert aggregate_result.success
         
         # 5. 生成总结报告
-        time_result = self.executor.execute("get_time", {"format": "human"})
+        time_result = executor.execute("get_time", {"format": "human"})
         report = (
             f"Log Analysis Report ({time_result.output})\n"
             f"Total lines: {json.loads(count_result.output)['lines']}\n"
             f"Warning/Error stats: {aggregate_result.output}"
         )
         
-        format_result = self.executor.execute("text_processor", {
+        format_result = executor.execute("text_processor", {
             "text": report,
             "operation": "format"
         })
-        self.assertTrue(format_result.success)
+        assert format_result.success
     
-    def test_data_processing_workflow(self):
+    def test_data_processing_workflow(self, executor: AdvancedToolExecutor):
         """测试数据处理流程：查询 → 过滤 → 聚合 → 报告"""
         # 1. 查询（读取数据）
-        data_result = self.executor.execute("read_file", {"path": "/tmp/logs.txt"})
-        self.assertTrue(data_result.success)
+        data_result = executor.execute("read_file", {"path": "/tmp/logs.txt"})
+        assert data_result.success
         
         # 2. 过滤错误数据
-        error_result = self.executor.execute("data_filter", {
+        error_result = executor.execute("data_filter", {
             "data": data_result.output,
             "condition": "error"
         })
-        self.assertTrue(error_result.success)
+        assert error_result.success
         
         # 3. 聚合统计
-        stats_result = self.executor.execute("data_aggregate", {
+        stats_result = executor.execute("data_aggregate", {
             "data": error_result.output,
             "operation": "stats"
         })
-        self.assertTrue(stats_result.success)
+        assert stats_result.success
         
         # 4. 生成报告
-        time_result = self.executor.execute("get_time", {"format": "iso"})
+        time_result = executor.execute("get_time", {"format": "iso"})
         report = f"Error Report [{time_result.output}]: {stats_result.output}"
         
-        final_result = self.executor.execute("text_processor", {
+        final_result = executor.execute("text_processor", {
             "text": report,
             "operation": "upper"
         })
-        self.assertTrue(final_result.success)
-        self.assertIn("ERROR REPORT", final_result.output)
+        assert final_result.success
+        assert "ERROR REPORT" in final_result.output
     
-    def test_code_generation_workflow(self):
+    def test_code_generation_workflow(self, executor: AdvancedToolExecutor):
         """测试代码生成流程：需求分析 → 代码生成 → 验证 → 修复"""
         # 1. 需求分析（模拟）
         requirement = "Create a function that prints hello world"
@@ -773,46 +787,44 @@ class TestRealWorldScenarios(unittest.TestCase):
 """
         
         # 3. 代码验证
-        validation = self.executor.execute("code_validator", {"code": generated_code})
+        validation = executor.execute("code_validator", {"code": generated_code})
         
         if not validation.success:
             # 4. 代码修复
-            fixed = self.executor.execute("code_fixer", {
+            fixed = executor.execute("code_fixer", {
                 "code": generated_code,
                 "errors": validation.error
             })
-            self.assertTrue(fixed.success)
-            self.assertIn("logger.info", fixed.output)
+            assert fixed.success
+            assert "logger.info" in fixed.output
         else:
             # 验证通过
-            self.assertTrue(validation.success)
+            assert validation.success
 
 
-class TestPerformanceBenchmarks(unittest.TestCase):
+@pytest.mark.xdist_group("performance")
+class TestPerformanceBenchmarks:
     """测试性能基准"""
     
-    def setUp(self):
-        self.executor = AdvancedToolExecutor()
-    
-    def test_tool_call_latency(self):
+    def test_tool_call_latency(self, executor: AdvancedToolExecutor):
         """测试工具调用延迟"""
         latencies = []
         
         for _ in range(10):
             start = time.time()
-            result = self.executor.execute("calculator", {"expression": "1 + 1"})
+            result = executor.execute("calculator", {"expression": "1 + 1"})
             elapsed = (time.time() - start) * 1000
             latencies.append(elapsed)
-            self.assertTrue(result.success)
+            assert result.success
         
         avg_latency = sum(latencies) / len(latencies)
         max_latency = max(latencies)
         
         # 验证性能在合理范围内
-        self.assertLess(avg_latency, 100)  # 平均 < 100ms
-        self.assertLess(max_latency, 200)  # 最大 < 200ms
+        assert avg_latency < 100  # 平均 < 100ms
+        assert max_latency < 200  # 最大 < 200ms
     
-    def test_concurrent_performance(self):
+    def test_concurrent_performance(self, executor: AdvancedToolExecutor):
         """测试并发性能"""
         tasks = [
             ("calculator", {"expression": f"{i} * {i}"})
@@ -820,143 +832,149 @@ class TestPerformanceBenchmarks(unittest.TestCase):
         ]
         
         start = time.time()
-        results = self.executor.execute_parallel(tasks, max_workers=5)
+        results = executor.execute_parallel(tasks, max_workers=5)
         elapsed = (time.time() - start) * 1000
         
         # 验证所有调用成功
         for result in results:
-            self.assertTrue(result.success)
+            assert result.success
         
         # 验证并发性能
-        self.assertLess(elapsed, 1000)  # 20个调用 < 1秒
+        assert elapsed < 1000  # 20个调用 < 1秒
     
-    def test_performance_report(self):
+    def test_concurrent_fast_path(self, executor: AdvancedToolExecutor):
+        """测试 track=False 的并发快速路径：结果正确，不记录历史和统计"""
+        tasks = [
+            ("calculator", {"expression": f"{i} * {i}"})
+            for i in range(20)
+        ]
+        
+        results = executor.execute_parallel(tasks, max_workers=5, track=False)
+        
+        assert sorted(r.output for r in results) == sorted(str(i * i) for i in range(20))
+        assert executor.call_history == []
+        assert executor.performance_stats == {}
+    
+    def test_performance_report(self, executor: AdvancedToolExecutor):
         """测试性能报告生成"""
         # 执行一些工具调用
         for i in range(5):
-            self.executor.execute("calculator", {"expression": f"{i} + 1"})
-            self.executor.execute("text_processor", {
+            executor.execute("calculator", {"expression": f"{i} + 1"})
+            executor.execute("text_processor", {
                 "text": f"test {i}",
                 "operation": "count"
             })
         
-        report = self.executor.get_performance_report()
+        report = executor.get_performance_report()
         
-        self.assertIn("calculator", report)
-        self.assertIn("text_processor", report)
+        assert "calculator" in report
+        assert "text_processor" in report
         
         calc_stats = report["calculator"]
-        self.assertEqual(calc_stats["count"], 5)
-        self.assertIn("avg_ms", calc_stats)
-        self.assertIn("min_ms", calc_stats)
-        self.assertIn("max_ms", calc_stats)
+        assert calc_stats["count"] == 5
+        assert "avg_ms" in calc_stats
+        assert "min_ms" in calc_stats
+        assert "max_ms" in calc_stats
 
 
-class TestBoundaryConditions(unittest.TestCase):
+class TestBoundaryConditions:
     """测试边界条件"""
     
-    def setUp(self):
-        self.executor = AdvancedToolExecutor()
-    
-    def test_circular_call_detection(self):
+    def test_circular_call_detection(self, executor: AdvancedToolExecutor):
         """测试循环调用检测"""
         # 模拟循环调用场景
         # 由于实际循环需要工具间相互调用，这里测试调用栈检测机制
         
         # 正常调用不应触发循环检测
-        result1 = self.executor.execute("calculator", {"expression": "1 + 1"})
-        self.assertTrue(result1.success)
+        result1 = executor.execute("calculator", {"expression": "1 + 1"})
+        assert result1.success
         
-        result2 = self.executor.execute("calculator", {"expression": "2 + 2"})
-        self.assertTrue(result2.success)
+        result2 = executor.execute("calculator", {"expression": "2 + 2"})
+        assert result2.success
         
         # 调用栈应该为空（已清理）
-        self.assertEqual(len(self.executor.call_stack), 0)
+        assert len(executor.call_stack) == 0
     
-    def test_max_depth_limit(self):
+    def test_max_depth_limit(self, executor: AdvancedToolExecutor):
         """测试最大深度限制"""
         # 设置较小的深度限制用于测试
-        original_max = self.executor.max_depth
-        self.executor.max_depth = 3
-        self.executor.call_stack.clear()  # 确保调用栈为空
+        original_max = executor.max_depth
+        executor.max_depth = 3
+        executor.call_stack.clear()  # 确保调用栈为空
         
         # 直接测试深度限制 - 模拟深度嵌套
         # 手动填充调用栈到接近限制
-        self.executor.call_stack = ["tool1", "tool2", "tool3"]
+        executor.call_stack = ["tool1", "tool2", "tool3"]
         
         # 再调用一个工具应该触发深度限制
-        result = self.executor.execute("calculator", {"expression": "1"})
-        self.assertFalse(result.success)
-        self.assertIn("depth", result.error.lower())
+        result = executor.execute("calculator", {"expression": "1"})
+        assert not result.success
+        assert "depth" in result.error.lower()
         
         # 恢复原始设置
-        self.executor.max_depth = original_max
-        self.executor.call_stack.clear()
+        executor.max_depth = original_max
+        executor.call_stack.clear()
     
-    def test_empty_input_handling(self):
+    def test_empty_input_handling(self, executor: AdvancedToolExecutor):
         """测试空输入处理"""
-        result = self.executor.execute("calculator", {"expression": ""})
-        self.assertFalse(result.success)
+        result = executor.execute("calculator", {"expression": ""})
+        assert not result.success
         # 验证错误信息不为空
-        self.assertIsNotNone(result.error)
-        self.assertGreater(len(result.error), 0)
+        assert result.error is not None
+        assert len(result.error) > 0
     
-    def test_invalid_tool_name(self):
+    def test_invalid_tool_name(self, executor: AdvancedToolExecutor):
         """测试无效工具名"""
-        result = self.executor.execute("nonexistent_tool", {})
-        self.assertFalse(result.success)
-        self.assertIn("not found", result.error.lower())
-
-
-def run_complex_tests():
-    """运行所有复杂工具调用测试"""
-    print("=" * 70)
-    print("Bamboo 复杂工具调用场景测试")
-    print("=" * 70)
-    
-    loader = unittest.TestLoader()
-    suite = unittest.TestSuite()
-    
-    # 添加所有测试类
-    suite.addTests(loader.loadTestsFromTestCase(TestConditionalToolCalls))
-    suite.addTests(loader.loadTestsFromTestCase(TestParallelToolCalls))
-    suite.addTests(loader.loadTestsFromTestCase(TestNestedToolCalls))
-    suite.addTests(loader.loadTestsFromTestCase(TestDynamicParameterGeneration))
-    suite.addTests(loader.loadTestsFromTestCase(TestLargeTextProcessing))
-    suite.addTests(loader.loadTestsFromTestCase(TestRealWorldScenarios))
-    suite.addTests(loader.loadTestsFromTestCase(TestPerformanceBenchmarks))
-    suite.addTests(loader.loadTestsFromTestCase(TestBoundaryConditions))
-    
-    runner = unittest.TextTestRunner(verbosity=2)
-    result = runner.run(suite)
-    
-    # 打印性能报告
+        result = executor.execute("nonexistent_tool", {})
+        assert not result.success
+        assert "not found" in result.error.lower()
+    
+    def test_latency_overflow_clamped(self):
+        """测试超出直方图范围的延迟按上限计数，不被丢弃"""
+        histogram = new_latency_histogram()
+        record_latency_us(histogram, 70_000_000)
+        record_latency_us(histogram, 1_000)
+        assert histogram.get_total_count() == 2
+        assert histogram.get_max_value() >= 59_000_000
+
+
+# 测试类别 → 测试类
+CATEGORY_MAP = {
+    "conditional": TestConditionalToolCalls,
+    "parallel": TestParallelToolCalls,
+    "nested": TestNestedToolCalls,
+    "dynamic": TestDynamicParameterGeneration,
+    "large": TestLargeTextProcessing,
+    "realworld": TestRealWorldScenarios,
+    "performance": TestPerformanceBenchmarks,
+    "boundary": TestBoundaryConditions,
+}
+
+
+# 预热负载（模块级预构建，避免循环内重复构造）
+_CALC_PAYLOADS = [{"expression": f"{i} * 2"} for i in range(10)]
+_TEXT_PAYLOADS = [{"text": f"test {i}", "operation": "count"} for i in range(10)]
+
+
+def log_performance_report() -> Dict[str, Dict[str, Any]]:
+    """收集工具调用性能基准，逐工具输出到 bamboo.bench 日志并返回报告"""
     executor = AdvancedToolExecutor()
-    print("\n" + "=" * 70)
-    print("性能基准报告")
-    print("=" * 70)
     
-    # 运行一些测试来收集性能数据
-    for i in range(10):
-        executor.execute("calculator", {"expression": f"{i} * 2"})
-        executor.execute("text_processor", {"text": f"test {i}", "operation": "count"})
+    # 并行运行一些工具调用来收集性能数据
+    tasks = (
+        [("calculator", p) for p in _CALC_PAYLOADS]
+        + [("text_processor", p) for p in _TEXT_PAYLOADS]
+    )
+    executor.execute_parallel(tasks, max_workers=os.cpu_count() or 4)
     
     report = executor.get_performance_report()
     for tool_name, stats in report.items():
-        print(f"\n{tool_name}:")
-        print(f"  调用次数: {stats['count']}")
-        print(f"  平均延迟: {stats['avg_ms']}ms")
-        print(f"  最小延迟: {stats['min_ms']}ms")
-        print(f"  最大延迟: {stats['max_ms']}ms")
-        print(f"  总耗时: {stats['total_ms']}ms")
-    
-    print("\n" + "=" * 70)
-    if result.wasSuccessful():
-        print("✅ 所有复杂工具调用测试通过!")
-        return 0
-    else:
-        print("❌ 部分测试失败")
-        return 1
+        bench_log.info(
+            "%s count=%d avg=%.3fms min=%.3fms max=%.3fms p99=%.3fms total=%.3fms",
+            tool_name, stats['count'], stats['avg_ms'], stats['min_ms'],
+            stats['max_ms'], stats.get('p99_ms', 0), stats['total_ms'],
+        )
+    return report
 
 
 def main():
@@ -964,37 +982,41 @@ def main():
     import argparse
     
     parser = argparse.ArgumentParser(description="Bamboo 复杂工具调用场景测试")
-    parser.add_argument("--category", choices=[
-        "conditional", "parallel", "nested", "dynamic", 
-        "large", "realworld", "performance", "boundary", "all"
-    ], default="all", help="测试类别")
+    parser.add_argument("--category", choices=[*CATEGORY_MAP, "all"],
+                        default="all", help="测试类别")
     parser.add_argument("--verbose", "-v", action="store_true", help="详细输出")
     
     args = parser.parse_args()
     
-    if args.category == "all":
-        return run_complex_tests()
-    else:
+    if args.category != "all":
         # 运行特定类别测试
-        category_map = {
-            "conditional": TestConditionalToolCalls,
-            "parallel": TestParallelToolCalls,
-            "nested": TestNestedToolCalls,
-            "dynamic": TestDynamicParameterGeneration,
-            "large": TestLargeTextProcessing,
-            "realworld": TestRealWorldScenarios,
-            "performance": TestPerformanceBenchmarks,
-            "boundary": TestBoundaryConditions,
-        }
-        
-        loader = unittest.TestLoader()
-        suite = loader.loadTestsFromTestCase(category_map[args.category])
-        
-        verbosity = 2 if args.verbose else 1
-        runner = unittest.TextTestRunner(verbosity=verbosity)
-        result = runner.run(suite)
-        
-        return 0 if result.wasSuccessful() else 1
+        target = f"{__file__}::{CATEGORY_MAP[args.category].__name__}"
+        return pytest.main([target, "-v" if args.verbose else "-q"])
+    
+    print("=" * 70)
+    print("Bamboo 复杂工具调用场景测试")
+    print("=" * 70)
+    
+    # 装了 pytest-xdist 时按 CPU 核数分片并行运行（保留 2 个核），性能基准类固定在同一 worker 上；
+    # 没装时串行运行
+    pytest_args = [__file__, "-v"]
+    if importlib.util.find_spec("xdist") is not None:
+        workers = max(1, (os.cpu_count() or 1) - 2)
+        pytest_args += ["-n", str(workers), "--dist=loadgroup"]
+    exit_code = pytest.main(pytest_args)
+    
+    # 性能基准报告默认关闭（CI 下不输出），设置 BAMBOO_BENCH_REPORT 启用
+    if os.getenv("BAMBOO_BENCH_REPORT"):
+        logging.basicConfig(level=logging.INFO, format="%(name)s %(message)s")
+        log_performance_report()
+    
+    print("\n" + "=" * 70)
+    if exit_code == 0:
+        print("✅ 所有复杂工具调用测试通过!")
+        return 0
+    else:
+        print("❌ 部分测试失败")
+        return 1
 
 
 if __name__ == "__main__":
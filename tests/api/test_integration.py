@@ -5,16 +5,15 @@ Bamboo API 集成测试
 
 import pytest
 import asyncio
+import importlib.util
 import aiohttp
 import websockets
-import json
-import time
-import uuid
-from typing import Dict, Any, List
+from time import perf_counter_ns
 
 from conftest import (
     TestConfig, create_session_via_http, connect_ws, send_chat_via_ws,
-    read_sse_stream, get_session_history, stop_session, PerformanceMonitor
+    read_sse_stream, get_session_history, stop_session, PerformanceMonitor,
+    drain_ws, ws_loads, ws_dumps, make_session_id
 )
 
 
@@ -47,7 +46,7 @@ class TestHttpApi:
     
     async def test_create_session_with_custom_id(self, config: TestConfig, http_session):
         """测试使用自定义 session_id 创建会话"""
-        custom_id = f"test-session-{uuid.uuid4().hex[:8]}"
+        custom_id = make_session_id("test-session")
         
         payload = {
             "message": "Test with custom ID",
@@ -67,7 +66,7 @@ class TestHttpApi:
         session_id = result['session_id']
         
         # 读取流
-        stream_url = f"{config.base_url}{result['stream_url']}"
+        stream_url = result['absolute_stream_url']
         events = await read_sse_stream(http_session, stream_url, timeout=30.0)
         
         # 验证收到事件
@@ -84,7 +83,7 @@ class TestHttpApi:
         session_id = result['session_id']
         
         # 等待流完成
-        stream_url = f"{config.base_url}{result['stream_url']}"
+        stream_url = result['absolute_stream_url']
         await read_sse_stream(http_session, stream_url, timeout=30.0)
         
         # 获取历史
@@ -120,7 +119,7 @@ class TestWebSocketApi:
     
     async def test_ws_connect_message(self, config: TestConfig):
         """测试 WebSocket Connect 消息"""
-        session_id = f"ws-test-{uuid.uuid4().hex[:8]}"
+        session_id = make_session_id("ws-test")
         
         async with websockets.connect(config.ws_url) as ws:
             # 发送 Connect
@@ -128,18 +127,18 @@ class TestWebSocketApi:
                 "type": "Connect",
                 "session_id": session_id
             }
-            await ws.send(json.dumps(connect_msg))
+            await ws.send(ws_dumps(connect_msg))
             
             # 等待响应
             response = await asyncio.wait_for(ws.recv(), timeout=10)
-            data = json.loads(response)
+            data = ws_loads(response)
             
             assert data.get('type') == 'Connected'
             assert data.get('session_id') == session_id
     
     async def test_ws_chat_message(self, config: TestConfig):
         """测试 WebSocket Chat 消息"""
-        session_id = f"ws-chat-{uuid.uuid4().hex[:8]}"
+        session_id = make_session_id("ws-chat")
         
         async with websockets.connect(config.ws_url) as ws:
             # 连接
@@ -149,20 +148,7 @@ class TestWebSocketApi:
             await send_chat_via_ws(ws, session_id, "Hello from WebSocket")
             
             # 等待响应（可能会有多个 Token 事件）
-            events = []
-            start_time = time.time()
-            
-            while time.time() - start_time < 30:
-                try:
-                    response = await asyncio.wait_for(ws.recv(), timeout=5)
-                    data = json.loads(response)
-                    events.append(data)
-                    
-                    # 检查是否完成
-                    if data.get('type') in ['Complete', 'Error']:
-                        break
-                except asyncio.TimeoutError:
-                    break
+            events = await drain_ws(ws, overall=30)
             
             # 验证收到响应
             assert len(events) > 0
@@ -178,11 +164,11 @@ class TestWebSocketApi:
                 "session_id": "test",
                 "content": "Hello"
             }
-            await ws.send(json.dumps(chat_msg))
+            await ws.send(ws_dumps(chat_msg))
             
             # 等待错误响应
             response = await asyncio.wait_for(ws.recv(), timeout=5)
-            data = json.loads(response)
+            data = ws_loads(response)
             
             assert data.get('type') == 'Error'
             assert 'NOT_CONNECTED' in data.get('code', '')
@@ -212,19 +198,7 @@ class TestHttpWebSocketIntegration:
             await send_chat_via_ws(ws, session_id, "Follow up via WebSocket")
             
             # 接收响应
-            events = []
-            start_time = time.time()
-            
-            while time.time() - start_time < 30:
-                try:
-                    response = await asyncio.wait_for(ws.recv(), timeout=5)
-                    data = json.loads(response)
-                    events.append(data)
-                    
-                    if data.get('type') in ['Complete', 'Error']:
-                        break
-                except asyncio.TimeoutError:
-                    break
+            events = await drain_ws(ws, overall=30)
             
             assert len(events) > 0
     
@@ -240,7 +214,7 @@ class TestHttpWebSocketIntegration:
             session_id = result['session_id']
             
             # 读取流
-            stream_url = f"{config.base_url}{result['stream_url']}"
+            stream_url = result['absolute_stream_url']
             events = await read_sse_stream(http_session, stream_url, timeout=30.0)
             
             results['http'] = {
@@ -250,33 +224,23 @@ class TestHttpWebSocketIntegration:
         
         async def ws_task():
             """WebSocket 任务"""
-            session_id = f"parallel-ws-{uuid.uuid4().hex[:8]}"
+            session_id = make_session_id("parallel-ws")
             
             async with websockets.connect(config.ws_url) as ws:
                 await connect_ws(ws, session_id)
                 await send_chat_via_ws(ws, session_id, "WS parallel test")
                 
-                events = []
-                start_time = time.time()
-                
-                while time.time() - start_time < 30:
-                    try:
-                        response = await asyncio.wait_for(ws.recv(), timeout=5)
-                        data = json.loads(response)
-                        events.append(data)
-                        
-                        if data.get('type') in ['Complete', 'Error']:
-                            break
-                    except asyncio.TimeoutError:
-                        break
+                events = await drain_ws(ws, overall=30)
                 
                 results['ws'] = {
                     'session_id': session_id,
                     'event_count': len(events)
                 }
         
-        # 并行执行
-        await asyncio.gather(http_task(), ws_task())
+        # 并行执行（任一失败立即取消另一个）
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(http_task())
+            tg.create_task(ws_task())
         
         # 验证结果
         assert results['http'] is not None
@@ -293,9 +257,9 @@ class TestHttpWebSocketIntegration:
 class TestSessionPersistence:
     """会话持久化测试"""
     
-    async def test_session_persists_after_disconnect(self, config: TestConfig):
-        """测试断开后会话仍然保持"""
-        session_id = f"persist-{uuid.uuid4().hex[:8]}"
+    async def test_ws_reconnect_persistence(self, config: TestConfig):
+        """测试断线重连后会话仍然保持"""
+        session_id = make_session_id("reconnect")
         
         # 第一次连接
         async with websockets.connect(config.ws_url) as ws:
@@ -303,26 +267,18 @@ class TestSessionPersistence:
             await send_chat_via_ws(ws, session_id, "First message")
             
             # 接收一些响应
-            start_time = time.time()
-            while time.time() - start_time < 10:
-                try:
-                    response = await asyncio.wait_for(ws.recv(), timeout=2)
-                    data = json.loads(response)
-                    if data.get('type') in ['Complete', 'Error']:
-                        break
-                except asyncio.TimeoutError:
-                    break
+            await drain_ws(ws, overall=10)
         
         # 断开连接后重新连接
         async with websockets.connect(config.ws_url) as ws:
             await connect_ws(ws, session_id)
             
-            # 验证可以发送新消息
+            # 验证可以发送新消息，会话恢复
             await send_chat_via_ws(ws, session_id, "Second message after reconnect")
             
             # 接收响应
             response = await asyncio.wait_for(ws.recv(), timeout=10)
-            data = json.loads(response)
+            data = ws_loads(response)
             
             # 应该能收到响应
             assert data.get('type') is not None
@@ -336,7 +292,7 @@ class TestSessionPersistence:
         session_id = result['session_id']
         
         # 等待流完成
-        stream_url = f"{config.base_url}{result['stream_url']}"
+        stream_url = result['absolute_stream_url']
         await read_sse_stream(http_session, stream_url, timeout=30.0)
         
         # 获取历史，验证会话存在
@@ -358,7 +314,7 @@ class TestMultiClient:
     
     async def test_multiple_ws_clients_same_session(self, config: TestConfig):
         """测试多个 WebSocket 客户端连接到同一会话"""
-        session_id = f"multi-ws-{uuid.uuid4().hex[:8]}"
+        session_id = make_session_id("multi-ws")
         
         async def client_task(client_id: int):
             """客户端任务"""
@@ -370,52 +326,41 @@ class TestMultiClient:
                 await send_chat_via_ws(ws, session_id, f"Message from client {client_id}")
                 
                 # 接收响应
-                events = []
-                start_time = time.time()
-                
-                while time.time() - start_time < 15:
-                    try:
-                        response = await asyncio.wait_for(ws.recv(), timeout=3)
-                        data = json.loads(response)
-                        events.append(data)
-                        
-                        if data.get('type') in ['Complete', 'Error']:
-                            break
-                    except asyncio.TimeoutError:
-                        break
+                events = await drain_ws(ws, overall=15)
                 
                 return {'client_id': client_id, 'events': events}
         
         # 启动多个客户端
-        clients = [client_task(i) for i in range(3)]
-        results = await asyncio.gather(*clients)
+        async with asyncio.TaskGroup() as tg:
+            clients = [tg.create_task(client_task(i)) for i in range(3)]
+        results = [c.result() for c in clients]
         
         # 验证所有客户端都收到了响应
         for result in results:
             assert len(result['events']) > 0
     
-    async def test_concurrent_http_requests(self, config: TestConfig):
+    async def test_concurrent_http_requests(self, config: TestConfig, http_session):
         """测试并发 HTTP 请求"""
-        async def request_task(task_id: int):
+        async def request_task(session: aiohttp.ClientSession, task_id: int):
             """请求任务"""
-            async with aiohttp.ClientSession() as session:
-                result = await create_session_via_http(
-                    session, config, f"Concurrent request {task_id}"
-                )
-                
-                # 读取流
-                stream_url = f"{config.base_url}{result['stream_url']}"
-                events = await read_sse_stream(session, stream_url, timeout=30.0)
-                
-                return {
-                    'task_id': task_id,
-                    'session_id': result['session_id'],
-                    'event_count': len(events)
-                }
+            result = await create_session_via_http(
+                session, config, f"Concurrent request {task_id}"
+            )
+            
+            # 读取流
+            stream_url = result['absolute_stream_url']
+            events = await read_sse_stream(session, stream_url, timeout=30.0)
+            
+            return {
+                'task_id': task_id,
+                'session_id': result['session_id'],
+                'event_count': len(events)
+            }
         
-        # 并发发送 5 个请求
-        tasks = [request_task(i) for i in range(5)]
-        results = await asyncio.gather(*tasks)
+        # 并发发送 5 个请求（共享同一个连接池）
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(request_task(http_session, i)) for i in range(5)]
+        results = [t.result() for t in tasks]
         
         # 验证所有请求都成功
         for result in results:
@@ -441,37 +386,33 @@ class TestEndToEnd:
         monitor.start()
         
         # 1. 创建会话
-        create_start = time.time()
+        t0 = perf_counter_ns()
         result = await create_session_via_http(
             http_session, config, "Start conversation"
         )
-        create_latency = (time.time() - create_start) * 1000
-        monitor.record_latency('create_session', create_latency)
+        monitor.record_latency_ns('create_session', perf_counter_ns() - t0)
         
         session_id = result['session_id']
         
         # 2. 读取流（聊天）
-        stream_start = time.time()
-        stream_url = f"{config.base_url}{result['stream_url']}"
+        t0 = perf_counter_ns()
+        stream_url = result['absolute_stream_url']
         events = await read_sse_stream(http_session, stream_url, timeout=30.0)
-        stream_latency = (time.time() - stream_start) * 1000
-        monitor.record_latency('first_chat_stream', stream_latency)
+        monitor.record_latency_ns('first_chat_stream', perf_counter_ns() - t0)
         
         assert len(events) > 0
         
         # 3. 获取历史
-        history_start = time.time()
+        t0 = perf_counter_ns()
         history = await get_session_history(http_session, config, session_id)
-        history_latency = (time.time() - history_start) * 1000
-        monitor.record_latency('get_history', history_latency)
+        monitor.record_latency_ns('get_history', perf_counter_ns() - t0)
         
         assert len(history) >= 1
         
         # 4. 停止会话
-        stop_start = time.time()
+        t0 = perf_counter_ns()
         success = await stop_session(http_session, config, session_id)
-        stop_latency = (time.time() - stop_start) * 1000
-        monitor.record_latency('stop_session', stop_latency)
+        monitor.record_latency_ns('stop_session', perf_counter_ns() - t0)
         
         assert success
         
@@ -488,7 +429,7 @@ class TestEndToEnd:
     
     async def test_complete_conversation_flow_ws(self, config: TestConfig):
         """测试完整的 WebSocket 对话流程"""
-        session_id = f"e2e-ws-{uuid.uuid4().hex[:8]}"
+        session_id = make_session_id("e2e-ws")
         
         async with websockets.connect(config.ws_url) as ws:
             # 1. 连接
@@ -507,19 +448,7 @@ class TestEndToEnd:
                 await send_chat_via_ws(ws, session_id, msg)
                 
                 # 接收响应
-                events = []
-                start_time = time.time()
-                
-                while time.time() - start_time < 30:
-                    try:
-                        response = await asyncio.wait_for(ws.recv(), timeout=5)
-                        data = json.loads(response)
-                        events.append(data)
-                        
-                        if data.get('type') in ['Complete', 'Error']:
-                            break
-                    except asyncio.TimeoutError:
-                        break
+                events = await drain_ws(ws, overall=30)
                 
                 # 验证收到响应
                 assert len(events) > 0
@@ -555,39 +484,6 @@ class TestErrorRecovery:
             # 应该返回 400
             assert response.status == 400
     
-    async def test_ws_reconnect_after_disconnect(self, config: TestConfig):
-        """测试断线重连"""
-        session_id = f"reconnect-{uuid.uuid4().hex[:8]}"
-        
-        # 第一次连接并发送消息
-        async with websockets.connect(config.ws_url) as ws:
-            await connect_ws(ws, session_id)
-            await send_chat_via_ws(ws, session_id, "First message")
-            
-            # 接收一些响应
-            start_time = time.time()
-            while time.time() - start_time < 5:
-                try:
-                    response = await asyncio.wait_for(ws.recv(), timeout=2)
-                    data = json.loads(response)
-                    if data.get('type') in ['Complete', 'Error']:
-                        break
-                except asyncio.TimeoutError:
-                    break
-        
-        # 模拟断线后重连
-        async with websockets.connect(config.ws_url) as ws:
-            await connect_ws(ws, session_id)
-            
-            # 发送新消息，验证会话恢复
-            await send_chat_via_ws(ws, session_id, "After reconnect")
-            
-            response = await asyncio.wait_for(ws.recv(), timeout=10)
-            data = json.loads(response)
-            
-            # 应该能正常收到响应
-            assert data.get('type') is not None
-    
     async def test_graceful_degradation_under_load(self, config: TestConfig):
         """测试负载下的优雅降级"""
         async def stress_client(client_id: int):
@@ -597,48 +493,47 @@ class TestErrorRecovery:
                     config.ws_url,
                     timeout=5
                 ) as ws:
-                    session_id = f"stress-{client_id}-{uuid.uuid4().hex[:8]}"
+                    session_id = make_session_id(f"stress-{client_id}")
                     await connect_ws(ws, session_id)
                     
-                    # 快速发送多条消息
-                    for i in range(5):
-                        await send_chat_via_ws(ws, session_id, f"Stress message {i}")
-                        await asyncio.sleep(0.1)
-                    
-                    # 尝试接收响应
-                    events = []
-                    start_time = time.time()
-                    
-                    while time.time() - start_time < 10:
-                        try:
-                            response = await asyncio.wait_for(ws.recv(), timeout=2)
-                            data = json.loads(response)
-                            events.append(data)
-                            
-                            if data.get('type') in ['Complete', 'Error']:
-                                break
-                        except asyncio.TimeoutError:
-                            break
+                    # 连续发送多条消息，同时接收响应
+                    sends = asyncio.gather(*(
+                        send_chat_via_ws(ws, session_id, f"Stress message {i}")
+                        for i in range(5)
+                    ))
+                    _, events = await asyncio.gather(sends, drain_ws(ws, overall=10))
                     
                     return {'client_id': client_id, 'success': True, 'events': len(events)}
             except Exception as e:
                 return {'client_id': client_id, 'success': False, 'error': str(e)}
         
-        # 启动多个并发客户端
-        clients = [stress_client(i) for i in range(10)]
-        results = await asyncio.gather(*clients)
-        
-        # 统计结果
-        successful = sum(1 for r in results if r['success'])
-        failed = len(results) - successful
+        # 启动多个并发客户端，按完成顺序统计
+        num_clients = 10
+        clients = [asyncio.create_task(stress_client(i)) for i in range(num_clients)]
+        successful = 0
+        failed = 0
+        try:
+            for next_done in asyncio.as_completed(clients):
+                result = await next_done
+                if result['success']:
+                    successful += 1
+                else:
+                    failed += 1
+                    # 失败已超过一半，结论已定，不再等待剩余客户端
+                    if failed > num_clients * 0.5:
+                        break
+        finally:
+            for client in clients:
+                client.cancel()
+            await asyncio.gather(*clients, return_exceptions=True)
         
         print(f"\nStress Test Results:")
-        print(f"  Total: {len(results)}")
+        print(f"  Total: {num_clients}")
         print(f"  Successful: {successful}")
         print(f"  Failed: {failed}")
         
         # 至少 50% 应该成功（允许部分失败）
-        assert successful >= len(results) * 0.5
+        assert successful >= num_clients * 0.5
 
 
 # =============================================================================
@@ -646,4 +541,8 @@ class TestErrorRecovery:
 # =============================================================================
 
 if __name__ == "__main__":
-    pytest.main([__file__, "-v", "--tb=short"])
+    # 装了 pytest-xdist 时按 CPU 核数并行
+    pytest_args = [__file__, "-v", "--tb=short"]
+    if importlib.util.find_spec("xdist") is not None:
+        pytest_args += ["-n", "auto"]
+    pytest.main(pytest_args)
@@ -3,32 +3,106 @@ Bamboo API 性能测试
 使用 pytest + locust 进行并发、延迟、吞吐量测试
 """
 
+from __future__ import annotations
+
 import pytest
 import asyncio
-import aiohttp
-import websockets
-import json
+import functools
+import orjson
+import threading
 import time
-import uuid
-import statistics
-from typing import Dict, Any, List, Optional
-from dataclasses import dataclass, field
-from datetime import datetime
-import psutil
+from time import perf_counter_ns
 import os
-from concurrent.futures import ThreadPoolExecutor
+import sys
+from collections.abc import Iterable
+from dataclasses import dataclass, field
 
 from conftest import (
     TestConfig, create_session_via_http, connect_ws, send_chat_via_ws,
-    read_sse_stream, PerformanceMonitor, TEST_MESSAGES
+    TERMINAL_EVENT_TYPES, TEST_PAYLOADS, make_session_id,
+    new_latency_histogram, record_latency_us
 )
 
 
+# =============================================================================
+# 重量级依赖按需导入（只收集或只运行部分测试时不付导入开销）
+# =============================================================================
+
+@functools.cache
+def _psutil():
+    import psutil
+    return psutil
+
+
+@functools.cache
+def _aiohttp():
+    import aiohttp
+    return aiohttp
+
+
+@functools.cache
+def _websockets():
+    import websockets
+    return websockets
+
+
+@functools.cache
+def _numpy():
+    import numpy
+    return numpy
+
+
+def _latency_histogram(samples_ms: list[float]):
+    """把毫秒样本记入延迟直方图（与 PerformanceMonitor 同一后端，值单位为微秒）"""
+    histogram = new_latency_histogram()
+    for value in samples_ms:
+        record_latency_us(histogram, round(value * 1000))
+    return histogram
+
+
+def _summary_stats(histogram) -> dict[str, float]:
+    """直方图的 min/max/avg/P95（毫秒）"""
+    return {
+        'min_ms': histogram.get_min_value() / 1000,
+        'max_ms': histogram.get_max_value() / 1000,
+        'avg_ms': histogram.get_mean_value() / 1000,
+        'p95_ms': histogram.get_value_at_percentile(95) / 1000
+    }
+
+
+# 字节 → MB 换算系数（采样循环中用乘法代替两次除法）
+_BYTES_PER_MB_INV = 1.0 / (1024 * 1024)
+
+# SSE 请求头：声明事件流并要求不压缩，服务端按原样逐块推送
+_SSE_HEADERS = {'Accept': 'text/event-stream', 'Accept-Encoding': 'identity'}
+
+# 终止事件类型的 JSON 字面量，用于在解析前快速过滤
+_TERMINAL_MARKERS = tuple(f'"{t}"'.encode() for t in TERMINAL_EVENT_TYPES)
+
+
+def _is_terminal_event(payload: bytes) -> bool:
+    """判断 SSE data 是否为终止事件（不含终止类型字面量的 token 事件不做 JSON 解析）"""
+    if not any(marker in payload for marker in _TERMINAL_MARKERS):
+        return False
+    try:
+        return orjson.loads(payload).get('type') in TERMINAL_EVENT_TYPES
+    except orjson.JSONDecodeError:
+        return False
+
+
+async def _recv_session_event(ws, session_id: str) -> dict:
+    """接收下一个属于 session_id 的事件（按事件里的 session_id 认领，不带 session_id 的 Error 也算）"""
+    while True:
+        event = orjson.loads(await ws.recv())
+        if event.get('session_id', session_id) == session_id:
+            return event
+
+
 # =============================================================================
 # 性能测试数据收集器
 # =============================================================================
 
-@dataclass
+@dataclass(slots=True)
 class PerformanceResult:
     """性能测试结果"""
     test_name: str
@@ -36,13 +110,15 @@ class PerformanceResult:
     total_requests: int
     successful_requests: int
     failed_requests: int
-    latencies_ms: List[float] = field(default_factory=list)
-    first_token_latencies_ms: List[float] = field(default_factory=list)
-    total_durations_ms: List[float] = field(default_factory=list)
-    start_time: Optional[float] = None
-    end_time: Optional[float] = None
+    latencies_ms: list[float] = field(default_factory=list)
+    first_token_latencies_ms: list[float] = field(default_factory=list)
+    total_durations_ms: list[float] = field(default_factory=list)
+    start_time: float | None = None
+    end_time: float | None = None
     memory_start_mb: float = 0.0
     memory_end_mb: float = 0.0
+    # 统计结果缓存：名称 → 统计字典，add_samples 追加样本时清空
+    _stats_cache: dict = field(default_factory=dict, init=False, repr=False, compare=False)
     
     @property
     def duration_seconds(self) -> float:
@@ -56,31 +132,49 @@ class PerformanceResult:
             return self.successful_requests / self.duration_seconds
         return 0.0
     
+    def add_samples(self, latencies_ms: Iterable[float],
+                    first_token_latencies_ms: Iterable[float] = ()) -> None:
+        """追加延迟样本（毫秒）并使已计算的统计失效"""
+        self.latencies_ms.extend(latencies_ms)
+        self.first_token_latencies_ms.extend(first_token_latencies_ms)
+        self._stats_cache.clear()
+    
     @property
-    def latency_stats(self) -> Dict[str, float]:
+    def latency_stats(self) -> dict[str, float]:
+        """延迟统计（样本经 add_samples 追加；结果缓存到下一次追加）"""
         if not self.latencies_ms:
             return {}
-        sorted_latencies = sorted(self.latencies_ms)
-        return {
-            'min_ms': min(self.latencies_ms),
-            'max_ms': max(self.latencies_ms),
-            'avg_ms': statistics.mean(self.latencies_ms),
-            'median_ms': statistics.median(self.latencies_ms),
-            'p50_ms': sorted_latencies[int(len(sorted_latencies) * 0.50)],
-            'p95_ms': sorted_latencies[int(len(sorted_latencies) * 0.95)],
-            'p99_ms': sorted_latencies[int(len(sorted_latencies) * 0.99)],
-            'std_dev': statistics.stdev(self.latencies_ms) if len(self.latencies_ms) > 1 else 0
-        }
+        stats = self._stats_cache.get('latency')
+        if stats is None:
+            stats = self._stats_cache['latency'] = self._compute_latency_stats(
+                _latency_histogram(self.latencies_ms)
+            )
+        return stats
     
     @property
-    def first_token_stats(self) -> Dict[str, float]:
+    def first_token_stats(self) -> dict[str, float]:
+        """首 token 延迟统计（缓存规则同 latency_stats）"""
         if not self.first_token_latencies_ms:
             return {}
+        stats = self._stats_cache.get('first_token')
+        if stats is None:
+            stats = self._stats_cache['first_token'] = _summary_stats(
+                _latency_histogram(self.first_token_latencies_ms)
+            )
+        return stats
+    
+    @staticmethod
+    def _compute_latency_stats(histogram) -> dict[str, float]:
+        p50 = histogram.get_value_at_percentile(50) / 1000
         return {
-            'min_ms': min(self.first_token_latencies_ms),
-            'max_ms': max(self.first_token_latencies_ms),
-            'avg_ms': statistics.mean(self.first_token_latencies_ms),
-            'p95_ms': sorted(self.first_token_latencies_ms)[int(len(self.first_token_latencies_ms) * 0.95)]
+            'min_ms': histogram.get_min_value() / 1000,
+            'max_ms': histogram.get_max_value() / 1000,
+            'avg_ms': histogram.get_mean_value() / 1000,
+            'median_ms': p50,
+            'p50_ms': p50,
+            'p95_ms': histogram.get_value_at_percentile(95) / 1000,
+            'p99_ms': histogram.get_value_at_percentile(99) / 1000,
+            'std_dev': histogram.get_stddev() / 1000
         }
     
     def print_summary(self):
@@ -113,6 +207,62 @@ class PerformanceResult:
         print(f"{'='*60}\n")
 
 
+class TestPerformanceResultStats:
+    """PerformanceResult 统计计算测试（不依赖服务）"""
+    
+    def test_percentiles_from_histogram(self):
+        """百分位取直方图中覆盖该比例样本的值（3 位有效数字精度）"""
+        result = PerformanceResult(
+            test_name="stats", concurrency=1, total_requests=10,
+            successful_requests=10, failed_requests=0,
+            latencies_ms=[float(i) for i in range(1, 11)],
+            first_token_latencies_ms=[float(i) for i in range(1, 11)]
+        )
+        
+        stats = result.latency_stats
+        assert stats['avg_ms'] == pytest.approx(5.5, rel=1e-3)
+        assert stats['p50_ms'] == pytest.approx(5.0, rel=1e-3)
+        assert stats['p95_ms'] == pytest.approx(10.0, rel=1e-3)
+        assert stats['p99_ms'] == pytest.approx(10.0, rel=1e-3)
+        assert stats['min_ms'] == pytest.approx(1.0, rel=1e-3)
+        assert result.first_token_stats['p95_ms'] == pytest.approx(10.0, rel=1e-3)
+    
+    def test_single_sample(self):
+        """单个样本时百分位等于该样本，标准差为 0"""
+        result = PerformanceResult(
+            test_name="stats", concurrency=1, total_requests=1,
+            successful_requests=1, failed_requests=0, latencies_ms=[42.0]
+        )
+        
+        stats = result.latency_stats
+        assert stats['p50_ms'] == stats['p99_ms'] == pytest.approx(42.0, rel=1e-3)
+        assert stats['std_dev'] == 0.0
+    
+    def test_latency_over_limit_clamped(self):
+        """超过直方图上限的样本钳到上限，仍计入统计"""
+        result = PerformanceResult(
+            test_name="stats", concurrency=1, total_requests=2,
+            successful_requests=2, failed_requests=0,
+            latencies_ms=[10.0, 90_000.0]
+        )
+        
+        assert result.latency_stats['max_ms'] == pytest.approx(60_000.0, rel=1e-3)
+    
+    def test_stats_cached_until_samples_change(self):
+        """样本不变时复用统计结果，add_samples 追加后重新计算"""
+        result = PerformanceResult(
+            test_name="stats", concurrency=1, total_requests=2,
+            successful_requests=2, failed_requests=0, latencies_ms=[1.0, 3.0]
+        )
+        
+        stats = result.latency_stats
+        assert result.latency_stats is stats
+        
+        result.add_samples([5.0])
+        assert result.latency_stats is not stats
+        assert result.latency_stats['max_ms'] == pytest.approx(5.0, rel=1e-3)
+
+
 # =============================================================================
 # 并发聊天请求测试
 # =============================================================================
@@ -138,85 +288,93 @@ class TestConcurrentChat:
         )
         
         # 记录内存使用
-        process = psutil.Process(os.getpid())
-        result.memory_start_mb = process.memory_info().rss / 1024 / 1024
+        memory_info = _psutil().Process(os.getpid()).memory_info
+        result.memory_start_mb = memory_info().rss * _BYTES_PER_MB_INV
         
-        # 信号量控制并发
-        semaphore = asyncio.Semaphore(concurrency)
-        completed_count = 0
+        # 按请求序号预分配结果数组（status: 1 成功 / -1 失败 / 0 未完成）
+        np = _numpy()
+        latencies = np.empty(total_requests, dtype=np.float64)
+        first_tokens = np.full(total_requests, np.nan)
+        status = np.zeros(total_requests, dtype=np.int8)
+        
+        num_payloads = len(TEST_PAYLOADS)
         
-        async def single_chat_request(request_id: int):
-            """单个聊天请求"""
-            nonlocal completed_count
+        async def single_chat_request(session, request_id: int) -> None:
+            """单个聊天请求，结果直接写入预分配数组"""
+            start_ns = perf_counter_ns()
+            first_token_ns = None
             
-            async with semaphore:
-                start_time = time.time()
-                first_token_time = None
+            try:
+                # 创建会话
+                chat_result = await create_session_via_http(
+                    session, config, TEST_PAYLOADS[request_id % num_payloads]
+                )
                 
-                try:
-                    async with aiohttp.ClientSession() as session:
-                        # 创建会话
-                        chat_result = await create_session_via_http(
-                            session, config, TEST_MESSAGES[request_id % len(TEST_MESSAGES)]
-                        )
-                        
-                        # 读取流
-                        stream_url = f"{config.base_url}{chat_result['stream_url']}"
-                        
-                        async with session.get(stream_url) as response:
-                            if response.status != 200:
-                                return {'success': False, 'error': f'HTTP {response.status}'}
+                # 读取流
+                stream_url = chat_result['absolute_stream_url']
+                
+                async with session.get(stream_url, headers=_SSE_HEADERS) as response:
+                    if response.status != 200:
+                        status[request_id] = -1
+                        return
+                    
+                    async for line in response.content:
+                        if line.startswith(b'data: '):
+                            if first_token_ns is None:
+                                first_token_ns = perf_counter_ns()
                             
-                            async for line in response.content:
-                                line = line.decode('utf-8').strip()
-                                if line.startswith('data: '):
-                                    if first_token_time is None:
-                                        first_token_time = time.time()
-                                    
-                                    data = line[6:]
-                                    try:
-                                        event = json.loads(data)
-                                        if event.get('type') in ['Complete', 'Error']:
-                                            break
-                                    except json.JSONDecodeError:
-                                        pass
-                        
-                        end_time = time.time()
-                        completed_count += 1
-                        
-                        return {
-                            'success': True,
-                            'total_latency_ms': (end_time - start_time) * 1000,
-                            'first_token_latency_ms': (first_token_time - start_time) * 1000 if first_token_time else None
-                        }
-                        
-                except Exception as e:
-                    return {'success': False, 'error': str(e)}
-        
-        # 记录开始时间
-        result.start_time = time.time()
-        
-        # 创建所有任务
-        tasks = [single_chat_request(i) for i in range(total_requests)]
-        
-        # 等待所有任务完成
-        task_results = await asyncio.gather(*tasks, return_exceptions=True)
+                            if _is_terminal_event(line[6:]):
+                                break
+                
+                end_ns = perf_counter_ns()
+                
+                latencies[request_id] = (end_ns - start_ns) / 1_000_000
+                if first_token_ns is not None:
+                    first_tokens[request_id] = (first_token_ns - start_ns) / 1_000_000
+                status[request_id] = 1
+                
+            except Exception:
+                status[request_id] = -1
+        
+        # 所有请求共享一个连接池，连接数上限与并发数一致
+        aiohttp = _aiohttp()
+        # DNS 结果缓存 10 分钟；所有响应都要求不压缩，因此可关闭自动解压
+        connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=600)
+        async with aiohttp.ClientSession(
+            connector=connector,
+            auto_decompress=False,
+            headers={'Accept-Encoding': 'identity'}
+        ) as session:
+            # 记录开始时间
+            result.start_time = time.time()
+            
+            # 固定 concurrency 个 worker 共享请求序号迭代器，
+            # 同时存活的协程数受并发数约束，而不是总请求数
+            request_ids = iter(range(total_requests))
+            
+            async def worker():
+                for request_id in request_ids:
+                    await single_chat_request(session, request_id)
+            
+            # 等待所有请求完成
+            await asyncio.gather(
+                *(worker() for _ in range(min(concurrency, total_requests))),
+                return_exceptions=True
+            )
         
         # 记录结束时间
         result.end_time = time.time()
-        result.memory_end_mb = process.memory_info().rss / 1024 / 1024
+        result.memory_end_mb = memory_info().rss * _BYTES_PER_MB_INV
         
         # 统计结果
-        for r in task_results:
-            if isinstance(r, Exception):
-                result.failed_requests += 1
-            elif r.get('success'):
-                result.successful_requests += 1
-                result.latencies_ms.append(r['total_latency_ms'])
-                if r.get('first_token_latency_ms'):
-                    result.first_token_latencies_ms.append(r['first_token_latency_ms'])
-            else:
-                result.failed_requests += 1
+        ok = status == 1
+        result.successful_requests = int(ok.sum())
+        result.failed_requests = total_requests - result.successful_requests
+        ok_first_tokens = first_tokens[ok]
+        result.add_samples(
+            latencies[ok].tolist(),
+            ok_first_tokens[~np.isnan(ok_first_tokens)].tolist()
+        )
         
         return result
     
@@ -266,10 +424,10 @@ class TestLatencyMeasurement:
         """测试首 token 延迟"""
         latencies = []
         
-        for i in range(10):
-            async with aiohttp.ClientSession() as session:
-                start_time = time.time()
-                first_token_time = None
+        async with _aiohttp().ClientSession() as session:
+            for i in range(10):
+                start_ns = perf_counter_ns()
+                first_token_ns = None
                 
                 # 创建会话
                 result = await create_session_via_http(
@@ -277,40 +435,42 @@ class TestLatencyMeasurement:
                 )
                 
                 # 读取流，记录首 token 时间
-                stream_url = f"{config.base_url}{result['stream_url']}"
+                stream_url = result['absolute_stream_url']
                 
-                async with session.get(stream_url) as response:
+                async with session.get(stream_url, headers=_SSE_HEADERS) as response:
                     async for line in response.content:
-                        line = line.decode('utf-8').strip()
-                        if line.startswith('data: '):
-                            first_token_time = time.time()
+                        if line.startswith(b'data: '):
+                            first_token_ns = perf_counter_ns()
                             break
+                    # 拿到首 token 即断开流，不等待服务端发完剩余事件
+                    response.close()
                 
-                if first_token_time:
-                    latency_ms = (first_token_time - start_time) * 1000
+                if first_token_ns is not None:
+                    latency_ms = (first_token_ns - start_ns) / 1_000_000
                     latencies.append(latency_ms)
                 
                 await asyncio.sleep(0.5)  # 间隔，避免请求过快
         
         # 统计
         if latencies:
+            stats = _summary_stats(_latency_histogram(latencies))
             print(f"\n首 Token 延迟统计:")
             print(f"  样本数: {len(latencies)}")
-            print(f"  平均: {statistics.mean(latencies):.2f} ms")
-            print(f"  最小: {min(latencies):.2f} ms")
-            print(f"  最大: {max(latencies):.2f} ms")
-            print(f"  P95: {sorted(latencies)[int(len(latencies)*0.95)]:.2f} ms")
+            print(f"  平均: {stats['avg_ms']:.2f} ms")
+            print(f"  最小: {stats['min_ms']:.2f} ms")
+            print(f"  最大: {stats['max_ms']:.2f} ms")
+            print(f"  P95: {stats['p95_ms']:.2f} ms")
             
             # 断言：平均首 token 延迟 < 5s
-            assert statistics.mean(latencies) < 5000
+            assert stats['avg_ms'] < 5000
     
     async def test_total_response_time(self, config: TestConfig):
         """测试总响应时间"""
         durations = []
         
         for i in range(10):
-            async with aiohttp.ClientSession() as session:
-                start_time = time.time()
+            async with _aiohttp().ClientSession() as session:
+                start_ns = perf_counter_ns()
                 
                 # 创建会话
                 result = await create_session_via_http(
@@ -318,71 +478,68 @@ class TestLatencyMeasurement:
                 )
                 
                 # 读取完整流
-                stream_url = f"{config.base_url}{result['stream_url']}"
+                stream_url = result['absolute_stream_url']
                 
-                async with session.get(stream_url) as response:
+                async with session.get(stream_url, headers=_SSE_HEADERS) as response:
                     async for line in response.content:
-                        line = line.decode('utf-8').strip()
-                        if line.startswith('data: '):
-                            data = line[6:]
-                            try:
-                                event = json.loads(data)
-                                if event.get('type') in ['Complete', 'Error']:
-                                    break
-                            except json.JSONDecodeError:
-                                pass
+                        if line.startswith(b'data: '):
+                            if _is_terminal_event(line[6:]):
+                                break
                 
-                duration_ms = (time.time() - start_time) * 1000
+                duration_ms = (perf_counter_ns() - start_ns) / 1_000_000
                 durations.append(duration_ms)
                 
                 await asyncio.sleep(0.5)
         
         # 统计
         if durations:
+            stats = _summary_stats(_latency_histogram(durations))
             print(f"\n总响应时间统计:")
             print(f"  样本数: {len(durations)}")
-            print(f"  平均: {statistics.mean(durations):.2f} ms")
-            print(f"  最小: {min(durations):.2f} ms")
-            print(f"  最大: {max(durations):.2f} ms")
-            print(f"  P95: {sorted(durations)[int(len(durations)*0.95)]:.2f} ms")
+            print(f"  平均: {stats['avg_ms']:.2f} ms")
+            print(f"  最小: {stats['min_ms']:.2f} ms")
+            print(f"  最大: {stats['max_ms']:.2f} ms")
+            print(f"  P95: {stats['p95_ms']:.2f} ms")
             
             # 断言：平均响应时间 < 30s
-            assert statistics.mean(durations) < 30000
+            assert stats['avg_ms'] < 30000
     
     async def test_ws_latency(self, config: TestConfig):
-        """测试 WebSocket 延迟"""
+        """测试 WebSocket 延迟（同一连接、同一会话上连续多轮聊天）"""
         latencies = []
+        session_id = make_session_id("latency-test")
         
-        for i in range(10):
-            session_id = f"latency-test-{uuid.uuid4().hex[:8]}"
+        # 只建立一次连接、只 Connect 一次会话，样本只含应用层往返，不含握手和会话建立
+        async with _websockets().connect(config.ws_url) as ws:
+            connected = await connect_ws(ws, session_id)
+            assert connected.get('session_id') == session_id
             
-            async with websockets.connect(config.ws_url) as ws:
-                # 连接
-                await connect_ws(ws, session_id)
-                
+            for i in range(10):
                 # 发送消息并计时
-                start_time = time.time()
-                await send_chat_via_ws(ws, session_id, "Latency test")
+                start_ns = perf_counter_ns()
+                await send_chat_via_ws(ws, session_id, f"Latency test {i}")
                 
-                # 等待第一个响应
-                response = await asyncio.wait_for(ws.recv(), timeout=30)
-                end_time = time.time()
-                
-                latency_ms = (end_time - start_time) * 1000
-                latencies.append(latency_ms)
-                
-                await asyncio.sleep(0.5)
+                async with asyncio.timeout(30):
+                    # 本会话的第一个响应计为延迟样本
+                    event = await _recv_session_event(ws, session_id)
+                    latencies.append((perf_counter_ns() - start_ns) / 1_000_000)
+                    
+                    # 读完本轮剩余事件，避免串到下一轮
+                    while event.get('type') not in TERMINAL_EVENT_TYPES:
+                        event = await _recv_session_event(ws, session_id)
         
         # 统计
         if latencies:
+            stats = _summary_stats(_latency_histogram(latencies))
             print(f"\nWebSocket 延迟统计:")
             print(f"  样本数: {len(latencies)}")
-            print(f"  平均: {statistics.mean(latencies):.2f} ms")
-            print(f"  最小: {min(latencies):.2f} ms")
-            print(f"  最大: {max(latencies):.2f} ms")
+            print(f"  平均: {stats['avg_ms']:.2f} ms")
+            print(f"  最小: {stats['min_ms']:.2f} ms")
+            print(f"  最大: {stats['max_ms']:.2f} ms")
+            print(f"  P95: {stats['p95_ms']:.2f} ms")
             
             # 断言：平均延迟 < 5s
-            assert statistics.mean(latencies) < 5000
+            assert stats['avg_ms'] < 5000
 
 
 # =============================================================================
@@ -393,61 +550,56 @@ class TestLatencyMeasurement:
 class TestThroughput:
     """吞吐量测试"""
     
-    async def test_http_throughput(self, config: TestConfig):
+    async def test_http_throughput(self, config: TestConfig, http_session):
         """测试 HTTP 吞吐量"""
         duration_seconds = 30
         concurrency = 20
         
         semaphore = asyncio.Semaphore(concurrency)
-        success_count = 0
-        error_count = 0
+        outcomes: list[bool] = []
         start_time = time.time()
         
         async def request_task():
-            nonlocal success_count, error_count
-            
             async with semaphore:
                 try:
-                    async with aiohttp.ClientSession() as session:
-                        result = await create_session_via_http(
-                            session, config, "Throughput test"
-                        )
-                        
-                        stream_url = f"{config.base_url}{result['stream_url']}"
-                        
-                        async with session.get(stream_url) as response:
-                            async for line in response.content:
-                                line = line.decode('utf-8').strip()
-                                if line.startswith('data: '):
-                                    data = line[6:]
-                                    try:
-                                        event = json.loads(data)
-                                        if event.get('type') in ['Complete', 'Error']:
-                                            break
-                                    except json.JSONDecodeError:
-                                        pass
-                        
-                        success_count += 1
-                except Exception as e:
-                    error_count += 1
-        
-        # 持续运行指定时间
-        tasks = []
-        while time.time() - start_time < duration_seconds:
-            tasks.append(asyncio.create_task(request_task()))
+                    result = await create_session_via_http(
+                        http_session, config, "Throughput test"
+                    )
+                    
+                    stream_url = result['absolute_stream_url']
+                    
+                    async with http_session.get(stream_url, headers=_SSE_HEADERS) as response:
+                        async for line in response.content:
+                            if line.startswith(b'data: '):
+                                if _is_terminal_event(line[6:]):
+                                    break
+                    
+                    outcomes.append(True)
+                except Exception:
+                    outcomes.append(False)
+        
+        # 持续运行指定时间，在途任务数上限 concurrency * 2，
+        # 只在有任务完成后补充新任务，创建速度跟随完成速度
+        pending = set()
+        deadline = start_time + duration_seconds
+        while time.time() < deadline:
+            while len(pending) < concurrency * 2 and time.time() < deadline:
+                pending.add(asyncio.create_task(request_task()))
+            # 内层循环可能因到达截止时间而一个任务也没创建，asyncio.wait 不接受空集合
+            if not pending:
+                break
             
-            # 控制创建速度
-            if len(tasks) >= concurrency * 2:
-                done, pending = await asyncio.wait(
-                    tasks, return_when=asyncio.FIRST_COMPLETED
-                )
-                tasks = list(pending)
+            done, pending = await asyncio.wait(
+                pending, timeout=0.05, return_when=asyncio.FIRST_COMPLETED
+            )
         
         # 等待剩余任务
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
         
         actual_duration = time.time() - start_time
+        success_count = sum(outcomes)
+        error_count = len(outcomes) - success_count
         throughput = success_count / actual_duration
         
         print(f"\nHTTP 吞吐量测试结果:")
@@ -465,44 +617,49 @@ class TestThroughput:
         num_clients = 10
         messages_per_client = 20
         
+        # 每个客户端的成功消息数，边收边记，超时取消时已完成的计数仍然有效
+        success_counts = [0] * num_clients
+        
         async def ws_client(client_id: int):
             """WebSocket 客户端"""
-            session_id = f"throughput-ws-{client_id}-{uuid.uuid4().hex[:8]}"
-            success_count = 0
+            session_id = make_session_id(f"throughput-ws-{client_id}")
             
             try:
-                async with websockets.connect(config.ws_url) as ws:
+                async with _websockets().connect(config.ws_url) as ws:
                     await connect_ws(ws, session_id)
                     
                     start_time = time.time()
                     
-                    while time.time() - start_time < duration_seconds and success_count < messages_per_client:
+                    while time.time() - start_time < duration_seconds and success_counts[client_id] < messages_per_client:
                         try:
-                            await send_chat_via_ws(ws, session_id, f"Message {success_count}")
+                            await send_chat_via_ws(ws, session_id, f"Message {success_counts[client_id]}")
                             
                             # 等待响应
                             response = await asyncio.wait_for(ws.recv(), timeout=10)
-                            data = json.loads(response)
+                            data = orjson.loads(response)
                             
-                            if data.get('type') not in ['Error']:
-                                success_count += 1
+                            if data.get('type') != 'Error':
+                                success_counts[client_id] += 1
                             
                             await asyncio.sleep(0.1)
                         except asyncio.TimeoutError:
                             break
-                    
-                    return success_count
-            except Exception as e:
-                return success_count
+            except Exception:
+                pass
         
         start_time = time.time()
         
-        # 启动多个客户端
-        tasks = [ws_client(i) for i in range(num_clients)]
-        results = await asyncio.gather(*tasks)
+        # 启动多个客户端，整体不超过 duration_seconds + 5 秒，超时后取消仍在等待的客户端
+        try:
+            async with asyncio.timeout(duration_seconds + 5):
+                async with asyncio.TaskGroup() as tg:
+                    for i in range(num_clients):
+                        tg.create_task(ws_client(i))
+        except TimeoutError:
+            pass
         
         actual_duration = time.time() - start_time
-        total_messages = sum(results)
+        total_messages = sum(success_counts)
         throughput = total_messages / actual_duration
         
         print(f"\nWebSocket 吞吐量测试结果:")
@@ -525,17 +682,18 @@ class TestMemoryUsage:
     
     async def test_memory_under_load(self, config: TestConfig):
         """测试负载下的内存使用"""
-        process = psutil.Process(os.getpid())
+        memory_info = _psutil().Process(os.getpid()).memory_info
         
         # 记录初始内存
-        initial_memory = process.memory_info().rss / 1024 / 1024
+        initial_memory = memory_info().rss * _BYTES_PER_MB_INV
         print(f"\n初始内存使用: {initial_memory:.2f} MB")
         
         # 创建大量会话
         num_sessions = 50
         session_ids = []
+        progress: list[str] = []  # 进度输出先缓存，循环结束后一次写出
         
-        async with aiohttp.ClientSession() as session:
+        async with _aiohttp().ClientSession() as session:
             for i in range(num_sessions):
                 result = await create_session_via_http(
                     session, config, f"Memory test message {i}"
@@ -543,11 +701,15 @@ class TestMemoryUsage:
                 session_ids.append(result['session_id'])
                 
                 if i % 10 == 0:
-                    current_memory = process.memory_info().rss / 1024 / 1024
-                    print(f"  创建 {i} 个会话后: {current_memory:.2f} MB")
+                    # 在线程中读取 RSS，避免 /proc 读取阻塞事件循环
+                    current = await asyncio.to_thread(memory_info)
+                    current_memory = current.rss * _BYTES_PER_MB_INV
+                    progress.append(f"  创建 {i} 个会话后: {current_memory:.2f} MB")
+        
+        sys.stdout.write("\n".join(progress) + "\n")
         
         # 记录最终内存
-        final_memory = process.memory_info().rss / 1024 / 1024
+        final_memory = memory_info().rss * _BYTES_PER_MB_INV
         memory_increase = final_memory - initial_memory
         
         print(f"最终内存使用: {final_memory:.2f} MB")
@@ -557,9 +719,9 @@ class TestMemoryUsage:
         # 断言：内存增量 < 500MB
         assert memory_increase < 500
     
-    async def test_memory_stability(self, config: TestConfig):
+    async def test_memory_stability(self, config: TestConfig, http_session):
         """测试内存稳定性（长时间运行）"""
-        process = psutil.Process(os.getpid())
+        memory_info = _psutil().Process(os.getpid()).memory_info
         
         # 记录多个时间点的内存
         memory_samples = []
@@ -572,39 +734,41 @@ class TestMemoryUsage:
             """持续发送请求"""
             while time.time() - start_time < duration_seconds:
                 try:
-                    async with aiohttp.ClientSession() as session:
-                        result = await create_session_via_http(
-                            session, config, "Stability test"
-                        )
-                        
-                        stream_url = f"{config.base_url}{result['stream_url']}"
-                        
-                        async with session.get(stream_url) as response:
-                            async for line in response.content:
-                                line = line.decode('utf-8').strip()
-                                if line.startswith('data: '):
-                                    data = line[6:]
-                                    try:
-                                        event = json.loads(data)
-                                        if event.get('type') in ['Complete', 'Error']:
-                                            break
-                                    except json.JSONDecodeError:
-                                        pass
+                    result = await create_session_via_http(
+                        http_session, config, "Stability test"
+                    )
+                    
+                    stream_url = result['absolute_stream_url']
+                    
+                    async with http_session.get(stream_url, headers=_SSE_HEADERS) as response:
+                        async for line in response.content:
+                            if line.startswith(b'data: '):
+                                if _is_terminal_event(line[6:]):
+                                    break
                 except Exception as e:
                     pass
                 
                 await asyncio.sleep(0.5)
         
-        async def sample_memory():
-            """采样内存"""
-            while time.time() - start_time < duration_seconds:
-                memory = process.memory_info().rss / 1024 / 1024
-                memory_samples.append(memory)
-                print(f"  内存采样: {memory:.2f} MB")
-                await asyncio.sleep(sample_interval)
+        stop_sampling = threading.Event()
         
-        # 同时运行请求和采样
-        await asyncio.gather(continuous_requests(), sample_memory())
+        def sample_memory():
+            """采样内存（后台线程，不占用事件循环）"""
+            while not stop_sampling.is_set():
+                memory = memory_info().rss * _BYTES_PER_MB_INV
+                memory_samples.append(memory)
+                stop_sampling.wait(sample_interval)
+        
+        # 请求在事件循环中运行，采样在后台线程中运行
+        sampler = threading.Thread(target=sample_memory, name="memory-sampler", daemon=True)
+        sampler.start()
+        try:
+            await continuous_requests()
+        finally:
+            stop_sampling.set()
+            sampler.join()
+        
+        sys.stdout.write("".join(f"  内存采样: {m:.2f} MB\n" for m in memory_samples))
         
         # 分析内存趋势
         if len(memory_samples) >= 2:
@@ -30,569 +30,47 @@ import os
 import tempfile
 import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Any, Dict, Optional
 import gzip
 import shutil
 
 import pytest
 import pytest_asyncio
 
-
-# ============================================================================
-# 数据模型
-# ============================================================================
-
-@dataclass
-class SessionMetadata:
-    """Session 元数据"""
-    session_id: str
-    client_id: str
-    created_at: float
-    last_activity: float
-    expires_at: float
-    user_agent: str
-    ip_address: str
-    custom_data: Dict[str, Any]
-    
-    def to_dict(self) -> Dict:
-        return asdict(self)
-    
-    @classmethod
-    def from_dict(cls, data: Dict) -> 'SessionMetadata':
-        return cls(**data)
-
-
-@dataclass
-class SessionState:
-    """Session 状态"""
-    session_id: str
-    status: str  # active, inactive, expired
-    data: Dict[str, Any]
-    sequence_number: int
-    checkpoint_id: str
-    
-    def to_dict(self) -> Dict:
-        return asdict(self)
-    
-    @classmethod
-    def from_dict(cls, data: Dict) -> 'SessionState':
-        return cls(**data)
+from session_store import JSONLSessionStore, SessionManager, SessionMetadata, SessionState, zstandard
 
 
 # ============================================================================
-# Session 存储实现
+# 测试数据构造
 # ============================================================================
 
-class JSONLSessionStore:
-    """JSONL 格式的 Session 持久化存储"""
-    
-    def __init__(self, storage_dir: str, compress_after_days: int = 7):
-        self.storage_dir = Path(storage_dir)
-        self.storage_dir.mkdir(parents=True, exist_ok=True)
-        self.compress_after_days = compress_after_days
-        self._lock = asyncio.Lock()
-        
-    def _get_session_file(self, session_id: str) -> Path:
-        """获取 session 文件路径"""
-        return self.storage_dir / f"{session_id}.jsonl"
-    
-    def _get_archive_file(self, session_id: str) -> Path:
-        """获取归档文件路径"""
-        return self.storage_dir / f"{session_id}.jsonl.gz"
-    
-    async def save_session(self, session: SessionMetadata) -> bool:
-        """保存 session 元数据"""
-        async with self._lock:
-            file_path = self._get_session_file(session.session_id)
-            record = {
-                "type": "metadata",
-                "timestamp": time.time(),
-                "data": session.to_dict()
-            }
-            
-            with open(file_path, 'a', encoding='utf-8') as f:
-                f.write(json.dumps(record, ensure_ascii=False) + '\n')
-            return True
-    
-    async def save_state(self, session_id: str, state: SessionState) -> bool:
-        """保存 session 状态"""
-        async with self._lock:
-            file_path = self._get_session_file(session_id)
-            record = {
-                "type": "state",
-                "timestamp": time.time(),
-                "data": state.to_dict()
-            }
-            
-            with open(file_path, 'a', encoding='utf-8') as f:
-                f.write(json.dumps(record, ensure_ascii=False) + '\n')
-            return True
-    
-    async def load_session(self, session_id: str) -> Optional[SessionMetadata]:
-        """加载 session 元数据"""
-        file_path = self._get_session_file(session_id)
-        
-        if not file_path.exists():
-            # 检查归档文件
-            archive_path = self._get_archive_file(session_id)
-            if archive_path.exists():
-                return await self._load_from_archive(archive_path, session_id)
-            return None
-        
-        latest_metadata = None
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    record = json.loads(line)
-                    if record.get("type") == "metadata":
-                        latest_metadata = SessionMetadata.from_dict(record["data"])
-                except json.JSONDecodeError:
-                    continue
-        
-        return latest_metadata
-    
-    async def load_state(self, session_id: str) -> Optional[SessionState]:
-        """加载最新 session 状态"""
-        file_path = self._get_session_file(session_id)
-        
-        if not file_path.exists():
-            archive_path = self._get_archive_file(session_id)
-            if archive_path.exists():
-                return await self._load_state_from_archive(archive_path)
-            return None
-        
-        latest_state = None
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    record = json.loads(line)
-                    if record.get("type") == "state":
-                        state = SessionState.from_dict(record["data"])
-                        if latest_state is None or state.sequence_number > latest_state.sequence_number:
-                            latest_state = state
-                except json.JSONDecodeError:
-                    continue
-        
-        return latest_state
-    
-    async def _load_from_archive(self, archive_path: Path, session_id: str) -> Optional[SessionMetadata]:
-        """从归档文件加载 session"""
-        with gzip.open(archive_path, 'rt', encoding='utf-8') as f:
-            latest_metadata = None
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    record = json.loads(line)
-                    if record.get("type") == "metadata":
-                        latest_metadata = SessionMetadata.from_dict(record["data"])
-                except json.JSONDecodeError:
-                    continue
-            return latest_metadata
-    
-    async def _load_state_from_archive(self, archive_path: Path) -> Optional[SessionState]:
-        """从归档文件加载状态"""
-        with gzip.open(archive_path, 'rt', encoding='utf-8') as f:
-            latest_state = None
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    record = json.loads(line)
-                    if record.get("type") == "state":
-                        state = SessionState.from_dict(record["data"])
-                        if latest_state is None or state.sequence_number > latest_state.sequence_number:
-                            latest_state = state
-                except json.JSONDecodeError:
-                    continue
-            return latest_state
-    
-    async def archive_session(self, session_id: str) -> bool:
-        """归档 session 文件"""
-        async with self._lock:
-            file_path = self._get_session_file(session_id)
-            archive_path = self._get_archive_file(session_id)
-            
-            if not file_path.exists():
-                return False
-            
-            with open(file_path, 'rb') as f_in:
-                with gzip.open(archive_path, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            
-            file_path.unlink()
-            return True
-    
-    async def delete_session(self, session_id: str) -> bool:
-        """删除 session"""
-        async with self._lock:
-            file_path = self._get_session_file(session_id)
-            archive_path = self._get_archive_file(session_id)
-            
-            deleted = False
-            if file_path.exists():
-                file_path.unlink()
-                deleted = True
-            if archive_path.exists():
-                archive_path.unlink()
-                deleted = True
-            
-            return deleted
-    
-    async def list_sessions(self) -> List[str]:
-        """列出所有 session ID"""
-        sessions = set()
-        
-        for file_path in self.storage_dir.glob("*.jsonl"):
-            sessions.add(file_path.stem)
-        
-        for file_path in self.storage_dir.glob("*.jsonl.gz"):
-            sessions.add(file_path.stem.replace('.jsonl', ''))
-        
-        return list(sessions)
-    
-    async def verify_integrity(self, session_id: str) -> Dict[str, Any]:
-        """验证存储文件完整性"""
-        file_path = self._get_session_file(session_id)
-        result = {
-            "session_id": session_id,
-            "exists": False,
-            "valid_records": 0,
-            "invalid_records": 0,
-            "total_records": 0,
-            "errors": []
-        }
-        
-        if not file_path.exists():
-            archive_path = self._get_archive_file(session_id)
-            if archive_path.exists():
-                return await self._verify_archive_integrity(archive_path, result)
-            return result
-        
-        result["exists"] = True
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if not line:
-                    continue
-                result["total_records"] += 1
-                try:
-                    record = json.loads(line)
-                    if "type" in record and "data" in record:
-                        result["valid_records"] += 1
-                    else:
-                        result["invalid_records"] += 1
-                        result["errors"].append(f"Line {line_num}: Missing required fields")
-                except json.JSONDecodeError as e:
-                    result["invalid_records"] += 1
-                    result["errors"].append(f"Line {line_num}: JSON decode error - {e}")
-        
-        return result
-    
-    async def _verify_archive_integrity(self, archive_path: Path, result: Dict) -> Dict:
-        """验证归档文件完整性"""
-        result["exists"] = True
-        result["archived"] = True
-        
-        try:
-            with gzip.open(archive_path, 'rt', encoding='utf-8') as f:
-                for line_num, line in enumerate(f, 1):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    result["total_records"] += 1
-                    try:
-                        record = json.loads(line)
-                        if "type" in record and "data" in record:
-                            result["valid_records"] += 1
-                        else:
-                            result["invalid_records"] += 1
-                            result["errors"].append(f"Line {line_num}: Missing required fields")
-                    except json.JSONDecodeError as e:
-                        result["invalid_records"] += 1
-                        result["errors"].append(f"Line {line_num}: JSON decode error - {e}")
-        except gzip.BadGzipFile as e:
-            result["errors"].append(f"Corrupted gzip file: {e}")
-        
-        return result
-    
-    async def get_storage_stats(self) -> Dict[str, Any]:
-        """获取存储统计信息"""
-        stats = {
-            "total_sessions": 0,
-            "active_files": 0,
-            "archived_files": 0,
-            "total_size_bytes": 0,
-            "avg_file_size_bytes": 0
-        }
-        
-        total_size = 0
-        
-        for file_path in self.storage_dir.glob("*.jsonl"):
-            stats["active_files"] += 1
-            total_size += file_path.stat().st_size
-        
-        for file_path in self.storage_dir.glob("*.jsonl.gz"):
-            stats["archived_files"] += 1
-            total_size += file_path.stat().st_size
-        
-        stats["total_sessions"] = stats["active_files"] + stats["archived_files"]
-        stats["total_size_bytes"] = total_size
-        
-        if stats["total_sessions"] > 0:
-            stats["avg_file_size_bytes"] = total_size // stats["total_sessions"]
-        
-        return stats
-
+def make_metadata(session_id: str, **fields) -> SessionMetadata:
+    """构造一小时后过期的 SessionMetadata，未给出的字段取测试默认值"""
+    now = time.time()
+    values = {
+        "client_id": "client_001",
+        "created_at": now,
+        "last_activity": now,
+        "expires_at": now + 3600,
+        "user_agent": "TestAgent",
+        "ip_address": "127.0.0.1",
+        "custom_data": {},
+        **fields
+    }
+    return SessionMetadata(session_id=session_id, **values)
 
-# ============================================================================
-# Session 管理器
-# ============================================================================
 
-class SessionManager:
-    """Session 管理器"""
-    
-    def __init__(
-        self,
-        storage_dir: str,
-        default_ttl: int = 3600,
-        cleanup_interval: int = 300
-    ):
-        self.store = JSONLSessionStore(storage_dir)
-        self.default_ttl = default_ttl
-        self.cleanup_interval = cleanup_interval
-        self._active_sessions: Dict[str, SessionMetadata] = {}
-        self._session_states: Dict[str, SessionState] = {}
-        self._lock = asyncio.Lock()
-        self._cleanup_task: Optional[asyncio.Task] = None
-        self._running = False
-    
-    async def start(self):
-        """启动管理器"""
-        self._running = True
-        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
-    
-    async def stop(self):
-        """停止管理器"""
-        self._running = False
-        if self._cleanup_task:
-            self._cleanup_task.cancel()
-            try:
-                await self._cleanup_task
-            except asyncio.CancelledError:
-                pass
-    
-    async def _cleanup_loop(self):
-        """清理过期 session 的循环"""
-        while self._running:
-            try:
-                await asyncio.sleep(self.cleanup_interval)
-                await self.cleanup_expired_sessions()
-            except asyncio.CancelledError:
-                break
-            except Exception:
-                continue
-    
-    async def create_session(
-        self,
-        client_id: str,
-        user_agent: str = "",
-        ip_address: str = "",
-        custom_data: Optional[Dict] = None,
-        ttl: Optional[int] = None
-    ) -> SessionMetadata:
-        """创建新 session"""
-        now = time.time()
-        session_id = str(uuid.uuid4())
-        
-        session = SessionMetadata(
-            session_id=session_id,
-            client_id=client_id,
-            created_at=now,
-            last_activity=now,
-            expires_at=now + (ttl or self.default_ttl),
-            user_agent=user_agent,
-            ip_address=ip_address,
-            custom_data=custom_data or {}
-        )
-        
-        async with self._lock:
-            self._active_sessions[session_id] = session
-        
-        await self.store.save_session(session)
-        
-        # 创建初始状态
-        state = SessionState(
-            session_id=session_id,
-            status="active",
-            data={},
-            sequence_number=1,
-            checkpoint_id=str(uuid.uuid4())
-        )
-        
-        async with self._lock:
-            self._session_states[session_id] = state
-        
-        await self.store.save_state(session_id, state)
-        
-        return session
-    
-    async def get_session(self, session_id: str) -> Optional[SessionMetadata]:
-        """获取 session"""
-        now = time.time()
-        
-        async with self._lock:
-            if session_id in self._active_sessions:
-                session = self._active_sessions[session_id]
-                # 检查是否过期
-                if session.expires_at > now:
-                    return session
-                else:
-                    # 过期了，从内存中移除
-                    del self._active_sessions[session_id]
-                    self._session_states.pop(session_id, None)
-                    return None
-        
-        # 从存储加载
-        session = await self.store.load_session(session_id)
-        if session and session.expires_at > now:
-            async with self._lock:
-                self._active_sessions[session_id] = session
-            return session
-        
-        return None
-    
-    async def update_session_activity(self, session_id: str) -> bool:
-        """更新 session 活动时间"""
-        async with self._lock:
-            if session_id not in self._active_sessions:
-                return False
-            
-            session = self._active_sessions[session_id]
-            session.last_activity = time.time()
-            session.expires_at = session.last_activity + self.default_ttl
-        
-        await self.store.save_session(self._active_sessions[session_id])
-        return True
-    
-    async def save_state(
-        self,
-        session_id: str,
-        data: Dict[str, Any],
-        status: str = "active"
-    ) -> Optional[SessionState]:
-        """保存 session 状态"""
-        async with self._lock:
-            if session_id not in self._session_states:
-                return None
-            
-            current_state = self._session_states[session_id]
-            new_state = SessionState(
-                session_id=session_id,
-                status=status,
-                data=data,
-                sequence_number=current_state.sequence_number + 1,
-                checkpoint_id=str(uuid.uuid4())
-            )
-            self._session_states[session_id] = new_state
-        
-        await self.store.save_state(session_id, new_state)
-        return new_state
-    
-    async def get_state(self, session_id: str) -> Optional[SessionState]:
-        """获取 session 状态"""
-        async with self._lock:
-            if session_id in self._session_states:
-                return self._session_states[session_id]
-        
-        return await self.store.load_state(session_id)
-    
-    async def destroy_session(self, session_id: str) -> bool:
-        """销毁 session"""
-        async with self._lock:
-            self._active_sessions.pop(session_id, None)
-            self._session_states.pop(session_id, None)
-        
-        return await self.store.delete_session(session_id)
-    
-    async def cleanup_expired_sessions(self) -> List[str]:
-        """清理过期 session"""
-        now = time.time()
-        expired_sessions = []
-        
-        async with self._lock:
-            for session_id, session in list(self._active_sessions.items()):
-                if session.expires_at < now:
-                    expired_sessions.append(session_id)
-                    del self._active_sessions[session_id]
-                    self._session_states.pop(session_id, None)
-        
-        # 归档过期 session
-        for session_id in expired_sessions:
-            await self.store.archive_session(session_id)
-        
-        return expired_sessions
-    
-    async def restore_session(self, session_id: str) -> Optional[SessionMetadata]:
-        """恢复 session（用于客户端重连）"""
-        session = await self.get_session(session_id)
-        if not session:
-            return None
-        
-        # 更新过期时间
-        now = time.time()
-        session.last_activity = now
-        session.expires_at = now + self.default_ttl
-        
-        await self.store.save_session(session)
-        
-        # 加载状态
-        state = await self.store.load_state(session_id)
-        if state:
-            async with self._lock:
-                self._session_states[session_id] = state
-        
-        return session
-    
-    async def get_active_count(self) -> int:
-        """获取活跃 session 数量"""
-        async with self._lock:
-            return len(self._active_sessions)
-    
-    async def recover_from_storage(self) -> int:
-        """从存储恢复所有 session"""
-        session_ids = await self.store.list_sessions()
-        recovered = 0
-        
-        for session_id in session_ids:
-            session = await self.store.load_session(session_id)
-            if session and session.expires_at > time.time():
-                async with self._lock:
-                    self._active_sessions[session_id] = session
-                
-                state = await self.store.load_state(session_id)
-                if state:
-                    async with self._lock:
-                        self._session_states[session_id] = state
-                
-                recovered += 1
-        
-        return recovered
+def make_state(session_id: str, sequence_number: int = 1, data: Optional[Dict[str, Any]] = None) -> SessionState:
+    """构造 active 状态的 SessionState，checkpoint_id 随机生成"""
+    return SessionState(
+        session_id=session_id,
+        status="active",
+        data=data if data is not None else {},
+        sequence_number=sequence_number,
+        checkpoint_id=str(uuid.uuid4())
+    )
 
 
 # ============================================================================
@@ -619,11 +97,13 @@ async def session_manager(temp_storage_dir):
     await manager.stop()
 
 
-@pytest.fixture
+@pytest_asyncio.fixture
 async def store(temp_storage_dir):
     """创建 JSONLSessionStore 实例"""
     store = JSONLSessionStore(temp_storage_dir)
     yield store
+    await store.flush()
+    store.close_all()
 
 
 # ============================================================================
@@ -715,6 +195,86 @@ class TestSessionBasic:
             assert updated.expires_at > original_expires
         finally:
             await manager.stop()
+    
+    async def test_activity_updates_coalesced(self, temp_storage_dir):
+        """测试活动时间更新只标记为脏，停止时统一写入"""
+        manager = SessionManager(temp_storage_dir, activity_flush_interval=60)
+        await manager.start()
+        
+        try:
+            session = await manager.create_session(client_id="client_001")
+            for _ in range(10):
+                assert await manager.update_session_activity(session.session_id) is True
+            latest_expires = session.expires_at
+            
+            file_path = Path(temp_storage_dir) / f"{session.session_id}.jsonl"
+            with open(file_path, 'rb') as f:
+                metadata_lines = [line for line in f if b'"type":"metadata"' in line]
+            assert len(metadata_lines) == 1  # 只有创建时的一条
+        finally:
+            await manager.stop()
+        
+        # 停止时写入积压的更新
+        new_manager = SessionManager(temp_storage_dir)
+        try:
+            loaded = await new_manager.store.load_session(session.session_id)
+            assert loaded.expires_at == latest_expires
+        finally:
+            await new_manager.stop()
+    
+    async def test_unknown_session_skips_storage(self, temp_storage_dir):
+        """测试存储中不存在的 session 直接返回 None，不读文件"""
+        manager = SessionManager(temp_storage_dir)
+        session = await manager.create_session(client_id="client_001")
+        await manager.store.archive_session(session.session_id)
+        await manager.stop()
+        
+        new_manager = SessionManager(temp_storage_dir)
+        try:
+            stats = new_manager.store.io_stats
+            assert await new_manager.get_session("no-such-session") is None
+            assert await new_manager.get_state("no-such-session") is None
+            assert stats["indexed_reads"] == stats["scans"] == 0
+            
+            # 已归档的 session 仍然能查到
+            assert await new_manager.store.has_session(session.session_id)
+            assert (await new_manager.get_session(session.session_id)).session_id == session.session_id
+            assert stats["scans"] == 1
+        finally:
+            await new_manager.stop()
+    
+    async def test_session_written_by_another_instance_is_found(self, temp_storage_dir):
+        """测试缓存未命中时回退到 stat：另一个实例之后写入的 session 也能查到"""
+        reader = SessionManager(temp_storage_dir)
+        writer = SessionManager(temp_storage_dir)
+        try:
+            session = await writer.create_session(client_id="client_001")
+            await writer.store.flush()
+            
+            assert await reader.store.has_session(session.session_id)
+            assert (await reader.get_session(session.session_id)).session_id == session.session_id
+        finally:
+            await writer.stop()
+            await reader.stop()
+    
+    async def test_concurrent_misses_share_one_load(self, temp_storage_dir):
+        """测试内存未命中时并发的 get_session 共用一次存储读取，状态也一并放回内存"""
+        manager = SessionManager(temp_storage_dir)
+        session = await manager.create_session(client_id="client_001")
+        await manager.stop()
+        
+        new_manager = SessionManager(temp_storage_dir)
+        try:
+            stats = new_manager.store.io_stats
+            results = await asyncio.gather(*(new_manager.get_session(session.session_id) for _ in range(20)))
+            
+            assert all(r.session_id == session.session_id for r in results)
+            assert stats["scans"] == 1
+            # 状态随元数据一起放回内存，再取不读存储
+            assert (await new_manager.get_state(session.session_id)).session_id == session.session_id
+            assert stats["scans"] == 1
+        finally:
+            await new_manager.stop()
 
 
 # ============================================================================
@@ -856,22 +416,12 @@ class TestSessionPersistence:
 class TestJSONLStorage:
     """JSONL 存储格式测试"""
     
-    async def test_jsonl_format(self, temp_storage_dir):
+    async def test_jsonl_format(self, store, temp_storage_dir):
         """测试 JSONL 格式正确性"""
-        store = JSONLSessionStore(temp_storage_dir)
-        
-        session = SessionMetadata(
-            session_id="test-123",
-            client_id="client_001",
-            created_at=time.time(),
-            last_activity=time.time(),
-            expires_at=time.time() + 3600,
-            user_agent="TestAgent",
-            ip_address="127.0.0.1",
-            custom_data={"test": True}
-        )
+        session = make_metadata("test-123", custom_data={"test": True})
         
         await store.save_session(session)
+        await store.flush()
         
         # 读取文件验证格式
         file_path = Path(temp_storage_dir) / "test-123.jsonl"
@@ -885,35 +435,19 @@ class TestJSONLStorage:
             assert record["type"] == "metadata"
             assert record["data"]["session_id"] == "test-123"
     
-    async def test_multiple_records_in_file(self, temp_storage_dir):
+    async def test_multiple_records_in_file(self, store, temp_storage_dir):
         """测试文件中多条记录"""
-        store = JSONLSessionStore(temp_storage_dir)
-        
         session_id = "test-multi"
         
         # 保存元数据
-        session = SessionMetadata(
-            session_id=session_id,
-            client_id="client_001",
-            created_at=time.time(),
-            last_activity=time.time(),
-            expires_at=time.time() + 3600,
-            user_agent="TestAgent",
-            ip_address="127.0.0.1",
-            custom_data={}
-        )
+        session = make_metadata(session_id)
         await store.save_session(session)
         
         # 保存多个状态
         for i in range(3):
-            state = SessionState(
-                session_id=session_id,
-                status="active",
-                data={"step": i},
-                sequence_number=i + 1,
-                checkpoint_id=str(uuid.uuid4())
-            )
+            state = make_state(session_id, i + 1, data={"step": i})
             await store.save_state(session_id, state)
+        await store.flush()
         
         # 验证文件包含 4 条记录
         file_path = Path(temp_storage_dir) / f"{session_id}.jsonl"
@@ -926,21 +460,196 @@ class TestJSONLStorage:
                 record = json.loads(line.strip())
                 assert "type" in record
     
-    async def test_storage_integrity(self, temp_storage_dir):
-        """测试存储完整性检查"""
-        store = JSONLSessionStore(temp_storage_dir)
+    async def test_group_commit(self, store, temp_storage_dir):
+        """测试组提交：并发保存合并成少量批次写入，save 返回时记录已落盘"""
+        session_id = "test-group-commit"
+        file_path = Path(temp_storage_dir) / f"{session_id}.jsonl"
         
+        stats = store.io_stats
+        await asyncio.gather(*(
+            store.save_state(session_id, make_state(session_id, i + 1, data={"step": i}))
+            for i in range(50)
+        ))
+        
+        # 无需 flush，save 返回即已落盘
+        with open(file_path, 'rb') as f:
+            assert len(f.readlines()) == 50
+        assert stats["records"] == 50
+        assert stats["batches"] < 50
+        
+        # 批次字节数受 max_batch_bytes 限制，积压被拆成多批
+        batches_before = stats["batches"]
+        store.max_batch_bytes = 1024
+        await asyncio.gather(*(
+            store.save_state(
+                session_id, make_state(session_id, 51 + i, data={"step": i, "payload": "x" * 200})
+            )
+            for i in range(20)
+        ))
+        assert stats["records"] == 70
+        assert stats["batches"] - batches_before >= 4
+        assert (await store.load_state(session_id)).sequence_number == 70
+    
+    async def test_save_sessions_bulk(self, store, temp_storage_dir):
+        """测试批量保存元数据：一次调用合并成少量批次写入"""
+        sessions = [
+            make_metadata(f"bulk-{i}", client_id=f"client_{i}", custom_data={"index": i})
+            for i in range(100)
+        ]
+        assert await store.save_sessions(sessions) is True
+        
+        assert store.io_stats["records"] == 100
+        assert store.io_stats["batches"] <= 2
+        for i in (0, 57, 99):
+            loaded = await store.load_session(f"bulk-{i}")
+            assert loaded.custom_data == {"index": i}
+    
+    async def test_commit_delay_groups_fsync(self, temp_storage_dir):
+        """测试 commit_delay：陆续到达的保存在等待窗口内合并成一次刷盘"""
+        store = JSONLSessionStore(temp_storage_dir, fsync=True, commit_delay=0.05)
+        
+        async def save(i):
+            await asyncio.sleep(i * 0.002)
+            await store.save_state("test-commit-delay", make_state("test-commit-delay", i + 1, data={"step": i}))
+        
+        try:
+            await asyncio.gather(*(save(i) for i in range(10)))
+            assert store.io_stats["syncs"] == 1
+            assert (await store.load_state("test-commit-delay")).sequence_number == 10
+        finally:
+            store.close_all()
+    
+    async def test_append_fd_cache_bounded(self, temp_storage_dir):
+        """测试追加描述符缓存：超出上限时关闭最久未用的，之后仍可继续追加"""
+        store = JSONLSessionStore(temp_storage_dir, max_open_files=2)
+        try:
+            for round_no in range(2):
+                for i in range(3):
+                    await store.save_state(f"fd-{i}", make_state(f"fd-{i}", round_no + 1))
+                assert store.cached_handles == ["fd-1", "fd-2"]
+            
+            for i in range(3):
+                assert (await store.load_state(f"fd-{i}")).sequence_number == 2
+        finally:
+            await store.flush()
+            store.close_all()
+        assert store.cached_handles == []
+    
+    async def test_offset_index(self, store, temp_storage_dir):
+        """测试偏移索引：命中时直接读取最新记录，文件被外部追加后回退到文件扫描"""
+        session_id = "test-index"
+        file_path = Path(temp_storage_dir) / f"{session_id}.jsonl"
+        
+        for i in range(5):
+            await store.save_state(session_id, make_state(session_id, i + 1, data={"step": i}))
+        
+        state = await store.load_state(session_id)
+        assert state.sequence_number == 5
+        assert await store.load_session(session_id) is None
+        assert store.io_stats["indexed_reads"] == 1
+        assert store.io_stats["scans"] == 0
+        
+        # 外部写入使索引失效
+        with open(file_path, 'a') as f:
+            f.write(json.dumps({
+                "type": "state",
+                "timestamp": time.time(),
+                "data": {
+                    "session_id": session_id,
+                    "status": "active",
+                    "data": {},
+                    "sequence_number": 6,
+                    "checkpoint_id": str(uuid.uuid4())
+                }
+            }) + "\n")
+        
+        state = await store.load_state(session_id)
+        assert state.sequence_number == 6
+        assert store.io_stats["scans"] == 1
+    
+    async def test_load_cache(self, store, temp_storage_dir):
+        """测试读缓存：命中时不读文件，写入/删除后失效"""
+        session_id = "test-load-cache"
+        for i in range(3):
+            await store.save_state(session_id, make_state(session_id, i + 1, data={"step": i}))
+        
+        first = await store.load_state(session_id)
+        assert first.sequence_number == 3
+        
+        def reads():
+            return store.io_stats["indexed_reads"] + store.io_stats["scans"]
+        
+        before = reads()
+        assert await store.load_state(session_id) is first
+        assert reads() == before
+        
+        await store.save_state(session_id, make_state(session_id, 4, data={"step": 3}))
+        assert (await store.load_state(session_id)).sequence_number == 4
+        assert reads() == before + 1
+        
+        # 元数据和状态一起加载时同样走读缓存
+        _, state = await store.load_all(session_id)
+        assert state.sequence_number == 4
+        before = reads()
+        assert await store.load_all(session_id) == (None, state)
+        assert reads() == before
+        
+        await store.delete_session(session_id)
+        assert await store.load_state(session_id) is None
+    
+    async def test_large_file_scan(self, store, temp_storage_dir):
+        """测试大文件（走 mmap 切分）的加载与校验，包括末行无换行符"""
+        session_id = "test-large"
+        file_path = Path(temp_storage_dir) / f"{session_id}.jsonl"
+        
+        for i in range(100):
+            await store.save_state(
+                session_id, make_state(session_id, i + 1, data={"step": i, "payload": "x" * 1024})
+            )
+        await store.flush()
+        assert file_path.stat().st_size > 64 * 1024
+        
+        # 去掉末尾换行，最后一行没有换行符时也应能解析
+        with open(file_path, 'rb+') as f:
+            f.truncate(file_path.stat().st_size - 1)
+        
+        state = await store.load_state(session_id)
+        assert state.sequence_number == 100
+        
+        integrity = await store.verify_integrity(session_id)
+        assert integrity["valid_records"] == 100
+        assert integrity["invalid_records"] == 0
+    
+    async def test_compact(self, temp_storage_dir):
+        """测试压实：只保留最新的元数据/状态，历史分段一并删除，之后仍可继续追加"""
+        session_id = "test-compact"
+        store = JSONLSessionStore(temp_storage_dir, max_segment_bytes=2048)
+        try:
+            await store.save_session(make_metadata(session_id, client_id="client"))
+            for i in range(30):
+                await store.save_state(
+                    session_id, make_state(session_id, i + 1, data={"step": i, "payload": "x" * 100})
+                )
+            assert list(Path(temp_storage_dir).glob(f"{session_id}.jsonl.[0-9]*"))
+            
+            assert await store.compact(session_id) is True
+            assert sorted(p.name for p in Path(temp_storage_dir).iterdir()) == [f"{session_id}.jsonl"]
+            integrity = await store.verify_integrity(session_id)
+            assert integrity["valid_records"] == 2
+            
+            await store.save_state(session_id, make_state(session_id, 31))
+            assert (await store.load_state(session_id)).sequence_number == 31
+            assert (await store.load_session(session_id)).client_id == "client"
+            stats = await store.get_storage_stats()
+            assert stats["total_size_bytes"] == (Path(temp_storage_dir) / f"{session_id}.jsonl").stat().st_size
+        finally:
+            await store.flush()
+            store.close_all()
+    
+    async def test_storage_integrity(self, store, temp_storage_dir):
+        """测试存储完整性检查"""
         session_id = "test-integrity"
-        session = SessionMetadata(
-            session_id=session_id,
-            client_id="client_001",
-            created_at=time.time(),
-            last_activity=time.time(),
-            expires_at=time.time() + 3600,
-            user_agent="TestAgent",
-            ip_address="127.0.0.1",
-            custom_data={}
-        )
+        session = make_metadata(session_id)
         await store.save_session(session)
         
         # 验证完整性
@@ -951,30 +660,19 @@ class TestJSONLStorage:
         assert result["invalid_records"] == 0
         assert len(result["errors"]) == 0
     
-    async def test_archive_functionality(self, temp_storage_dir):
+    async def test_archive_functionality(self, store, temp_storage_dir):
         """测试归档功能"""
-        store = JSONLSessionStore(temp_storage_dir)
-        
         session_id = "test-archive"
-        session = SessionMetadata(
-            session_id=session_id,
-            client_id="client_001",
-            created_at=time.time(),
-            last_activity=time.time(),
-            expires_at=time.time() + 3600,
-            user_agent="TestAgent",
-            ip_address="127.0.0.1",
-            custom_data={"archived": True}
-        )
+        session = make_metadata(session_id, custom_data={"archived": True})
         await store.save_session(session)
         
         # 归档
         result = await store.archive_session(session_id)
         assert result is True
         
-        # 验证原文件已删除，归档文件存在
+        # 验证原文件已删除，归档文件存在（单条元数据很小，不压缩直接改名）
         file_path = Path(temp_storage_dir) / f"{session_id}.jsonl"
-        archive_path = Path(temp_storage_dir) / f"{session_id}.jsonl.gz"
+        archive_path = Path(temp_storage_dir) / f"{session_id}.jsonl.archived"
         
         assert not file_path.exists()
         assert archive_path.exists()
@@ -985,22 +683,112 @@ class TestJSONLStorage:
         assert loaded.session_id == session_id
         assert loaded.custom_data["archived"] is True
     
-    async def test_storage_stats(self, temp_storage_dir):
-        """测试存储统计"""
-        store = JSONLSessionStore(temp_storage_dir)
+    async def test_archive_failure_keeps_source(self, store, temp_storage_dir, monkeypatch):
+        """测试归档中途失败：原文件保留，不留下归档或临时文件"""
+        session_id = "test-archive-failure"
+        store.compression_min_size = 0
+        await store.save_state(session_id, make_state(session_id, data={"step": 1}))
+        
+        def failing_copy(*args, **kwargs):
+            raise OSError("disk full")
+        
+        monkeypatch.setattr(shutil, "copyfileobj", failing_copy)
+        with pytest.raises(OSError):
+            await store.archive_session(session_id)
+        
+        assert (Path(temp_storage_dir) / f"{session_id}.jsonl").exists()
+        assert [p.name for p in Path(temp_storage_dir).iterdir() if not p.name.startswith(".")] == [
+            f"{session_id}.jsonl"
+        ]
+        assert (await store.load_state(session_id)).sequence_number == 1
+    
+    @pytest.mark.skipif(zstandard is None, reason="zstandard 未安装")
+    async def test_zstd_archive_with_dictionary(self, temp_storage_dir):
+        """测试 zstd 归档：样本足够时训练字典，旧的 gzip 归档仍可读取"""
+        gzip_store = JSONLSessionStore(temp_storage_dir, archive_codec="gzip", compression_min_size=0)
+        legacy = make_metadata("legacy", client_id="client")
+        await gzip_store.save_session(legacy)
+        await gzip_store.archive_session("legacy")
+        gzip_store.close_all()
+        
+        store = JSONLSessionStore(temp_storage_dir, archive_codec="zstd", compression_min_size=0)
+        try:
+            for i in range(100):
+                await store.save_session(make_metadata(
+                    f"zstd-{i}", client_id=f"client-{i}", user_agent="TestAgent/1.0", custom_data={"index": i}
+                ))
+            await store.flush()
+            for i in range(100):
+                assert await store.archive_session(f"zstd-{i}")
+            
+            assert (Path(temp_storage_dir) / ".zstd.dict").exists()
+            assert (Path(temp_storage_dir) / "zstd-99.jsonl.zst").exists()
+            
+            loaded = await store.load_session("zstd-99")
+            assert loaded.custom_data == {"index": 99}
+            assert (await store.load_session("legacy")).client_id == "client"
+            
+            stats = await store.get_storage_stats()
+            assert stats["archived_files"] == 101
+        finally:
+            store.close_all()
+    
+    @pytest.mark.skipif(zstandard is None, reason="zstandard 未安装")
+    async def test_zstd_dictionary_from_gzip_archives(self, temp_storage_dir):
+        """测试冷启动：只有旧 gzip 归档时也能取样训练字典"""
+        gzip_store = JSONLSessionStore(temp_storage_dir, archive_codec="gzip", compression_min_size=0)
+        for i in range(40):
+            await gzip_store.save_state(f"legacy-{i}", make_state(f"legacy-{i}", data={"step": i}))
+            await gzip_store.archive_session(f"legacy-{i}")
+        gzip_store.close_all()
+        
+        store = JSONLSessionStore(temp_storage_dir, archive_codec="zstd", compression_min_size=0)
+        try:
+            # 第一次 zstd 归档时用旧归档取样训练字典
+            await store.save_state("new", make_state("new"))
+            assert await store.archive_session("new") is True
+            assert (Path(temp_storage_dir) / ".zstd.dict").exists()
+            assert (Path(temp_storage_dir) / "new.jsonl.zst").exists()
+            assert (await store.load_state("legacy-39")).data == {"step": 39}
+        finally:
+            store.close_all()
+    
+    async def test_segment_rotation(self, temp_storage_dir):
+        """测试分段滚动：加载只读当前分段，校验/归档覆盖所有分段"""
+        store = JSONLSessionStore(temp_storage_dir, max_segment_bytes=2048)
+        session_id = "test-segments"
         
+        try:
+            await store.save_session(make_metadata(session_id, client_id="client", custom_data={"segmented": True}))
+            for i in range(100):
+                await store.save_state(session_id, make_state(session_id, i + 1, data={"step": i}))
+            
+            segments = sorted(Path(temp_storage_dir).glob(f"{session_id}.jsonl.*"))
+            assert len(segments) > 1
+            assert (Path(temp_storage_dir) / f"{session_id}.jsonl").stat().st_size < 2048
+            assert await store.list_sessions() == [session_id]
+            
+            # 元数据在第一个分段里写入，仍能从当前分段读到
+            metadata = await store.load_session(session_id)
+            assert metadata.custom_data == {"segmented": True}
+            assert (await store.load_state(session_id)).sequence_number == 100
+            
+            integrity = await store.verify_integrity(session_id)
+            assert integrity["valid_records"] >= 101
+            assert integrity["invalid_records"] == 0
+            
+            assert await store.archive_session(session_id)
+            assert not list(Path(temp_storage_dir).glob(f"{session_id}.jsonl.[0-9]*"))
+            assert (await store.load_state(session_id)).sequence_number == 100
+            assert (await store.get_storage_stats())["total_sessions"] == 1
+        finally:
+            store.close_all()
+    
+    async def test_storage_stats(self, store, temp_storage_dir, monkeypatch):
+        """测试存储统计"""
         # 创建多个 session
         for i in range(5):
-            session = SessionMetadata(
-                session_id=f"session-{i}",
-                client_id=f"client_{i}",
-                created_at=time.time(),
-                last_activity=time.time(),
-                expires_at=time.time() + 3600,
-                user_agent="TestAgent",
-                ip_address="127.0.0.1",
-                custom_data={}
-            )
+            session = make_metadata(f"session-{i}", client_id=f"client_{i}")
             await store.save_session(session)
         
         # 归档其中 2 个
@@ -1014,6 +802,20 @@ class TestJSONLStorage:
         assert stats["active_files"] == 3
         assert stats["archived_files"] == 2
         assert stats["total_size_bytes"] > 0
+        
+        # 新实例启动时扫描目录，统计与增量维护的结果一致
+        rescanned = JSONLSessionStore(temp_storage_dir)
+        assert await rescanned.get_storage_stats() == stats
+        assert sorted(await rescanned.list_sessions()) == [f"session-{i}" for i in range(5)]
+        
+        # 统计与列表只读缓存，不再遍历目录或 stat 文件
+        def no_fs(*args, **kwargs):
+            raise AssertionError("unexpected filesystem access")
+        
+        monkeypatch.setattr(os, "scandir", no_fs)
+        monkeypatch.setattr(os, "stat", no_fs)
+        assert await store.get_storage_stats() == stats
+        assert len(await store.list_sessions()) == 5
 
 
 # ============================================================================
@@ -1131,6 +933,30 @@ class TestSessionExpiration:
                 assert await manager.get_session(session_id) is not None
         finally:
             await manager.stop()
+    
+    async def test_cleanup_follows_changed_expiry(self, temp_storage_dir):
+        """测试过期堆：延期的 session 不被清理，过期时间提前的按新时间清理"""
+        manager = SessionManager(temp_storage_dir, default_ttl=1, cleanup_interval=60)
+        await manager.start()
+        
+        try:
+            extended = await manager.create_session(client_id="extended", ttl=1)
+            shortened = await manager.create_session(client_id="shortened", ttl=3600)
+            
+            # 延期到 1 小时后；把 1 小时的 TTL 缩短为 default_ttl（1 秒）
+            manager.default_ttl = 3600
+            assert await manager.update_session_activity(extended.session_id)
+            manager.default_ttl = 1
+            assert await manager.update_session_activity(shortened.session_id)
+            
+            await asyncio.sleep(1.5)
+            expired = await manager.cleanup_expired_sessions()
+            
+            assert expired == [shortened.session_id]
+            assert await manager.get_session(extended.session_id) is not None
+            assert (await manager.get_session(extended.session_id)).expires_at > time.time() + 3000
+        finally:
+            await manager.stop()
 
 
 # ============================================================================
@@ -1330,6 +1156,28 @@ class TestSessionConcurrency:
         finally:
             await manager.stop()
     
+    async def test_state_records_appended_in_order(self, temp_storage_dir):
+        """测试写队列已满时，同一 session 的状态仍按序号顺序落盘"""
+        manager = SessionManager(temp_storage_dir)
+        manager.store.max_queue_size = 1
+        session = await manager.create_session(client_id="ordered_client")
+        
+        try:
+            await asyncio.gather(*(
+                manager.save_state(session.session_id, data={"i": i}) for i in range(50)
+            ))
+        finally:
+            await manager.stop()
+        
+        file_path = Path(temp_storage_dir) / f"{session.session_id}.jsonl"
+        with open(file_path, 'rb') as f:
+            sequence_numbers = [
+                record["data"]["sequence_number"]
+                for record in map(json.loads, f)
+                if record["type"] == "state"
+            ]
+        assert sequence_numbers == list(range(1, 52))
+    
     async def test_100_active_sessions(self, temp_storage_dir):
         """测试 100+ 同时活跃的 session"""
         manager = SessionManager(temp_storage_dir)
@@ -1445,26 +1293,15 @@ class TestSessionConcurrency:
 class TestSessionPerformance:
     """Session 性能测试"""
     
-    async def test_large_data_storage(self, temp_storage_dir):
+    async def test_large_data_storage(self, store, temp_storage_dir):
         """测试大数据量存储"""
-        store = JSONLSessionStore(temp_storage_dir)
-        
         # 创建包含大数据的 session
         large_data = {
             "items": [f"item_{i}" for i in range(10000)],
             "metadata": {f"key_{i}": f"value_{i}" for i in range(1000)}
         }
         
-        session = SessionMetadata(
-            session_id="large-data-session",
-            client_id="client_001",
-            created_at=time.time(),
-            last_activity=time.time(),
-            expires_at=time.time() + 3600,
-            user_agent="TestAgent",
-            ip_address="127.0.0.1",
-            custom_data=large_data
-        )
+        session = make_metadata("large-data-session", custom_data=large_data)
         
         start_time = time.time()
         await store.save_session(session)
@@ -1502,7 +1339,8 @@ class TestSessionPerformance:
             # 验证性能
             assert create_time < 30.0  # 200 个 session 应该在 30 秒内完成
             
-            # 批量恢复测试
+            # 批量恢复测试（先落盘写缓冲，新实例才能读到）
+            await manager.store.flush()
             new_manager = SessionManager(temp_storage_dir)
             await new_manager.start()
             
@@ -1517,25 +1355,21 @@ class TestSessionPerformance:
         finally:
             await manager.stop()
     
-    async def test_storage_compression_ratio(self, temp_storage_dir):
+    async def test_storage_compression_ratio(self, store, temp_storage_dir):
         """测试存储压缩比率"""
-        store = JSONLSessionStore(temp_storage_dir)
-        
         # 创建包含重复数据的 session
         session_id = "compress-test"
         
         for i in range(100):
-            session = SessionMetadata(
-                session_id=session_id,
+            session = make_metadata(
+                session_id,
                 client_id=f"client_{i}",
-                created_at=time.time(),
-                last_activity=time.time(),
-                expires_at=time.time() + 3600,
                 user_agent="TestAgent/1.0 (Very Long User Agent String For Testing Compression)",
                 ip_address="192.168.1.100",
                 custom_data={"iteration": i, "template": "repeated_data_pattern" * 10}
             )
             await store.save_session(session)
+        await store.flush()
         
         # 获取原始大小
         file_path = Path(temp_storage_dir) / f"{session_id}.jsonl"
@@ -1544,7 +1378,7 @@ class TestSessionPerformance:
         # 归档
         await store.archive_session(session_id)
         
-        archive_path = Path(temp_storage_dir) / f"{session_id}.jsonl.gz"
+        archive_path, = Path(temp_storage_dir).glob(f"{session_id}.jsonl.*")
         compressed_size = archive_path.stat().st_size
         
         # 计算压缩比率
@@ -1616,34 +1450,14 @@ class TestSessionEdgeCases:
         finally:
             await manager.stop()
     
-    async def test_duplicate_session_id_handling(self, temp_storage_dir):
+    async def test_duplicate_session_id_handling(self, store, temp_storage_dir):
         """测试重复 session ID 处理"""
-        store = JSONLSessionStore(temp_storage_dir)
-        
         # 两次保存相同 ID 的 session（追加模式）
         session_id = "duplicate-test"
         
-        session1 = SessionMetadata(
-            session_id=session_id,
-            client_id="client_v1",
-            created_at=time.time(),
-            last_activity=time.time(),
-            expires_at=time.time() + 3600,
-            user_agent="Agent/1.0",
-            ip_address="127.0.0.1",
-            custom_data={"version": 1}
-        )
+        session1 = make_metadata(session_id, client_id="client_v1", user_agent="Agent/1.0", custom_data={"version": 1})
         
-        session2 = SessionMetadata(
-            session_id=session_id,
-            client_id="client_v2",
-            created_at=time.time(),
-            last_activity=time.time(),
-            expires_at=time.time() + 3600,
-            user_agent="Agent/2.0",
-            ip_address="127.0.0.1",
-            custom_data={"version": 2}
-        )
+        session2 = make_metadata(session_id, client_id="client_v2", user_agent="Agent/2.0", custom_data={"version": 2})
         
         await store.save_session(session1)
         await store.save_session(session2)
@@ -1698,7 +1512,14 @@ class TestSessionEdgeCases:
                 data=special_data
             )
             
-            # 重新加载
+            # 重新加载（先落盘写缓冲，新实例才能读到）
+            await manager.store.flush()
+            # 非 ASCII 字符按 UTF-8 原样写出，不展开成 \uXXXX 转义；换行符仍须转义，保证一条记录一行
+            raw = (Path(temp_storage_dir) / f"{session.session_id}.jsonl").read_bytes()
+            assert special_data["unicode"].encode() in raw
+            assert b"\\u" not in raw
+            assert raw.count(b"\n") == len(raw.splitlines()) == 3
+            
             new_manager = SessionManager(temp_storage_dir)
             await new_manager.start()
             
@@ -1715,24 +1536,23 @@ class TestSessionEdgeCases:
         finally:
             await manager.stop()
     
-    async def test_corrupted_file_recovery(self, temp_storage_dir):
-        """测试损坏文件恢复"""
-        store = JSONLSessionStore(temp_storage_dir)
+    async def test_non_string_keys_in_data(self, store, temp_storage_dir):
+        """测试自定义数据中的非字符串键按 JSON 规则转成字符串"""
+        await store.save_session(make_metadata(
+            "non-str-keys", client_id="client", custom_data={1: "one", None: "none", "nested": {2.5: True}}
+        ))
         
+        loaded = await store.load_session("non-str-keys")
+        assert loaded.custom_data == {"1": "one", "null": "none", "nested": {"2.5": True}}
+    
+    async def test_corrupted_file_recovery(self, store, temp_storage_dir):
+        """测试损坏文件恢复"""
         session_id = "corrupt-test"
         
         # 创建有效数据
-        session = SessionMetadata(
-            session_id=session_id,
-            client_id="client_001",
-            created_at=time.time(),
-            last_activity=time.time(),
-            expires_at=time.time() + 3600,
-            user_agent="TestAgent",
-            ip_address="127.0.0.1",
-            custom_data={}
-        )
+        session = make_metadata(session_id)
         await store.save_session(session)
+        await store.flush()
         
         # 追加损坏的数据
         file_path = Path(temp_storage_dir) / f"{session_id}.jsonl"
@@ -1745,11 +1565,23 @@ class TestSessionEdgeCases:
         assert result["exists"] is True
         assert result["invalid_records"] == 2
         assert len(result["errors"]) == 2
+        assert result["errors"][0].startswith("Line 2: JSON decode error")
+        assert result["errors"][1].startswith("Line 3: Truncated record")
         
         # 但有效数据仍然可以加载
         loaded = await store.load_session(session_id)
         assert loaded is not None
         assert loaded.session_id == session_id
+        
+        # 之后的追加从新行开始，不会拼接到半截记录上
+        store.close_all()
+        await store.save_state(session_id, make_state(session_id, data={"after": "crash"}))
+        await store.flush()
+        state = await store.load_state(session_id)
+        assert state is not None and state.data == {"after": "crash"}
+        result = await store.verify_integrity(session_id)
+        assert result["valid_records"] == 2
+        assert result["invalid_records"] == 2
 
 
 # ============================================================================
@@ -18,14 +18,18 @@ Bamboo API 工具和技能测试脚本
 - 技能热重载验证
 """
 
+import functools
+import importlib.util
 import json
 import os
 import sys
 import time
 import unittest
+from collections.abc import Sequence
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Callable, ClassVar, Tuple
 from dataclasses import dataclass
+from datetime import datetime
 from unittest.mock import Mock, patch, MagicMock
 
 import requests
@@ -36,7 +40,61 @@ DEFAULT_BASE_URL = "http://localhost:8080"
 BASE_URL = os.getenv("BAMBOO_API_URL", DEFAULT_BASE_URL)
 
 
-@dataclass
+@functools.lru_cache(maxsize=8)
+def _probe(base_url: str) -> bool:
+    """检查服务器是否可用（按 URL 缓存，同一进程内只探测一次）
+    
+    连接超时取短值：服务器不在时不必等满 2 秒；连上后仍给健康检查 2 秒响应。
+    """
+    try:
+        response = requests.get(f"{base_url}/api/v1/health", timeout=(0.25, 2))
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+
+# 计算器表达式允许的字符；translate 删掉这些字符后还有剩余即含非法字符
+_CALC_ALLOWED = "0123456789+-*/(). "
+_CALC_REJECT_TABLE = str.maketrans("", "", _CALC_ALLOWED)
+
+
+@functools.lru_cache(maxsize=256)
+def _evaluate_expr(expression: str) -> str:
+    """计算表达式并返回结果文本
+    
+    表达式只含数字和运算符（调用方已校验），结果只取决于表达式本身，
+    所以按表达式缓存结果：重复的表达式直接查表，不再编译和求值。出错时抛出异常，不缓存。
+    """
+    code = compile(expression, "<calc>", "eval")
+    return str(eval(code, {"__builtins__": {}}, {}))
+
+
+def _head_lines(text: str, limit: Optional[int]) -> str:
+    """取前 limit 行，结果同 "\n".join(text.split("\n")[:limit])，但只查找到第 limit 个换行符
+
+    limit 为 None 时与切片一致，返回全部内容。
+    """
+    if limit is None:
+        return text
+    if limit <= 0:
+        return "\n".join(text.split("\n")[:limit])
+    end = -1
+    for _ in range(limit):
+        end = text.find("\n", end + 1)
+        if end == -1:
+            return text
+    return text[:end]
+
+
+# get_time 的 format 参数 -> 格式化函数（未知格式按 iso 处理）
+_TIME_FORMATTERS: Dict[str, Callable[[datetime], str]] = {
+    "iso": datetime.isoformat,
+    "timestamp": lambda now: str(int(now.timestamp())),
+    "human": lambda now: now.strftime("%Y-%m-%d %H:%M:%S"),
+}
+
+
+@dataclass(slots=True)
 class ToolResult:
     """工具执行结果"""
     success: bool
@@ -45,7 +103,7 @@ class ToolResult:
     duration_ms: int = 0
 
 
-@dataclass
+@dataclass(slots=True)
 class ToolDef:
     """工具定义"""
     name: str
@@ -54,7 +112,7 @@ class ToolDef:
     args: List[Dict[str, Any]]
 
 
-@dataclass
+@dataclass(slots=True)
 class Skill:
     """技能定义"""
     name: str
@@ -64,12 +122,39 @@ class Skill:
     system_prompt: Optional[str] = None
 
 
+class CallHistory(Sequence):
+    """调用历史的只读快照：取某一项时才组装成 {"tool", "args", "timestamp"} dict"""
+    
+    __slots__ = ("_calls",)
+    
+    def __init__(self, calls: Tuple[Tuple[str, Dict[str, Any], float], ...]):
+        self._calls = calls
+    
+    def __len__(self) -> int:
+        return len(self._calls)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CallHistory(self._calls[index])
+        tool, args, ts = self._calls[index]
+        return {"tool": tool, "args": args, "timestamp": ts}
+
+
 class MockToolExecutor:
     """Mock 工具执行器 - 用于测试，避免依赖外部服务"""
     
+    # Mock 文件内容（类加载时生成一次）
+    _MOCK_FILES: ClassVar[Dict[str, str]] = {
+        "/tmp/test.txt": "Hello, World!\nThis is a test file.\nLine 3\n",
+        "/tmp/data.json": json.dumps({"name": "test", "value": 42}, indent=2),
+        "test.txt": "Relative path test file content.\n" * 5,
+    }
+    
     def __init__(self):
         self.tools: Dict[str, ToolDef] = {}
-        self.call_history: List[Dict[str, Any]] = []
+        # 每次调用记一个 (tool, args, timestamp) 元组，读取时才组装成 dict；
+        # 单个元组一次 append，并发调用时各列不会错位
+        self._calls: List[Tuple[str, Dict[str, Any], float]] = []
         self._setup_mock_tools()
     
     def _setup_mock_tools(self):
@@ -115,36 +200,36 @@ class MockToolExecutor:
                 {"name": "format", "type": "string", "required": False, "default": "iso", "description": "时间格式"}
             ]
         )
+        
+        # 工具名 -> 实现，execute 一次查表分发
+        self._dispatch: Dict[str, Callable[[Dict[str, Any]], ToolResult]] = {
+            "calculator": self._mock_calculator,
+            "read_file": self._mock_read_file,
+            "text_processor": self._mock_text_processor,
+            "get_time": self._mock_get_time,
+        }
     
     def execute(self, tool_name: str, args: Dict[str, Any]) -> ToolResult:
         """执行 Mock 工具"""
-        self.call_history.append({"tool": tool_name, "args": args, "timestamp": time.time()})
+        self._calls.append((tool_name, args, time.time()))
         
-        if tool_name not in self.tools:
+        handler = self._dispatch.get(tool_name)
+        if handler is None:
             return ToolResult(success=False, output="", error=f"Tool not found: {tool_name}", duration_ms=0)
         
-        tool = self.tools[tool_name]
-        start_time = time.time()
+        # 耗时用单调时钟的整数纳秒计算；调用历史里的时间戳仍是墙上时间
+        start_ns = time.perf_counter_ns()
         
         # 模拟工具执行
         try:
-            if tool_name == "calculator":
-                result = self._mock_calculator(args)
-            elif tool_name == "read_file":
-                result = self._mock_read_file(args)
-            elif tool_name == "text_processor":
-                result = self._mock_text_processor(args)
-            elif tool_name == "get_time":
-                result = self._mock_get_time(args)
-            else:
-                result = ToolResult(success=False, error=f"Unknown tool: {tool_name}")
+            result = handler(args)
             
-            duration_ms = int((time.time() - start_time) * 1000)
+            duration_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
             result.duration_ms = duration_ms
             return result
             
         except Exception as e:
-            duration_ms = int((time.time() - start_time) * 1000)
+            duration_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
             return ToolResult(success=False, output="", error=str(e), duration_ms=duration_ms)
     
     def _mock_calculator(self, args: Dict[str, Any]) -> ToolResult:
@@ -152,14 +237,12 @@ class MockToolExecutor:
         expression = args.get("expression", "")
         try:
             # 安全计算 - 只允许基本数学运算
-            allowed_chars = set("0123456789+-*/(). ")
             if not expression:
                 return ToolResult(success=False, output="", error="Empty expression")
-            if not all(c in allowed_chars for c in expression):
+            if expression.translate(_CALC_REJECT_TABLE):
                 return ToolResult(success=False, output="", error="Invalid characters in expression")
             
-            result = eval(expression)  # 在测试环境中安全使用
-            return ToolResult(success=True, output=str(result), error=None)
+            return ToolResult(success=True, output=_evaluate_expr(expression), error=None)
         except Exception as e:
             return ToolResult(success=False, output="", error=f"Calculation error: {e}")
     
@@ -168,16 +251,10 @@ class MockToolExecutor:
         path = args.get("path", "")
         limit = args.get("limit", 100)
         
-        # Mock 文件内容
-        mock_files = {
-            "/tmp/test.txt": "Hello, World!\nThis is a test file.\nLine 3\n",
-            "/tmp/data.json": json.dumps({"name": "test", "value": 42}, indent=2),
-            "test.txt": "Relative path test file content.\n" * 5,
-        }
-        
-        content = mock_files.get(path, f"Mock content for {path}\nLine 2\nLine 3\n")
-        lines = content.split("\n")[:limit]
-        return ToolResult(success=True, output="\n".join(lines), error=None)
+        content = self._MOCK_FILES.get(path)
+        if content is None:
+            content = f"Mock content for {path}\nLine 2\nLine 3\n"
+        return ToolResult(success=True, output=_head_lines(content, limit), error=None)
     
     def _mock_text_processor(self, args: Dict[str, Any]) -> ToolResult:
         """Mock 文本处理器实现"""
@@ -188,7 +265,7 @@ class MockToolExecutor:
             result = {
                 "chars": len(text),
                 "words": len(text.split()),
-                "lines": len(text.split("\n"))
+                "lines": text.count("\n") + 1
             }
             return ToolResult(success=True, output=json.dumps(result, indent=2), error=None)
         elif operation == "upper":
@@ -202,32 +279,24 @@ class MockToolExecutor:
     
     def _mock_get_time(self, args: Dict[str, Any]) -> ToolResult:
         """Mock 时间获取实现"""
-        format_type = args.get("format", "iso")
-        from datetime import datetime
-        now = datetime.now()
-        
-        if format_type == "iso":
-            output = now.isoformat()
-        elif format_type == "timestamp":
-            output = str(int(now.timestamp()))
-        elif format_type == "human":
-            output = now.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            output = now.isoformat()
-        
-        return ToolResult(success=True, output=output, error=None)
+        formatter = _TIME_FORMATTERS.get(args.get("format", "iso"), datetime.isoformat)
+        return ToolResult(success=True, output=formatter(datetime.now()), error=None)
     
     def list_tools(self) -> List[ToolDef]:
         """列出所有可用工具"""
         return list(self.tools.values())
     
-    def get_call_history(self) -> List[Dict[str, Any]]:
-        """获取调用历史"""
-        return self.call_history.copy()
+    def get_call_history(self) -> CallHistory:
+        """获取调用历史（之后的调用不会反映到返回的快照里）"""
+        return CallHistory(tuple(self._calls))
+    
+    def get_tool_names(self) -> List[str]:
+        """按调用顺序获取工具名（不组装完整的历史记录）"""
+        return [tool for tool, _, _ in self._calls]
     
     def clear_history(self):
         """清除调用历史"""
-        self.call_history.clear()
+        self._calls.clear()
 
 
 class MockSkillManager:
@@ -359,6 +428,15 @@ class TestSingleToolExecution(unittest.TestCase):
         result = self.executor.execute("read_file", {"path": "/tmp/test.txt"})
         self.assertTrue(result.success)
         self.assertIn("Hello", result.output)
+        
+        # limit 截取前几行；不足 limit 行时原样返回
+        result = self.executor.execute("read_file", {"path": "/tmp/test.txt", "limit": 2})
+        self.assertEqual(result.output, "Hello, World!\nThis is a test file.")
+        result = self.executor.execute("read_file", {"path": "/tmp/test.txt", "limit": 10})
+        self.assertEqual(result.output, "Hello, World!\nThis is a test file.\nLine 3\n")
+        # limit 为 None 时返回全部内容
+        result = self.executor.execute("read_file", {"path": "/tmp/test.txt", "limit": None})
+        self.assertEqual(result.output, "Hello, World!\nThis is a test file.\nLine 3\n")
     
     def test_text_processor_count(self):
         """测试文本统计"""
@@ -444,6 +522,15 @@ class TestMultiToolChain(unittest.TestCase):
 class TestComplexToolCallScenarios(unittest.TestCase):
     """测试复杂工具调用场景（并行、嵌套、真实场景模拟）"""
     
+    @classmethod
+    def setUpClass(cls):
+        # 并行测试共用一个线程池，不在每个测试里重新创建线程
+        cls.pool = ThreadPoolExecutor(max_workers=4)
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+    
     def setUp(self):
         self.executor = MockToolExecutor()
     
@@ -475,22 +562,19 @@ class TestComplexToolCallScenarios(unittest.TestCase):
         ]
         
         results = []
-        with ThreadPoolExecutor(max_workers=4) as pool:
-            futures = [
-                pool.submit(self.executor.execute, tool, args)
-                for tool, args in tasks
-            ]
-            for future in as_completed(futures):
-                result = future.result()
-                results.append(result)
-                self.assertTrue(result.success)
+        futures = [
+            self.pool.submit(self.executor.execute, tool, args)
+            for tool, args in tasks
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            self.assertTrue(result.success)
         
         self.assertEqual(len(results), len(tasks))
         
-        history = self.executor.get_call_history()
-        self.assertEqual(len(history), len(tasks))
-        
-        tool_names = [item["tool"] for item in history]
+        tool_names = self.executor.get_tool_names()
+        self.assertEqual(len(tool_names), len(tasks))
         for expected in ["calculator", "get_time", "text_processor", "read_file"]:
             self.assertIn(expected, tool_names)
     
@@ -519,8 +603,7 @@ class TestComplexToolCallScenarios(unittest.TestCase):
         self.assertIn("LINES=", format_result.output)
         self.assertIn("AVG=", format_result.output)
         
-        history = self.executor.get_call_history()
-        tool_names = [item["tool"] for item in history]
+        tool_names = self.executor.get_tool_names()
         self.assertGreaterEqual(tool_names.count("text_processor"), 2)
         self.assertIn("calculator", tool_names)
         self.assertIn("read_file", tool_names)
@@ -701,6 +784,13 @@ class TestToolExecutionValidation(unittest.TestCase):
         self.assertEqual(len(history), 2)
         self.assertEqual(history[0]["tool"], "calculator")
         self.assertEqual(history[1]["tool"], "get_time")
+        self.assertEqual(self.executor.get_tool_names(), ["calculator", "get_time"])
+        
+        # 返回的是快照：之后的调用不影响已取得的历史
+        self.executor.execute("calculator", {"expression": "2 + 3"})
+        self.assertEqual(len(history), 2)
+        self.assertEqual([item["tool"] for item in history[1:]], ["get_time"])
+        self.assertEqual(len(self.executor.get_call_history()), 3)
 
 
 class TestRealAPICalls(unittest.TestCase):
@@ -709,25 +799,22 @@ class TestRealAPICalls(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         cls.base_url = BASE_URL
-        cls.skip_real_tests = not cls._server_available()
+        cls.skip_real_tests = not _probe(cls.base_url)
         if cls.skip_real_tests:
             print(f"\n⚠️  服务器不可用 ({cls.base_url})，跳过真实 API 测试")
+        # 各测试共用一个 Session，复用到服务器的连接
+        cls.session = requests.Session()
     
     @classmethod
-    def _server_available(cls) -> bool:
-        """检查服务器是否可用"""
-        try:
-            response = requests.get(f"{cls.base_url}/api/v1/health", timeout=2)
-            return response.status_code == 200
-        except:
-            return False
+    def tearDownClass(cls):
+        cls.session.close()
     
     def test_health_endpoint(self):
         """测试健康检查端点"""
         if self.skip_real_tests:
             self.skipTest("服务器不可用")
         
-        response = requests.get(f"{self.base_url}/api/v1/health")
+        response = self.session.get(f"{self.base_url}/api/v1/health")
         self.assertEqual(response.status_code, 200)
     
     def test_chat_endpoint(self):
@@ -741,7 +828,7 @@ class TestRealAPICalls(unittest.TestCase):
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/v1/chat",
                 json=payload,
                 timeout=5
@@ -758,24 +845,39 @@ class TestRealAPICalls(unittest.TestCase):
             self.skipTest(f"请求失败: {e}")
 
 
-def run_mock_tests():
-    """运行所有 Mock 测试"""
+# Mock 测试类（不依赖服务）
+MOCK_TEST_CLASSES = (
+    TestToolDiscovery,
+    TestSingleToolExecution,
+    TestMultiToolChain,
+    TestComplexToolCallScenarios,
+    TestToolErrorHandling,
+    TestSkillLoading,
+    TestSkillHotReload,
+    TestToolExecutionValidation,
+)
+
+
+def run_mock_tests(parallel: bool = False):
+    """运行所有 Mock 测试
+    
+    parallel=True 且装了 pytest-xdist 时交给 pytest -n auto 分进程运行，否则用 unittest 串行运行。
+    """
     print("=" * 60)
     print("运行 Mock 工具测试")
     print("=" * 60)
     
+    if parallel and importlib.util.find_spec("xdist") is not None:
+        import pytest
+        targets = [f"{__file__}::{cls.__name__}" for cls in MOCK_TEST_CLASSES]
+        return pytest.main([*targets, "-n", "auto"]) == 0
+    
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
     
     # 添加所有测试类
-    suite.addTests(loader.loadTestsFromTestCase(TestToolDiscovery))
-    suite.addTests(loader.loadTestsFromTestCase(TestSingleToolExecution))
-    suite.addTests(loader.loadTestsFromTestCase(TestMultiToolChain))
-    suite.addTests(loader.loadTestsFromTestCase(TestComplexToolCallScenarios))
-    suite.addTests(loader.loadTestsFromTestCase(TestToolErrorHandling))
-    suite.addTests(loader.loadTestsFromTestCase(TestSkillLoading))
-    suite.addTests(loader.loadTestsFromTestCase(TestSkillHotReload))
-    suite.addTests(loader.loadTestsFromTestCase(TestToolExecutionValidation))
+    for test_class in MOCK_TEST_CLASSES:
+        suite.addTests(loader.loadTestsFromTestCase(test_class))
     
     runner = unittest.TextTestRunner(verbosity=2)
     result = runner.run(suite)
@@ -877,6 +979,8 @@ def main():
     parser.add_argument("--mock-only", action="store_true", help="只运行 Mock 测试")
     parser.add_argument("--real-only", action="store_true", help="只运行真实 API 测试")
     parser.add_argument("--demo", action="store_true", help="运行演示")
+    parser.add_argument("--parallel", action="store_true",
+                        help="Mock 测试用 pytest-xdist 分进程并行运行（未安装时串行）")
     parser.add_argument("--url", default=BASE_URL, help=f"API 基础 URL (默认: {DEFAULT_BASE_URL})")
     
     args = parser.parse_args()
@@ -896,10 +1000,10 @@ def main():
     if args.real_only:
         success = run_real_api_tests()
     elif args.mock_only:
-        success = run_mock_tests()
+        success = run_mock_tests(args.parallel)
     else:
         # 运行所有测试
-        mock_success = run_mock_tests()
+        mock_success = run_mock_tests(args.parallel)
         real_success = run_real_api_tests()
         success = mock_success and real_success
     